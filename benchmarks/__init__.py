@@ -0,0 +1,37 @@
+# benchmarks, timing of the QTLab hot paths
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+Benchmarks of the QTLab hot paths: instrument get/set, data point
+append/write, .dat loading, object sharer calls and signals, gnuplot
+replots and fitting. All benchmarks use dummy instruments and run without
+a GUI.
+
+Start qtlab without GUI in the qtlab directory ('qtlab --nogui') and run:
+
+    execfile('benchmarks/run.py')
+
+or, for more control:
+
+    from benchmarks import runner
+    runner.run(output='before.json', names=['instrument_get'])
+
+The results, including information about the environment and the git
+commit, are written in JSON format. Two result files can be compared
+without qtlab:
+
+    python benchmarks/compare.py before.json after.json
+'''
@@ -0,0 +1,38 @@
+# base.py, base class for benchmarks
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+class Benchmark:
+    '''
+    Base class for benchmarks.
+
+    Subclasses set 'name', 'number' (the number of operations timed per
+    repeat) and 'unit' (what an operation is) and implement run(n), which
+    should perform <n> operations. setup() and teardown() are called once,
+    outside of the timed region.
+    '''
+
+    name = None
+    number = 1000
+    unit = 'call'
+
+    def setup(self):
+        pass
+
+    def run(self, n):
+        raise NotImplementedError()
+
+    def teardown(self):
+        pass
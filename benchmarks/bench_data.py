@@ -0,0 +1,103 @@
+# bench_data.py, Data point appending, writing and loading
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import shutil
+import tempfile
+import numpy as np
+
+import qt
+from base import Benchmark
+
+def _new_data(name, **kwargs):
+    d = qt.Data(name=name, **kwargs)
+    d.add_coordinate('x')
+    d.add_coordinate('y')
+    d.add_value('z')
+    return d
+
+def _remove_data(d):
+    qt.data.remove(d.get_name())
+
+class DataAppend(Benchmark):
+    '''Add single data points to an in-memory Data object.'''
+
+    name = 'data_append'
+    number = 20000
+    unit = 'point'
+
+    def setup(self):
+        self._data = _new_data('bench_append', inmem=True, infile=False)
+
+    def run(self, n):
+        add = self._data.add_data_point
+        for i in xrange(n):
+            add(i, 0.5 * i, 1e-3 * i)
+
+    def teardown(self):
+        _remove_data(self._data)
+
+class DataWrite(Benchmark):
+    '''Add single data points to a Data object that writes to file.'''
+
+    name = 'data_write'
+    number = 20000
+    unit = 'point'
+
+    def setup(self):
+        self._dir = tempfile.mkdtemp()
+        self._data = _new_data('bench_write')
+        self._data.create_file(
+            filepath=os.path.join(self._dir, 'bench_write.dat'),
+            settings_file=False)
+
+    def run(self, n):
+        add = self._data.add_data_point
+        for i in xrange(n):
+            add(i, 0.5 * i, 1e-3 * i)
+
+    def teardown(self):
+        self._data.close_file()
+        _remove_data(self._data)
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+class DataLoad(Benchmark):
+    '''Load a .dat file of 100 blocks of 1000 points.'''
+
+    name = 'data_load'
+    number = 5
+    unit = 'file'
+
+    def setup(self):
+        self._dir = tempfile.mkdtemp()
+        self._filepath = os.path.join(self._dir, 'bench_load.dat')
+
+        d = _new_data('bench_load_src')
+        d.create_file(filepath=self._filepath, settings_file=False)
+        y = np.linspace(0, 1, 1000)
+        for x in range(100):
+            d.add_data_point(np.ones_like(y) * x, y, np.sin(x * y))
+            d.new_block()
+        d.close_file()
+        _remove_data(d)
+
+    def run(self, n):
+        for i in xrange(n):
+            d = qt.Data(self._filepath, name='bench_load')
+            _remove_data(d)
+
+    def teardown(self):
+        shutil.rmtree(self._dir, ignore_errors=True)
@@ -0,0 +1,58 @@
+# bench_fit.py, fitting throughput
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import numpy as np
+
+from lib.math import fit
+from base import Benchmark
+
+class GaussianFit(Benchmark):
+    '''Fit a Gaussian to 1000 noisy points.'''
+
+    name = 'fit_gaussian'
+    number = 50
+    unit = 'fit'
+
+    def setup(self):
+        rand = np.random.RandomState(0)
+        self._x = np.linspace(-10, 10, 1000)
+        self._p = [0.1, 5.0, 0.5, 2.0]
+        y = fit.Gaussian().func(self._p, self._x)
+        self._y = y + 0.1 * rand.randn(len(self._x))
+
+    def run(self, n):
+        p0 = [0, 4.0, 0, 1.5]
+        for i in xrange(n):
+            f = fit.Gaussian(self._x, self._y)
+            f.fit(p0)
+
+class FunctionFit(Benchmark):
+    '''Fit a user function (damped sine) to 1000 noisy points.'''
+
+    name = 'fit_function'
+    number = 50
+    unit = 'fit'
+
+    def setup(self):
+        rand = np.random.RandomState(0)
+        self._x = np.linspace(0, 10, 1000)
+        self._func = lambda p, x: p[0] * np.sin(p[1] * x) * np.exp(-x / p[2])
+        y = self._func([1.0, 3.0, 4.0], self._x)
+        self._y = y + 0.05 * rand.randn(len(self._x))
+
+    def run(self, n):
+        for i in xrange(n):
+            fit.fit(self._func, self._x, self._y, [0.8, 3.05, 3.0])
@@ -0,0 +1,112 @@
+# bench_instrument.py, overhead of Instrument get and set
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import qt
+from base import Benchmark
+
+_INSNAME = 'bench_dsgen'
+
+class _InstrumentBenchmark(Benchmark):
+
+    number = 100000
+
+    def setup(self):
+        self._ins = qt.instruments.create(_INSNAME, 'dummy_signal_generator')
+        if self._ins is None:
+            raise ValueError('Unable to create dummy_signal_generator')
+
+    def teardown(self):
+        qt.instruments.remove(_INSNAME)
+
+class DriverGet(_InstrumentBenchmark):
+    '''Direct call of the driver function, as a reference.'''
+
+    name = 'instrument_driver_get'
+
+    def run(self, n):
+        func = self._ins._ins.do_get_wave
+        for i in xrange(n):
+            func()
+
+class InstrumentGetFast(_InstrumentBenchmark):
+
+    name = 'instrument_get_fast'
+
+    def run(self, n):
+        func = self._ins.get_wave
+        for i in xrange(n):
+            func(fast=True)
+
+class InstrumentGet(_InstrumentBenchmark):
+
+    name = 'instrument_get'
+
+    def run(self, n):
+        func = self._ins.get_wave
+        for i in xrange(n):
+            func()
+
+class InstrumentSet(_InstrumentBenchmark):
+
+    name = 'instrument_set'
+
+    def run(self, n):
+        func = self._ins.set_amplitude
+        for i in xrange(n):
+            func(i % 100)
+
+class InstrumentSetOption(_InstrumentBenchmark):
+    '''Set of a parameter with an option list.'''
+
+    name = 'instrument_set_option'
+
+    def run(self, n):
+        func = self._ins.set_wave_type
+        for i in xrange(n):
+            func('SIN')
+
+class InstrumentGetGeneric(InstrumentGet):
+    '''get without the compiled accessors, as a reference.'''
+
+    name = 'instrument_get_generic'
+
+    def setup(self):
+        InstrumentGet.setup(self)
+        self._ins._ins._getters = {}
+
+class InstrumentSetGeneric(InstrumentSet):
+    '''set without the compiled accessors, as a reference.'''
+
+    name = 'instrument_set_generic'
+
+    def setup(self):
+        InstrumentSet.setup(self)
+        self._ins._ins._setters = {}
+
+class InstrumentTypeArguments(Benchmark):
+    '''Constructor arguments of all drivers, from the argspec index.'''
+
+    name = 'instrument_type_arguments'
+    number = 10
+    unit = 'listing'
+
+    def setup(self):
+        self._types = qt.instruments.get_types()
+
+    def run(self, n):
+        for i in xrange(n):
+            for typename in self._types:
+                qt.instruments.get_type_arguments(typename)
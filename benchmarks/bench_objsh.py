@@ -0,0 +1,104 @@
+# bench_objsh.py, object sharer call round trip and signal fan-out
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import sys
+import socket
+import subprocess
+import gobject
+
+from lib.network import object_sharer as objsh
+from lib.network import share_gtk
+from base import Benchmark
+
+def _free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('localhost', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+class _ServerBenchmark(Benchmark):
+    '''Starts a separate object sharer server process and connects to it.'''
+
+    def setup(self):
+        port = _free_port()
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                'objsh_server.py')
+        self._proc = subprocess.Popen([sys.executable, script, str(port)])
+        self._client = share_gtk.start_client('localhost', port=port,
+                nretry=10)
+        if not self._client:
+            self._proc.kill()
+            raise ValueError('Unable to connect to object sharer server')
+
+    def teardown(self):
+        conn = self._client.get_connection()
+        objsh.helper.remove_client(self._client)
+        conn.close()
+        self._proc.kill()
+        self._proc.wait()
+
+class CallRoundTrip(_ServerBenchmark):
+    '''Blocking call of a function of a remote object.'''
+
+    name = 'objsh_call'
+    number = 2000
+
+    def run(self, n):
+        func = self._client.hello_world
+        for i in xrange(n):
+            func(i)
+
+class _SignalObject(objsh.SharedGObject):
+
+    __gsignals__ = {
+        'bench-signal': (gobject.SIGNAL_RUN_FIRST, gobject.TYPE_NONE,
+                (gobject.TYPE_PYOBJECT,)),
+    }
+
+    def __init__(self):
+        objsh.SharedGObject.__init__(self, 'bench_signal', replace=True)
+
+class SignalFanOut(_ServerBenchmark):
+    '''
+    Emit a signal with a small dictionary to 100 local callbacks and one
+    connected client.
+    '''
+
+    name = 'objsh_signal'
+    number = 2000
+    unit = 'emit'
+
+    def setup(self):
+        _ServerBenchmark.setup(self)
+        self._obj = _SignalObject()
+        self._ncalls = 0
+        for i in range(100):
+            self._obj.connect('bench-signal', self._callback)
+
+    def _callback(self, sender, changes):
+        self._ncalls += 1
+
+    def run(self, n):
+        emit = self._obj.emit
+        changes = {'wave': 0.5, 'amplitude': 1.0}
+        for i in xrange(n):
+            emit('bench-signal', changes)
+
+    def teardown(self):
+        objsh.helper.remove_object('bench_signal')
+        _ServerBenchmark.teardown(self)
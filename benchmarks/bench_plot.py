@@ -0,0 +1,85 @@
+# bench_plot.py, gnuplot replot
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import numpy as np
+
+import qt
+from base import Benchmark
+
+class Replot(Benchmark):
+    '''
+    Replot of a 2D plot of 10000 points. The plot is sent to gnuplot's
+    dumb terminal with output discarded, so no display is needed.
+    '''
+
+    name = 'plot_replot'
+    number = 50
+    unit = 'replot'
+
+    def setup(self):
+        x = np.linspace(0, 10, 10000)
+        self._data = qt.Data(np.column_stack((x, np.sin(x))),
+                name='bench_replot')
+        self._plot = qt.plot(self._data, name='bench_replot')
+        self._plot.cmd('set terminal dumb')
+        self._plot.cmd("set output '%s'" % os.devnull.replace('\\', '/'))
+
+    def run(self, n):
+        for i in xrange(n):
+            self._plot.update()
+        # wait until gnuplot finished
+        self._plot._gnuplot.is_responding(timeout=60)
+
+    def teardown(self):
+        self._plot.quit()
+        qt.plots.remove('bench_replot')
+        qt.data.remove(self._data.get_name())
+
+class ReplotTraces(Benchmark):
+    '''
+    Update of a 2D plot with 10 traces of 1000 points, including setting
+    the labels, waiting until gnuplot has finished each update.
+    '''
+
+    name = 'plot_replot_10_traces'
+    number = 20
+    unit = 'update'
+
+    def setup(self):
+        x = np.linspace(0, 10, 1000)
+        self._data = []
+        for i in range(10):
+            self._data.append(qt.Data(np.column_stack((x, np.sin(x + i))),
+                name='bench_traces%d' % i))
+        self._plot = qt.Plot2D(name='bench_traces')
+        for d in self._data:
+            self._plot.add(d, update=False)
+        self._plot.cmd('set terminal dumb')
+        self._plot.cmd("set output '%s'" % os.devnull.replace('\\', '/'))
+
+    def run(self, n):
+        for i in xrange(n):
+            self._plot.set_xlabel('x %d' % i, update=False)
+            self._plot.set_ylabel('y %d' % i, update=False)
+            self._plot.update()
+            self._plot._gnuplot.is_responding(timeout=60)
+
+    def teardown(self):
+        self._plot.quit()
+        qt.plots.remove('bench_traces')
+        for d in self._data:
+            qt.data.remove(d.get_name())
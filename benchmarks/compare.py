@@ -0,0 +1,90 @@
+# compare.py, compare two benchmark result files
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+Usage: python compare.py [-t <threshold>] <old.json> <new.json>
+
+Prints the change in time per operation for every benchmark in both files
+and exits with status 1 if any benchmark became slower by more than
+<threshold> percent (default 10).
+'''
+
+import sys
+import optparse
+
+# for backward compatibility to python 2.5
+try:
+    import json
+except:
+    import simplejson as json
+
+def load(filename):
+    f = open(filename)
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+def compare(old, new, threshold=10.0):
+    '''
+    Compare result dictionaries <old> and <new>.
+
+    Returns a list of (name, old per_op, new per_op, change in percent,
+    regression) tuples for benchmarks that succeeded in both.
+    '''
+
+    oldres = dict((b['name'], b) for b in old['benchmarks'] if 'per_op' in b)
+    ret = []
+    for b in new['benchmarks']:
+        if 'per_op' not in b or b['name'] not in oldres:
+            continue
+        t0 = oldres[b['name']]['per_op']
+        t1 = b['per_op']
+        change = 100.0 * (t1 - t0) / t0
+        ret.append((b['name'], t0, t1, change, change > threshold))
+    return ret
+
+def _describe(env):
+    commit = env.get('git_commit') or 'unknown'
+    if env.get('git_dirty'):
+        commit += ' (modified)'
+    return '%s, %s, %s' % (commit[:12], env.get('hostname'), env.get('time'))
+
+def main(args):
+    parser = optparse.OptionParser(usage=__doc__.strip().split('\n')[0][7:])
+    parser.add_option('-t', '--threshold', type=float, default=10.0,
+        help='Regression threshold in percent')
+    opts, args = parser.parse_args(args)
+    if len(args) != 2:
+        parser.error('Expected two result files')
+
+    old, new = load(args[0]), load(args[1])
+    print 'old: %s' % _describe(old['environment'])
+    print 'new: %s' % _describe(new['environment'])
+    if old['environment'].get('hostname') != new['environment'].get('hostname'):
+        print 'Warning: results are from different machines'
+
+    nregress = 0
+    for name, t0, t1, change, regress in compare(old, new, opts.threshold):
+        print '%-24s %12.3f us %12.3f us %+7.1f%%%s' % (name, t0 * 1e6,
+            t1 * 1e6, change, regress and '  REGRESSION' or '')
+        if regress:
+            nregress += 1
+
+    return nregress > 0 and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,33 @@
+# objsh_server.py, object sharer server process for bench_objsh
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import sys
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'source'))
+
+import gobject
+from lib.network import object_sharer as objsh
+from lib.network import share_gtk
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.WARNING)
+    objsh.root.set_instance_name('bench_server')
+    if not share_gtk.start_server('localhost', port=int(sys.argv[1])):
+        sys.exit(1)
+    gobject.MainLoop().run()
@@ -0,0 +1,16 @@
+# Run all benchmarks, from a qtlab session started with --nogui:
+#
+#   execfile('benchmarks/run.py')
+#
+# Results are written to benchmarks/results/<date>_<commit>.json.
+
+import sys
+import os
+import qt
+
+_benchdir = os.path.join(qt.config['execdir'], 'benchmarks')
+if _benchdir not in sys.path:
+    sys.path.insert(0, _benchdir)
+
+import runner
+runner.run(output=runner.get_default_output())
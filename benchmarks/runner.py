@@ -0,0 +1,216 @@
+# runner.py, run benchmarks and store the results
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import sys
+import time
+import socket
+import logging
+import platform
+import subprocess
+
+# for backward compatibility to python 2.5
+try:
+    import json
+except:
+    import simplejson as json
+
+from lib.misc import exact_time
+from base import Benchmark
+
+MODULES = (
+    'bench_instrument',
+    'bench_data',
+    'bench_objsh',
+    'bench_plot',
+    'bench_fit',
+)
+
+def get_benchmarks(modules=MODULES):
+    '''Return a list of Benchmark classes defined in <modules>.'''
+
+    ret = []
+    for modname in modules:
+        try:
+            mod = __import__(modname, globals())
+        except Exception, e:
+            logging.warning('Unable to import %s: %s', modname, e)
+            continue
+
+        classes = [v for v in mod.__dict__.values() \
+                if type(v) is type(Benchmark) and issubclass(v, Benchmark) \
+                and v.name is not None]
+        classes.sort(key=lambda c: c.name)
+        ret.extend(classes)
+
+    return ret
+
+def _run_cmd(args):
+    try:
+        p = subprocess.Popen(args, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, cwd=_get_basedir())
+        out = p.communicate()[0]
+        if p.returncode != 0:
+            return None
+        return out.strip()
+    except Exception:
+        return None
+
+def _get_basedir():
+    return os.path.split(os.path.dirname(os.path.abspath(__file__)))[0]
+
+def _get_module_version(name):
+    try:
+        return __import__(name).__version__
+    except Exception:
+        return None
+
+def get_environment():
+    '''Return a dictionary describing the machine and software versions.'''
+
+    try:
+        f = open(os.path.join(_get_basedir(), 'VERSION'))
+        version = f.readline().strip()
+        f.close()
+    except IOError:
+        version = None
+
+    status = _run_cmd(['git', 'status', '--porcelain', '--untracked-files=no'])
+
+    try:
+        import multiprocessing
+        ncpus = multiprocessing.cpu_count()
+    except Exception:
+        ncpus = None
+
+    return {
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'qtlab_version': version,
+        'git_commit': _run_cmd(['git', 'rev-parse', 'HEAD']),
+        'git_dirty': status is not None and len(status) > 0,
+        'hostname': socket.gethostname(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'ncpus': ncpus,
+        'python': sys.version,
+        'numpy': _get_module_version('numpy'),
+        'scipy': _get_module_version('scipy'),
+        'gnuplot': _run_cmd(['gnuplot', '--version']),
+    }
+
+def run_benchmark(cls, repeat=5):
+    '''
+    Run a benchmark, returns a result dictionary.
+
+    The benchmark is run once with number / 10 operations to warm up, and
+    then <repeat> times with 'number' operations. 'per_op' is the minimum
+    time per operation, which is the least sensitive to other activity on
+    the machine.
+    '''
+
+    b = cls()
+    ret = {
+        'name': b.name,
+        'module': cls.__module__,
+        'doc': (cls.__doc__ or '').strip(),
+        'number': b.number,
+        'unit': b.unit,
+        'repeat': repeat,
+    }
+
+    try:
+        b.setup()
+    except Exception, e:
+        logging.warning('Setup of benchmark %s failed: %s', b.name, e)
+        ret['error'] = str(e)
+        return ret
+
+    times = []
+    try:
+        b.run(max(1, b.number / 10))
+        for i in range(repeat):
+            start = exact_time()
+            b.run(b.number)
+            times.append(exact_time() - start)
+    except Exception, e:
+        logging.warning('Benchmark %s failed: %s', b.name, e)
+        ret['error'] = str(e)
+    finally:
+        try:
+            b.teardown()
+        except Exception, e:
+            logging.warning('Teardown of benchmark %s failed: %s', b.name, e)
+
+    if len(times) > 0:
+        ret['times'] = times
+        ret['per_op'] = min(times) / b.number
+        ret['median_per_op'] = sorted(times)[len(times) / 2] / b.number
+        ret['ops_per_sec'] = b.number / min(times)
+
+    return ret
+
+def run(output=None, names=None, repeat=5, verbose=True):
+    '''
+    Run benchmarks and return the results.
+
+    Input:
+        output (string): JSON file to write results to
+        names (list of strings): benchmarks to run, default all
+        repeat (int): number of timed runs per benchmark
+        verbose (bool): print results while running
+    '''
+
+    results = {
+        'environment': get_environment(),
+        'benchmarks': [],
+    }
+
+    for cls in get_benchmarks():
+        if names is not None and cls.name not in names:
+            continue
+
+        res = run_benchmark(cls, repeat=repeat)
+        results['benchmarks'].append(res)
+        if not verbose:
+            continue
+        if 'per_op' in res:
+            print '%-24s %12.3f us/%s %12.1f %s/s' % (res['name'],
+                res['per_op'] * 1e6, res['unit'], res['ops_per_sec'],
+                res['unit'])
+        else:
+            print '%-24s failed: %s' % (res['name'], res.get('error'))
+
+    if output is not None:
+        f = open(output, 'w')
+        try:
+            json.dump(results, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+        if verbose:
+            print 'Results written to %s' % output
+
+    return results
+
+def get_default_output():
+    '''Return results/<date>_<commit>.json in the benchmarks directory.'''
+    commit = _run_cmd(['git', 'rev-parse', '--short', 'HEAD']) or 'unknown'
+    dirname = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+            'results')
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    return os.path.join(dirname, '%s_%s.json' % \
+            (time.strftime('%Y%m%d_%H%M%S'), commit))
@@ -173,9 +173,15 @@ class DataWindow(qtwindow.QTWindow):
         data = meta.get(self._meta_tag, '')
         if type(data) in (types.ListType, types.TupleType):
             text = '\n'.join(data)
+        elif type(data) in (types.StringType, types.UnicodeType):
+            text = data
         else:
             text = str(data)
 
+        # Headers are not necessarily UTF-8
+        if type(text) is types.StringType:
+            text = text.decode('utf-8', 'replace')
+
         buf = self._info_view.get_buffer()
         buf.set_text(text)
 
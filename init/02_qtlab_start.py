@@ -58,10 +58,10 @@ from qt import plot, plot3, Plot2D, Plot3D, Data
 
 from numpy import *
 import numpy as np
-try:
-    from scipy import constants as const
-except:
-    pass
+
+# Rarely used modules are imported on first use
+from lib.lazy import LazyModule
+const = LazyModule('scipy.constants')
 
 # Auto-start GUI
 if qt.config.get('startgui', True):
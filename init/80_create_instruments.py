@@ -13,3 +13,10 @@
 #    'scale': 0.5,
 #    'offset': 0
 #    }], format='%.04f')
+#
+#    Instruments can also be created in parallel; instruments on the same
+#    bus (e.g. GPIB) are still initialized one after the other:
+#    example1, dsgen, pos = qt.instruments.create_many([
+#        ('example1', 'example', {'address': 'GPIB::1', 'reset': True}),
+#        ('dsgen', 'dummy_signal_generator', {}),
+#        ('pos', 'dummy_positioner', {})])
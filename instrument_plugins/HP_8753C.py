@@ -20,11 +20,11 @@ from instrument import Instrument
 import visa
 import types
 import logging
-from time import sleep
-import struct
+from time import sleep, time
 import numpy
 
 import qt
+from lib import visafunc
 
 class HP_8753C(Instrument):
     '''
@@ -59,10 +59,6 @@ class HP_8753C(Instrument):
         self._visainstrument = visa.instrument(self._address)
 
         self._visainstrument.timeout = 30
-        # BEWARE! in case of low IFWB, it might be
-        # necessary to add additional delay
-        # ( ~ numpoints / IFBW ) yourself!
-        # see for example get_trace()
 
         self._visainstrument.send_end = False
         self._visainstrument.term_chars = ''
@@ -192,27 +188,71 @@ class HP_8753C(Instrument):
         '''
         Read the date from the instrument.
 
+        The trace is transferred in the binary FORM3 format (64 bit floats,
+        a real and imaginary value per point) and decoded in one go.
+
         Input:
             None
 
         Output:
-            data (int)  : list of data points
+            data (numpy.array)  : data points
+        '''
+        data = visafunc.ask_binary_block(self._visainstrument,
+                'FORM3;DISPDATA;OUTPFORM;', '>f8')
+        return data[::2]
+
+    def wait_sweep(self, timeout=None):
         '''
-        data = self._visainstrument.ask('FORM2;DISPDATA;OUTPFORM;')
-        d = [struct.unpack('>f', data[i:i+4])[0] for i in range(4, len(data),8)]
-        return d
+        Trigger a single sweep and wait until it is completed.
+
+        The instrument requests service when the sweep is done (OPC with
+        the event status bit enabled in the service request mask); the
+        status byte is polled while keeping the measurement loop alive.
+        Without serial poll support '*OPC?' style waiting ('OPC?;SING;')
+        is used instead.
+
+        Input:
+            timeout (float) : maximum time to wait, default twice the
+                              estimated sweep time plus 10 seconds.
+
+        Output:
+            True if the sweep completed, False on timeout
+        '''
+        if timeout is None:
+            numpoints = self.get_numpoints(query=False)
+            IF_Bandwidth = self.get_IF_Bandwidth(query=False)
+            timeout = 2.0 * numpoints / IF_Bandwidth + 10
+
+        vi = self._visainstrument
+        if not hasattr(type(vi), 'stb'):
+            oldtimeout = vi.timeout
+            vi.timeout = max(oldtimeout, timeout)
+            try:
+                return vi.ask('OPC?;SING;').strip() == '1'
+            finally:
+                vi.timeout = oldtimeout
+
+        vi.write('CLES;ESE1;SRE32;OPC;SING;')
+        start = time()
+        try:
+            while not (vi.stb & 32):
+                if time() - start > timeout:
+                    logging.warning('Timeout waiting for sweep to complete')
+                    return False
+                qt.msleep(0.01)
+        finally:
+            vi.write('CLES;')
+
+        return True
 
 ### Functions for doing measurements
 
     def get_trace(self):
         '''
         This function performs a full measurement.
-        First a trigger is sent to initiate a sweep.
-        An estimate is made of the time the sweep takes.
-        After the estimated time the data is queried from
-        the device. Usually the estimated time is a bit
-        lower then the actual time, the device will
-        respond as soon as it is finished.
+        First a trigger is sent to initiate a sweep, the data
+        is queried from the device as soon as the instrument
+        reports that the sweep is completed (see wait_sweep()).
         It is assumed that the instrument is already on
         'trigger hold'-mode.
 
@@ -231,19 +271,14 @@ class HP_8753C(Instrument):
         startfreq = self.get_start_freq(query=False)
         stopfreq = self.get_stop_freq(query=False)
         numpoints = self.get_numpoints(query=False)
-        IF_Bandwidth = self.get_IF_Bandwidth(query=False)
 
         freqs = numpy.linspace(startfreq,stopfreq,numpoints)
-        sweep_time = numpoints / IF_Bandwidth
 
         print 'sending trigger to network analyzer, and wait to finish'
-        print 'estimated waiting time: %.2f s' % sweep_time
-        self.send_trigger()
-        qt.msleep(sweep_time)
+        self.wait_sweep()
 
         print 'reading out network analyzer'
         reply = self.read()
-        reply = numpy.array(reply)
 
         qt.mend()
 
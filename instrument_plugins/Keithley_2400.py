@@ -32,8 +32,10 @@ import visa
 import types
 import logging
 import numpy
+import time
 
 import qt
+from lib import visafunc
 
 def bool_to_str(val):
     '''
@@ -87,6 +89,8 @@ class Keithley_2400(Instrument):
         #self._change_display = change_display
         #self._change_autozero = change_autozero
         #self._trigger_sent = False
+        self._buffer_npoints = 0
+        self._buffer_state = None
 
         # Add parameters to wrapper
         self.add_parameter('source_current_compliance',
@@ -246,6 +250,10 @@ class Keithley_2400(Instrument):
         self.add_function('send_init')
         self.add_function('fetch_last')
 
+        self.add_function('buffered_acquire')
+        self.add_function('fetch_buffer')
+        self.add_function('source_list_sweep')
+
         #self.add_function('send_trigger')
         #self.add_function('fetch')
 
@@ -454,6 +462,160 @@ class Keithley_2400(Instrument):
     #     else:
     #         logging.error('Triggering is on continous!')
 
+    def _check_output(self):
+        if not (self.get_output_on(query=False) or self.get_output_auto_off(query=False)):
+            raise Exception('Either source must be turned on manually or auto_off has to be enables before measuring.')
+
+    def _ask_volt_curr(self, cmd, n):
+        '''
+        Send cmd and read the n voltage and current readings it returns in
+        a single binary transfer. The reply is an indefinite length block,
+        so n determines its size.
+
+        Output:
+            (v, i) : tuple of numpy arrays
+        '''
+        try:
+            data = visafunc.ask_binary_block(self._visainstrument,
+                    ':FORM:ELEM VOLT,CURR;:FORM:BORD SWAP;:FORM:DATA SRE;' \
+                    + cmd, '<f4', count=2 * n)
+        finally:
+            self._visainstrument.write(':FORM:DATA ASC;' \
+                    ':FORM:ELEM VOLT,CURR,RES,TIME,STAT')
+        data = data.reshape((-1, 2))
+        return data[:,0], data[:,1]
+
+    def buffered_acquire(self, n, interval=None, wait=True, timeout=None):
+        '''
+        Acquire n readings into the internal buffer of the instrument with a
+        single trigger, instead of one bus transaction per reading.
+
+        Input:
+            n (int)          : number of readings (max 2500)
+            interval (float) : time between readings in seconds (using the
+                               arm layer timer), None to measure as fast
+                               as possible
+            wait (bool)      : if True, wait for the acquisition to finish
+                               and return the readings, otherwise use
+                               fetch_buffer() to get them later
+            timeout (float)  : maximum time to wait in seconds
+
+        Output:
+            (v, i) : tuple of voltage and current numpy arrays if wait is
+                     True, else None. Note that the values may not be valid
+                     if sense mode doesn't include them.
+        '''
+        if n < 1 or n > 2500:
+            raise ValueError('Buffer holds 1 to 2500 readings')
+        self._check_output()
+
+        logging.debug('Buffered acquisition of %d readings' % n)
+        self._visainstrument.write(':ABOR')
+        if self._buffer_state is None:
+            self._buffer_state = (self.get_arm_source(),
+                    self.get_arm_count(), self.get_trigger_count(),
+                    self._visainstrument.ask(':ARM:TIM?').strip())
+        if interval is None:
+            self.set_arm_source('IMM')
+            self.set_arm_count(1)
+            self.set_trigger_count(n)
+        else:
+            self.set_arm_source('TIM')
+            self._visainstrument.write(':ARM:TIM %s' % interval)
+            self.set_arm_count(n)
+            self.set_trigger_count(1)
+
+        self._visainstrument.write(':TRAC:CLE;:TRAC:POIN %d;' \
+                ':TRAC:FEED SENS;:TRAC:FEED:CONT NEXT' % n)
+        self._buffer_npoints = n
+        self._visainstrument.write(':INIT')
+
+        if not wait:
+            return None
+        return self.fetch_buffer(timeout=timeout)
+
+    def fetch_buffer(self, timeout=None):
+        '''
+        Wait for a buffered acquisition started with buffered_acquire() to
+        finish and transfer the whole buffer in a single binary block.
+
+        Input:
+            timeout (float) : maximum time to wait in seconds, after which
+                              the readings available so far are returned
+
+        Output:
+            (v, i) : tuple of voltage and current numpy arrays
+        '''
+        start = time.time()
+        while True:
+            navail = int(self._visainstrument.ask(':TRAC:POIN:ACT?'))
+            if navail >= self._buffer_npoints:
+                break
+            if timeout is not None and time.time() - start > timeout:
+                logging.warning('Timeout waiting for buffer, got %d of %d readings',
+                        navail, self._buffer_npoints)
+                self._visainstrument.write(':ABOR')
+                navail = int(self._visainstrument.ask(':TRAC:POIN:ACT?'))
+                break
+            qt.msleep(0.02)
+
+        logging.debug('Fetching buffer')
+        try:
+            return self._ask_volt_curr(':TRAC:DATA?',
+                    min(navail, self._buffer_npoints))
+        finally:
+            self._restore_trigger()
+
+    def _restore_trigger(self):
+        '''Restore the arm and trigger setup changed by buffered_acquire().'''
+        if self._buffer_state is None:
+            return
+        arm_source, arm_count, trigger_count, arm_timer = self._buffer_state
+        self._buffer_state = None
+
+        logging.debug('Restoring arm and trigger settings')
+        self._visainstrument.write(':ABOR;:ARM:TIM %s' % arm_timer)
+        self.set_arm_source(arm_source)
+        self.set_arm_count(arm_count)
+        self.set_trigger_count(trigger_count)
+
+    def source_list_sweep(self, voltages, delay=None):
+        '''
+        Sweep the source voltage through a list of values in hardware and
+        measure at every point, with a single trigger and a single binary
+        transfer of the results.
+
+        Input:
+            voltages (list) : source voltages (max 100 points)
+            delay (float)   : source delay in seconds per point, None to
+                              keep the current setting
+
+        Output:
+            (v, i) : tuple of voltage and current numpy arrays. Note that
+                     the current is only valid if it is in the sense mode.
+        '''
+        voltages = numpy.asarray(voltages, dtype=float)
+        if len(voltages) > 100:
+            raise ValueError('Source list holds at most 100 points')
+        self._check_output()
+
+        logging.debug('Source list sweep of %d points' % len(voltages))
+        self._visainstrument.write(':ABOR')
+        self.set_source_mode_volt()
+        if delay is not None:
+            self.set_source_delay(delay)
+        self._visainstrument.write(':SOUR:LIST:VOLT %s' % \
+                ','.join(['%.6e' % v for v in voltages]))
+        self._visainstrument.write(':SOUR:VOLT:MODE LIST')
+        self.set_arm_source('IMM')
+        self.set_arm_count(1)
+        self.set_trigger_count(len(voltages))
+
+        try:
+            return self._ask_volt_curr(':READ?', len(voltages))
+        finally:
+            self._visainstrument.write(':SOUR:VOLT:MODE FIX')
+
     def set_source_mode_volt(self):
         '''
         Set source_mode to voltage
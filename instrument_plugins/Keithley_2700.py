@@ -25,8 +25,10 @@ import visa
 import types
 import logging
 import numpy
+import time
 
 import qt
+from lib import visafunc
 
 def bool_to_str(val):
     '''
@@ -79,6 +81,8 @@ class Keithley_2700(Instrument):
         self._change_autozero = change_autozero
         self._averaging_types = ['MOV','REP']
         self._trigger_sent = False
+        self._buffer_npoints = 0
+        self._buffer_state = None
 
         # Add parameters to wrapper
         self.add_parameter('range',
@@ -165,6 +169,9 @@ class Keithley_2700(Instrument):
         self.add_function('send_trigger')
         self.add_function('fetch')
 
+        self.add_function('buffered_acquire')
+        self.add_function('fetch_buffer')
+
         # Connect to measurement flow to detect start and stop of measurement
         qt.flow.connect('measurement-start', self._measurement_start_cb)
         qt.flow.connect('measurement-end', self._measurement_end_cb)
@@ -310,6 +317,113 @@ class Keithley_2700(Instrument):
         else:
             logging.error('Triggering is on continous!')
 
+    def buffered_acquire(self, n, interval=None, wait=True, timeout=None):
+        '''
+        Acquire n readings into the internal buffer of the instrument with a
+        single trigger, instead of one bus transaction per reading.
+
+        Input:
+            n (int)          : number of readings (max 55000)
+            interval (float) : time between readings in seconds, None to
+                               measure as fast as possible
+            wait (bool)      : if True, wait for the acquisition to finish
+                               and return the readings, otherwise use
+                               fetch_buffer() to get them later
+            timeout (float)  : maximum time to wait in seconds
+
+        Output:
+            data (numpy array) : the readings if wait is True, else None
+        '''
+        if n < 1 or n > 55000:
+            raise ValueError('Buffer holds 1 to 55000 readings')
+
+        logging.debug('Buffered acquisition of %d readings' % n)
+        self.reset_trigger()
+        if self._buffer_state is None:
+            self._buffer_state = (self.get_trigger_continuous(),
+                    self.get_trigger_source(), self.get_trigger_timer(),
+                    self._get_func_par('TRIG', 'COUN'),
+                    self._visainstrument.ask(':SAMP:COUN?').strip())
+        self.set_trigger_continuous(False)
+
+        # The counts are written directly, set_trigger_count() turns
+        # values above 9999 into INF
+        if interval is None:
+            self.set_trigger_source('IMM')
+            ntrig, nsamp = 1, n
+        else:
+            self.set_trigger_source('TIM')
+            self.set_trigger_timer(interval)
+            ntrig, nsamp = n, 1
+
+        self._visainstrument.write(':TRIG:COUN %d;:SAMP:COUN %d;:TRAC:CLE;' \
+                ':TRAC:POIN %d;:TRAC:FEED SENS;:TRAC:FEED:CONT NEXT' % \
+                (ntrig, nsamp, n))
+        self._buffer_npoints = n
+        self._visainstrument.write(':INIT')
+
+        if not wait:
+            return None
+        return self.fetch_buffer(timeout=timeout)
+
+    def fetch_buffer(self, timeout=None):
+        '''
+        Wait for a buffered acquisition started with buffered_acquire() to
+        finish and transfer the whole buffer in a single binary block.
+
+        Input:
+            timeout (float) : maximum time to wait in seconds, after which
+                              the readings available so far are returned
+
+        Output:
+            data (numpy array) : the readings
+        '''
+        start = time.time()
+        while True:
+            navail = int(self._visainstrument.ask(':TRAC:POIN:ACT?'))
+            if navail >= self._buffer_npoints:
+                break
+            if timeout is not None and time.time() - start > timeout:
+                logging.warning('Timeout waiting for buffer, got %d of %d readings',
+                        navail, self._buffer_npoints)
+                self.reset_trigger()
+                navail = int(self._visainstrument.ask(':TRAC:POIN:ACT?'))
+                break
+            qt.msleep(0.02)
+
+        # The reply is an indefinite length block, its size follows from
+        # the number of readings
+        logging.debug('Fetching buffer')
+        try:
+            data = visafunc.ask_binary_block(self._visainstrument,
+                    ':FORM:ELEM READ;:FORM:BORD SWAP;:FORM:DATA SRE;' \
+                    ':TRAC:DATA?', '<f4',
+                    count=min(navail, self._buffer_npoints))
+        finally:
+            try:
+                self._visainstrument.write(':FORM:DATA ASC')
+            finally:
+                self._restore_trigger()
+        return data
+
+    def _restore_trigger(self):
+        '''Restore the trigger settings changed by buffered_acquire().'''
+        if self._buffer_state is None:
+            return
+        cont, source, timer, ntrig, nsamp = self._buffer_state
+        self._buffer_state = None
+
+        logging.debug('Restoring trigger settings')
+        self.reset_trigger()
+        if float(ntrig) > 55000:
+            ntrig = 'INF'
+        self._set_func_par_value('TRIG', 'COUN', ntrig)
+        self._visainstrument.write(':SAMP:COUN %s' % nsamp)
+        self.get_trigger_count()
+        self.set_trigger_timer(timer)
+        self.set_trigger_source(source)
+        self.set_trigger_continuous(cont)
+
     def set_mode_volt_ac(self):
         '''
         Set mode to AC Voltage
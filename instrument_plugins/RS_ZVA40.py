@@ -22,6 +22,7 @@ import logging
 import numpy
 
 import qt
+from lib import visafunc
 
 def bool_to_str(val):
     '''
@@ -180,11 +181,23 @@ class RS_ZVA40(Instrument):
     # read it out properly, so the reading is now done as if it is a
     # parameter, and the old functions are redirected.
 
+    def _ask_binary(self, cmd, real=32):
+        '''
+        Query trace data in binary (little endian REAL,32 or REAL,64)
+        format and return it as a numpy array. The ASCII data format and
+        the byte order are restored afterwards.
+        '''
+        border = self._visainstrument.ask('FORM:BORD?').strip()
+        try:
+            return visafunc.ask_binary_block(self._visainstrument,
+                    'FORM:BORD SWAP;:FORM:DATA REAL,%d;:%s' % (real, cmd),
+                    '<f%d' % (real / 8))
+        finally:
+            self._visainstrument.write('FORM:DATA ASC;:FORM:BORD %s' % \
+                    border)
+
     def read_frqs(self):
-        frqs = self._visainstrument.ask("CALC:DATA:STIM?")
-        frqs = frqs.strip("\'")
-        frqs = frqs.rsplit(",")
-        self._frqs = map(float, frqs)
+        self._frqs = self._ask_binary("CALC:DATA:STIM?", real=64)
         return self._frqs
     
     def read_header(self):
@@ -194,10 +207,7 @@ class RS_ZVA40(Instrument):
         return self._header
     
     def read_data(self):
-        raw = self._visainstrument.ask("CALC:DATA:ALL? SDAT")
-        raw = raw.strip("\'")
-        raw = raw.rsplit(",")  
-        return map(float, raw)
+        return self._ask_binary("CALC:DATA:ALL? SDAT")
 
     def send_trigger(self):
         '''
@@ -17,8 +17,26 @@
 
 from instrument import Instrument
 import visa
+from lib import visafunc
 import types
 import logging
+import numpy
+import time
+
+import qt
+
+# Output codes for the SNAP? query
+_SNAP_OUTPUTS = {
+    'X': 1,
+    'Y': 2,
+    'R': 3,
+    'P': 4,
+    'in1': 5,
+    'in2': 6,
+    'in3': 7,
+    'in4': 8,
+    'frequency': 9,
+}
 
 class SR830(Instrument):
     '''
@@ -46,6 +64,7 @@ class SR830(Instrument):
         Instrument.__init__(self, name, tags=['physical'])
         self._address = address
         self._visainstrument = visa.instrument(self._address)
+        self._direct_output = False
 
         self.add_parameter('mode',
            flags=Instrument.FLAG_SET,
@@ -133,6 +152,12 @@ class SR830(Instrument):
         self.add_function('reset')
         self.add_function('get_all')
         self.add_function('get_xyrp')
+        self.add_function('get_snap')
+        self.add_function('buffered_acquire')
+        self.add_function('start_buffer')
+        self.add_function('pause_buffer')
+        self.add_function('get_buffer_npoints')
+        self.add_function('fetch_buffer')
 
         if reset:
             self.reset()
@@ -197,11 +222,16 @@ class SR830(Instrument):
         '''
         self._visainstrument.write('OVRM 1')
 
-    def direct_output(self):
+    def direct_output(self, force=False):
         '''
         select GPIB as interface
+
+        This is only sent once per session, unless force is True.
         '''
+        if self._direct_output and not force:
+            return
         self._visainstrument.write('OUTX 1')
+        self._direct_output = True
 
     def read_output(self,output):
         '''
@@ -234,10 +264,162 @@ class SR830(Instrument):
         added by Fan Wu 06-06-2013 for the buggy LIA readout problem of 1 readout offset slow.
         Read out xyrp of the Lock In
         '''
-        readstr = self._visainstrument.ask('SNAP ? 1,2,3,4')
-        readstr = readstr.rsplit(',')
-        readlist = [float(readstr[0]), float(readstr[1]), float(readstr[2]), float(readstr[3])]
-        return readlist
+        return self.get_snap('X', 'Y', 'R', 'P')
+
+    def get_snap(self, *outputs):
+        '''
+        Read several outputs at the same instant with a single SNAP? query
+        and update the corresponding parameters.
+
+        Input:
+            outputs (strings) : 2 to 6 of X, Y, R, P, in1 - in4 and
+                                frequency, default X, Y, R, P
+
+        Output:
+            list of values, in the order requested
+        '''
+        if len(outputs) == 0:
+            outputs = ('X', 'Y', 'R', 'P')
+        for name in outputs:
+            if name not in _SNAP_OUTPUTS:
+                raise ValueError('Output %s cannot be read with SNAP?' % name)
+
+        self.direct_output()
+        if len(outputs) == 1:
+            ans = [self._visainstrument.ask('OUTP? %d' % _SNAP_OUTPUTS[outputs[0]])]
+        elif len(outputs) <= 6:
+            cmd = 'SNAP? %s' % ','.join(['%d' % _SNAP_OUTPUTS[name] \
+                    for name in outputs])
+            ans = self._visainstrument.ask(cmd).split(',')
+        else:
+            raise ValueError('SNAP? accepts at most 6 outputs')
+
+        vals = [float(v) for v in ans]
+        logging.debug(__name__ + ' : snapshot %r = %r' % (outputs, vals))
+        for name, val in zip(outputs, vals):
+            self.update_value(name, val)
+        return vals
+
+    def buffered_acquire(self, npoints, rate=512, ch1='X', ch2='Y',
+            data=None, blocksize=256):
+        '''
+        Fill the internal data buffer of the lock-in at a fixed sample rate
+        and transfer it in binary form, instead of reading every point over
+        the bus.
+
+        Input:
+            npoints (int)   : number of points (max 16383)
+            rate (float)    : sample rate in Hz, 62.5 mHz * 2**n up to 512 Hz
+            ch1 (string)    : quantity stored in buffer 1, X or R
+            ch2 (string)    : quantity stored in buffer 2, Y or P
+            data (Data)     : if given, (time, ch1, ch2) blocks are added to
+                              it while the acquisition is running
+            blocksize (int) : minimum number of points per transfer to data
+
+        Output:
+            (ch1, ch2) : tuple of float32 numpy arrays
+        '''
+        if npoints > 16383:
+            raise ValueError('Buffer holds at most 16383 points')
+
+        self.start_buffer(rate=rate, ch1=ch1, ch2=ch2)
+        nread = 0
+        nfetched = 0
+        parts = []
+        while nread < npoints:
+            qt.msleep(min(0.1, blocksize / float(rate)))
+            navail = min(self.get_buffer_npoints(), npoints)
+            if data is None:
+                nread = navail
+            elif navail - nread >= min(blocksize, npoints - nread):
+                v1, v2 = self.fetch_buffer(navail - nread, start=nread)
+                parts.append((v1, v2))
+                t = numpy.arange(nread, navail) / float(rate)
+                data.add_data_point(t, v1, v2)
+                nread = navail
+                nfetched = navail
+        self.pause_buffer()
+
+        # Only transfer the points that were not streamed to data
+        if nfetched < npoints:
+            parts.append(self.fetch_buffer(npoints - nfetched,
+                start=nfetched))
+        return tuple([numpy.concatenate([p[i] for p in parts]) \
+                for i in (0, 1)])
+
+    def start_buffer(self, rate=512, ch1='X', ch2='Y', loop=False):
+        '''
+        Reset the data buffer and start filling it.
+
+        Input:
+            rate (float) : sample rate in Hz, 62.5 mHz * 2**n up to 512 Hz,
+                           or None to sample on the external trigger
+            ch1 (string) : quantity stored in buffer 1, X or R
+            ch2 (string) : quantity stored in buffer 2, Y or P
+            loop (bool)  : keep sampling when the buffer is full,
+                           overwriting the oldest points
+
+        Output:
+            None
+        '''
+        if rate is None:
+            srat = 14
+        else:
+            srat = int(round(numpy.log2(rate / 0.0625)))
+            if srat < 0 or srat > 13 or abs(0.0625 * 2**srat - rate) > 1e-6:
+                raise ValueError('Invalid sample rate %s' % rate)
+        if ch1 not in ('X', 'R') or ch2 not in ('Y', 'P'):
+            raise ValueError('Buffers can only store X or R and Y or P')
+
+        logging.debug(__name__ + ' : starting buffer at rate %s' % rate)
+        self.direct_output()
+        self._visainstrument.write('DDEF 1,%d,0;DDEF 2,%d,0' % \
+                (ch1 == 'R', ch2 == 'P'))
+        self._visainstrument.write('SRAT %d;SEND %d;REST' % (srat, loop))
+        self._visainstrument.write('STRT')
+
+    def pause_buffer(self):
+        '''
+        Stop filling the data buffer.
+        '''
+        self._visainstrument.write('PAUS')
+
+    def get_buffer_npoints(self):
+        '''
+        Return the number of points stored in the data buffer.
+        '''
+        return int(self._visainstrument.ask('SPTS?'))
+
+    def fetch_buffer(self, npoints=None, start=0):
+        '''
+        Transfer points from both data buffers as binary float32 (TRCB?).
+
+        Input:
+            npoints (int) : number of points, default all stored points
+            start (int)   : index of the first point
+
+        Output:
+            (ch1, ch2) : tuple of float32 numpy arrays
+        '''
+        if npoints is None:
+            npoints = self.get_buffer_npoints() - start
+        if npoints <= 0:
+            return numpy.zeros(0, dtype=numpy.float32), \
+                    numpy.zeros(0, dtype=numpy.float32)
+
+        ret = []
+        for ch in (1, 2):
+            self._visainstrument.write('TRCB? %d,%d,%d' % (ch, start, npoints))
+            ret.append(self._read_floats(npoints))
+        return tuple(ret)
+
+    def _read_floats(self, npoints):
+        '''
+        Read a TRCB? reply: npoints little-endian IEEE floats without header.
+        The reply is read by its length, as it can contain 0x0A bytes.
+        '''
+        raw = visafunc.read_bytes(self._visainstrument, 4 * npoints)
+        return numpy.frombuffer(raw, dtype='<f4')
 
     def do_get_X(self):
         '''
@@ -251,6 +251,8 @@ class Data(SharedGObject):
         self._temp_binary = kwargs.get('binary', True)
         self._options = kwargs
         self._file = None
+        self._index_file = None
+        self._block_start = 0
         self._stop_req_hid = None
 
         # Dimension info
@@ -260,6 +262,13 @@ class Data(SharedGObject):
         self._loopshape = None
         self._complete = False
         self._reshaped_data = None
+        self._grid = None
+        self._grid_npoints = -1
+        self._coord_index = {}
+        self._loops_final = False
+
+        # NaN-padded acquisition buffer, self._data is a view of this
+        self._buf = None
 
         # Number of coordinate dimensions
         self._ncoordinates = 0
@@ -431,7 +440,8 @@ class Data(SharedGObject):
 
         Normally the data is just a 2D array, with a set of values on each
         'line'. However, if reshape is True, the data will be reshaped into
-        the detected dimension sizes.
+        the detected dimension sizes. Points that have not been acquired yet
+        are NaN, so this also works for a partially measured data set.
         '''
 
         if not self._inmem and self._infile:
@@ -498,6 +508,10 @@ class Data(SharedGObject):
         fn, ext = os.path.splitext(self.get_filepath())
         return fn + '.set'
 
+    def get_index_filepath(self):
+        fn, ext = os.path.splitext(self.get_filepath())
+        return fn + '.idx'
+
     def is_file_open(self):
         '''Return whether a file is open or not.'''
 
@@ -530,6 +544,7 @@ class Data(SharedGObject):
             kwargs['size'] = 0
         self._ncoordinates += 1
         self._dimensions.append(kwargs)
+        self._grid = None
 
     def add_value(self, name, **kwargs):
         '''
@@ -550,6 +565,7 @@ class Data(SharedGObject):
         kwargs['type'] = 'value'
         self._nvalues += 1
         self._dimensions.append(kwargs)
+        self._grid = None
 
     def add_comment(self, comment):
         '''Add comment to the Data object.'''
@@ -590,6 +606,7 @@ class Data(SharedGObject):
             return False
 
         self._write_header()
+        self._create_index_file()
 
         if settings_file and in_qtlab:
             self._write_settings_file()
@@ -622,9 +639,15 @@ class Data(SharedGObject):
         '''
 
         if self._file is not None:
+            if self._npoints_last_block > 0:
+                self._add_block_index()
             self._file.close()
             self._file = None
 
+        if self._index_file is not None:
+            self._index_file.close()
+            self._index_file = None
+
         if self._stop_req_hid is not None and in_qtlab:
             qt.flow.disconnect(self._stop_req_hid)
             self._stop_req_hid = None
@@ -659,6 +682,28 @@ class Data(SharedGObject):
 
         self._file.write('\n')
 
+    def _create_index_file(self):
+        '''
+        Create the block index sidecar file, which contains a line with the
+        byte offset and number of points for each block in the data file.
+        '''
+
+        try:
+            self._index_file = open(self.get_index_filepath(), 'w')
+        except:
+            logging.warning('Unable to create index file')
+            self._index_file = None
+        self._block_start = self._file.tell()
+
+    def _add_block_index(self):
+        '''Add the block that was just finished to the index file.'''
+
+        if self._index_file is not None and self._npoints_last_block > 0:
+            self._index_file.write('%d\t%d\n' % \
+                    (self._block_start, self._npoints_last_block))
+            self._index_file.flush()
+        self._block_start = self._file.tell()
+
     def _format_data_value(self, val, colnum):
         if type(val) in self._INT_TYPES:
             return '%d' % val
@@ -750,6 +795,7 @@ class Data(SharedGObject):
 
         self._write_data()
         self.close_file()
+        self.rebuild_index()
 
     def create_tempfile(self, path=None):
         '''
@@ -894,10 +940,7 @@ class Data(SharedGObject):
         #   - a 1d tuple of numbers, for adding a single data point
         #   - a 2d tuple/list/array, for adding >1 data points
         if self._inmem:
-            if len(self._data) == 0:
-                self._data = numpy.atleast_2d(args)
-            else:
-                self._data = numpy.append(self._data, [args], axis=0)
+            self._append_rows(numpy.reshape(args, (npoints, ncols)))
 
         if self._infile:
             if npoints == 1:
@@ -916,11 +959,66 @@ class Data(SharedGObject):
         else:
             self.emit('new-data-point')
 
+    def _get_planned_npoints(self):
+        '''
+        Return the total number of points according to the sizes specified
+        for the coordinate dimensions, or 0 if not all are known.
+        '''
+
+        npoints = 1
+        for i in range(self.get_ncoordinates()):
+            size = self.get_dimension_size(i)
+            if size <= 0:
+                return 0
+            npoints *= size
+        return npoints
+
+    def _resize_buffer(self, capacity, ncols, dtype):
+        '''
+        Move the in-memory data into a NaN-padded buffer for <capacity>
+        points.
+        '''
+
+        buf = numpy.empty((capacity, ncols), dtype=dtype)
+        buf.fill(numpy.nan)
+        n = len(self._data)
+        if n > 0:
+            buf[:n] = self._data
+        self._buf = buf
+        self._data = buf[:n]
+        self._grid = None
+
+    def _append_rows(self, rows):
+        '''
+        Append a 2D array of points to the in-memory data.
+
+        Points are stored in a preallocated buffer (sized according to the
+        coordinate dimensions if known, growing geometrically otherwise),
+        so that both self._data and the reshaped data are views that do
+        not have to be rebuilt for every point.
+        '''
+
+        dtype = numpy.promote_types(rows.dtype, numpy.float64)
+        n = len(self._data)
+        nrows, ncols = rows.shape
+
+        buf = self._buf
+        if buf is None or buf.shape[1] != ncols or buf.dtype != dtype \
+                or n + nrows > len(buf):
+            capacity = max(n + nrows, self._get_planned_npoints())
+            if buf is not None:
+                capacity = max(capacity, 2 * len(buf))
+            self._resize_buffer(capacity, ncols, dtype)
+
+        self._buf[n:n+nrows] = rows
+        self._data = self._buf[:n+nrows]
+
     def new_block(self):
         '''Start a new data block.'''
 
         if self._infile:
             self._file.write('\n')
+            self._add_block_index()
 
         self._block_sizes.append(self._npoints_last_block)
         self._npoints_last_block = 0
@@ -958,6 +1056,8 @@ class Data(SharedGObject):
         if not isinstance(data, numpy.ndarray):
             data = numpy.array(data)
         self._data = data
+        self._buf = None
+        self._grid = None
         self._inmem = True
         self._infile = False
         self._npoints = len(self._data)
@@ -1004,6 +1104,8 @@ class Data(SharedGObject):
         If the data is associated with a temporary file, it will be updated.
         '''
         self._data = data
+        self._buf = None
+        self._grid = None
         if self._tempfile:
             self.rewrite_tempfile()
 
@@ -1074,6 +1176,8 @@ class Data(SharedGObject):
         self._count_coord_val_dims()
 
         self._data = numpy.array(data)
+        self._buf = None
+        self._grid = None
         self._npoints = len(self._data)
         self._inmem = True
 
@@ -1129,22 +1233,63 @@ class Data(SharedGObject):
         if m is not None:
             self._comment.append(m.group(1))
 
+    def _get_loop_grid(self):
+        '''
+        Return the data as an array with one axis per loop level, outermost
+        loop first, followed by the column axis, or None if no loops were
+        detected. Loops that have not been completed yet are padded with
+        NaN. While acquiring, the result is a view of the acquisition buffer
+        that is only rebuilt when the detected loop structure can still
+        change.
+        '''
+
+        if self._grid is not None and \
+                (self._loops_final or self._grid_npoints == self._npoints):
+            return self._grid
+
+        data = self._data
+        if len(data) == 0 or len(numpy.shape(data)) != 2:
+            return None
+
+        loopdims, newshape, final = self._detect_loops(data)
+        if len(loopdims) == 0:
+            return None
+
+        self._loopdims = loopdims
+        self._loopshape = newshape
+        self._loops_final = final
+
+        total = int(numpy.prod(newshape))
+        self._complete = len(data) == total
+        if total > len(data):
+            if self._buf is None or total > len(self._buf):
+                self._resize_buffer(total, data.shape[1],
+                    numpy.promote_types(data.dtype, numpy.float64))
+            data = self._buf[:total]
+        elif total < len(data):
+            data = data[:total]
+
+        newshape = list(reversed(newshape))
+        newshape.append(-1)
+        self._grid = data.reshape(newshape)
+        self._grid_npoints = self._npoints
+        self._coord_index = {}
+        self._reshaped_data = None
+        return self._grid
+
     def _reshape_data(self):
         '''
         Return a reshaped version of the data. This is not guaranteed to be
         a view to the same data object.
         '''
 
+        data = self._get_loop_grid()
+        if data is None:
+            return None
         if self._reshaped_data is not None:
             return self._reshaped_data
 
-        loopdims = copy.copy(self._loopdims)
-        newshape = copy.copy(self._loopshape)
-        if not self._complete or None in (loopdims, newshape):
-            return None
-
-        data = self._data
-
+        loopdims = self._loopdims
         cshape_ok, fshape_ok = True, True
         for i in range(len(loopdims)):
             if loopdims[i] != i:
@@ -1154,62 +1299,89 @@ class Data(SharedGObject):
 
         if not cshape_ok and not fshape_ok:
             logging.warning('Unable to do simple data reshape')
-        else:
-            newshape.reverse()
-            newshape.append(-1)
-            data = data.reshape(newshape)
-
+            data = self._data
+        elif fshape_ok:
             # Swap axes if necessary
-            if fshape_ok:
-                for i in range(self.get_ncoordinates() - 1):
-                    data = data.swapaxes(i, i + 1)
+            for i in range(len(loopdims) - 1):
+                data = data.swapaxes(i, i + 1)
 
         self._reshaped_data = data
         return self._reshaped_data
 
-    def _detect_dimensions_size(self):
-        data = self._data
+    def _detect_loops(self, data):
+        '''
+        Detect the loop order and loop sizes of the coordinate dimensions.
+
+        For each loop level the first coordinate that changes is found with
+        a single vectorized comparison, its size from the first repetition
+        of its start value. A loop that has not wrapped yet takes the size
+        specified for the dimension if that is larger than what was seen.
+
+        Returns (loopdims, loopshape, final); final is True when further
+        data can not change the result.
+        '''
+
         ncoords = self.get_ncoordinates()
-        if len(data) < 2:
-            for colnum in range(ncoords):
-                self._dimensions[colnum]['size'] = len(data)
-            return
+        npoints = len(data)
+        coords = data[:, :ncoords]
 
         loopdims = []
         newshape = []
+        final = True
         mulsize = 1
-        firstloopdim = None
-        for iter in range(ncoords):
-            loopdim = None
-            for colnum in range(ncoords):
-                if mulsize >= len(data):
-                    continue
-
-                if data[0, colnum] != data[mulsize, colnum]:
-                    loopdim = colnum
-                    loopdims.append(loopdim)
-                    loopstart = data[0, loopdim]
-                    break
-
-            if loopdim is None:
+        while len(loopdims) < ncoords and mulsize < npoints:
+            changed = numpy.flatnonzero(coords[0] != coords[mulsize])
+            changed = [c for c in changed if c not in loopdims]
+            if len(changed) == 0:
                 break
 
-            if firstloopdim is None:
-                firstloopdim = loopdim
+            loopdim = int(changed[0])
+            col = coords[::mulsize, loopdim]
+            wraps = numpy.flatnonzero(col[1:] == col[0])
+            if len(wraps) > 0:
+                size = int(wraps[0]) + 1
+            else:
+                size = max(len(col), self.get_dimension_size(loopdim))
+                if size == len(col):
+                    final = False
+
+            loopdims.append(loopdim)
+            newshape.append(size)
+            mulsize *= size
+
+        # Dimensions not revealed by the data yet, but with a known size.
+        todo = [i for i in range(ncoords) if i not in loopdims and \
+                self.get_dimension_size(i) > 1]
+        if len(loopdims) > 0 and loopdims[0] == ncoords - 1:
+            todo.reverse()
+        if len(todo) > 1:
+            final = False
+        for i in todo:
+            loopdims.append(i)
+            newshape.append(self.get_dimension_size(i))
+
+        return loopdims, newshape, final
 
-            i = 1
-            while i * mulsize < len(data):
-                if data[i * mulsize, loopdim] == loopstart:
-                    break
-                i += 1
+    def _detect_dimensions_size(self):
+        data = self._data
+        ncoords = self.get_ncoordinates()
+        if len(data) < 2:
+            for colnum in range(ncoords):
+                self._dimensions[colnum]['size'] = len(data)
+            return
 
-            opt = self._dimensions[loopdim]
-            opt['start'] = loopstart
-            opt['size'] = i
-            opt['end'] = data[mulsize * (i - 1), loopdim]
-            newshape.append(i)
+        loopdims, newshape, final = self._detect_loops(data)
+        if len(loopdims) == 0:
+            return False
 
-            mulsize *= i
+        mulsize = 1
+        for loopdim, size in zip(loopdims, newshape):
+            opt = self._dimensions[loopdim]
+            opt['start'] = data[0, loopdim]
+            opt['size'] = size
+            last = min(size - 1, (len(data) - 1) / mulsize)
+            opt['end'] = data[mulsize * last, loopdim]
+            mulsize *= size
 
         complete = len(self._data) == mulsize
         self._loopdims = loopdims
@@ -1217,7 +1389,7 @@ class Data(SharedGObject):
         self._complete = complete
 
         # Determine number of blocks
-        bs = self._dimensions[firstloopdim]['size']
+        bs = newshape[0]
         if bs > 0:
             if len(data) % bs == 0:
                 self._block_sizes = [bs] * (len(data) / bs)
@@ -1255,6 +1427,283 @@ class Data(SharedGObject):
             else:
                 self._inmem = False
 
+### Block index
+
+    def _scan_blocks(self, f, offset=0):
+        '''
+        Scan the data file f starting at byte offset, which should be the
+        start of a block, and return a list of (offset, npoints) tuples.
+        '''
+
+        blocks = []
+        start = None
+        npoints = 0
+        f.seek(offset)
+        pos = offset
+        while True:
+            line = f.readline()
+            if line == '':
+                break
+
+            data = line.split('#', 1)[0].strip()
+            if len(data) > 0:
+                if start is None:
+                    start = pos
+                npoints += 1
+            elif len(line.strip()) == 0 and npoints > 0:
+                blocks.append((start, npoints))
+                start = None
+                npoints = 0
+
+            pos += len(line)
+
+        if npoints > 0:
+            blocks.append((start, npoints))
+
+        return blocks
+
+    def rebuild_index(self):
+        '''
+        Rebuild the block index sidecar file in a single pass over the data
+        file, e.g. for files written by older versions.
+        '''
+
+        f = open(self.get_filepath(), 'rb')
+        try:
+            blocks = self._scan_blocks(f)
+        finally:
+            f.close()
+
+        idx = open(self.get_index_filepath(), 'w')
+        for offset, npoints in blocks:
+            idx.write('%d\t%d\n' % (offset, npoints))
+        idx.close()
+
+        return blocks
+
+    def get_block_index(self):
+        '''
+        Return a list of (offset, npoints) tuples, one for each block in the
+        data file, including the block that is currently being written.
+
+        The index sidecar file is used if available, only the data after
+        the last indexed block is scanned. Without a sidecar it is rebuilt.
+        '''
+
+        fn = self.get_index_filepath()
+        if not os.path.exists(fn):
+            return self.rebuild_index()
+
+        blocks = []
+        f = open(fn, 'r')
+        for line in f:
+            fields = line.split()
+            if len(fields) == 2:
+                blocks.append((int(fields[0]), int(fields[1])))
+        f.close()
+
+        f = open(self.get_filepath(), 'rb')
+        try:
+            if len(blocks) > 0:
+                blocks = blocks[:-1] + self._scan_blocks(f, blocks[-1][0])
+            else:
+                blocks = self._scan_blocks(f)
+        finally:
+            f.close()
+
+        return blocks
+
+    def read_blocks(self, start=0, stop=None):
+        '''
+        Read blocks start up to (not including) stop from the data file by
+        seeking to their offsets, and return them as a 2D numpy.array.
+        Negative numbers count from the end, as in a Python slice.
+        '''
+
+        blocks = self.get_block_index()[start:stop]
+
+        data = []
+        f = open(self.get_filepath(), 'rb')
+        try:
+            for offset, npoints in blocks:
+                f.seek(offset)
+                n = 0
+                while n < npoints:
+                    line = f.readline()
+                    if line == '':
+                        break
+                    fields = line.split('#', 1)[0].split()
+                    if len(fields) > 0:
+                        data.append([float(x) for x in fields])
+                        n += 1
+        finally:
+            f.close()
+
+        return numpy.array(data)
+
+    def read_last_blocks(self, n):
+        '''Read the last n blocks from the data file.'''
+        if n <= 0:
+            return numpy.array([])
+        return self.read_blocks(-n)
+
+### Slicing
+
+    def _get_dim_index(self, dim):
+        '''Return the column number of dimension dim (number or name).'''
+
+        if type(dim) in self._INT_TYPES:
+            if dim < 0 or dim >= self.get_ndimensions():
+                raise ValueError('Dimension %d does not exist' % dim)
+            return int(dim)
+
+        for i, info in enumerate(self._dimensions):
+            if info.get('name', None) == dim:
+                return i
+        raise ValueError('Dimension %r does not exist' % (dim, ))
+
+    def get_coordinate_index(self, dim):
+        '''
+        Return a (values, order) tuple for coordinate dimension dim, where
+        values are the coordinates along its loop and order the indices
+        that sort them. The index is built once per loop structure and is
+        used for the coordinate lookups in slice().
+        '''
+
+        dim = self._get_dim_index(dim)
+        grid = self._get_loop_grid()
+        if grid is None or dim not in self._loopdims:
+            raise ValueError('Dimension %d is not a loop dimension' % dim)
+
+        if dim not in self._coord_index:
+            axis = len(self._loopdims) - 1 - self._loopdims.index(dim)
+            sel = [0] * (grid.ndim - 1)
+            sel[axis] = numpy.s_[:]
+            sel.append(dim)
+            values = grid[tuple(sel)]
+            self._coord_index[dim] = (values, numpy.argsort(values))
+
+        return self._coord_index[dim]
+
+    def _lookup_coordinate(self, dim, sel):
+        '''
+        Return an index (for a single coordinate value, the nearest point)
+        or a slice (for a (min, max) tuple) along the loop of dimension dim.
+        '''
+
+        values, order = self.get_coordinate_index(dim)
+        svalues = values[order]
+
+        if type(sel) in (types.TupleType, types.ListType):
+            i0 = numpy.searchsorted(svalues, min(sel), side='left')
+            i1 = numpy.searchsorted(svalues, max(sel), side='right')
+            if i1 <= i0:
+                raise ValueError('No points in range %r for dimension %d' % \
+                        (sel, dim))
+            idx = order[i0:i1]
+            return numpy.s_[idx.min():idx.max()+1]
+
+        i = numpy.searchsorted(svalues, sel)
+        if i == len(svalues) or \
+                (i > 0 and abs(svalues[i-1] - sel) <= abs(svalues[i] - sel)):
+            i -= 1
+        return int(order[i])
+
+    def slice(self, coords={}, vals=None, name=None):
+        '''
+        Return a new Data object containing a slice of this data set.
+
+        Input:
+            coords (dict): maps coordinate dimensions (number or name) to
+                either a single value, selecting the nearest point, or a
+                (min, max) tuple. Dimensions that are not specified are
+                included completely.
+            vals (list): value dimensions (number or name) to include,
+                default all.
+            name (string): name of the new Data object.
+
+        Coordinates fixed to a single value are dropped from the result and
+        recorded in its comment. The new object is backed by a view of this
+        data set whenever the selection allows it (e.g. a line cut along
+        any loop, or a range of an outer loop, with the selected columns
+        at a constant stride), so no data is copied.
+        '''
+
+        grid = self._get_loop_grid()
+        if grid is None:
+            raise ValueError('Unable to determine loop structure of data')
+
+        ncoords = self.get_ncoordinates()
+        for dim in coords:
+            if self._get_dim_index(dim) >= ncoords:
+                raise ValueError('Dimension %r is not a coordinate' % (dim, ))
+        sels = dict([(self._get_dim_index(k), v) for k, v in coords.items()])
+
+        if vals is None:
+            vals = range(ncoords, self.get_ndimensions())
+        else:
+            vals = [self._get_dim_index(v) for v in vals]
+
+        # Select along each loop axis, outermost first
+        index = []
+        comments = []
+        for loopdim in reversed(self._loopdims):
+            if loopdim not in sels:
+                index.append(numpy.s_[:])
+                continue
+            idx = self._lookup_coordinate(loopdim, sels[loopdim])
+            index.append(idx)
+            values, order = self._coord_index[loopdim]
+            dimname = self.get_dimension_name(loopdim)
+            if type(idx) is types.IntType:
+                comments.append('%s = %s' % (dimname, values[idx]))
+            else:
+                sel = values[idx]
+                comments.append('%s in [%s, %s]' % \
+                        (dimname, sel.min(), sel.max()))
+
+        cols = [i for i in range(ncoords) if i not in self._loopdims or \
+                type(index[len(self._loopdims) - 1 - \
+                self._loopdims.index(i)]) is not types.IntType]
+        cols += vals
+
+        # Columns with a constant stride can be selected without a copy;
+        # others are picked after the basic index so the loop axes stay
+        # in place.
+        steps = numpy.diff(cols)
+        if len(cols) == 1:
+            index.append(numpy.s_[cols[0]:cols[0]+1])
+            sliced = grid[tuple(index)]
+        elif steps[0] > 0 and numpy.all(steps == steps[0]):
+            index.append(numpy.s_[cols[0]:cols[-1]+1:steps[0]])
+            sliced = grid[tuple(index)]
+        else:
+            sliced = numpy.take(grid[tuple(index)], cols, axis=-1)
+        sliced = sliced.reshape((-1, len(cols)))
+
+        if name is None:
+            name = '%s_slice' % self._name
+        d = Data(name=name, infile=False, inmem=True)
+        for i in cols:
+            info = copy.copy(self._dimensions[i])
+            if i < ncoords:
+                info.pop('size', None)
+                d.add_coordinate(**info)
+            else:
+                d.add_value(**info)
+
+        d._comment = list(self._comment)
+        if len(comments) > 0:
+            d._comment.append('Slice of %s: %s' % \
+                    (self._name, ', '.join(comments)))
+        else:
+            d._comment.append('Slice of %s' % self._name)
+        d._data = sliced
+        d._npoints = len(sliced)
+        d._detect_dimensions_size()
+
+        return d
+
 ### Misc
 
     def _stop_request_cb(self, sender):
@@ -1273,3 +1722,40 @@ def slice(data, coords, vals):
     """
     Return new data object with a slice of the given data set
     """
+    return data.slice(coords, vals)
+
+if __name__ == '__main__':
+    # Slicing a 3D set with a non-contiguous column selection
+    xs, ys, zs = numpy.linspace(0, 1, 4), numpy.arange(5), numpy.arange(3)
+    rows = []
+    for x in xs:
+        for y in ys:
+            for z in zs:
+                rows.append([x, y, z, x + y, 10 * x, 100 * z, 1000 * y])
+    rows = numpy.array(rows)
+    d = Data(rows, name='t', infile=False)
+    for i, n in enumerate(('x', 'y', 'z')):
+        d._dimensions[i]['name'] = n
+    for i, n in enumerate(('u', 'v', 'w', 's')):
+        d._dimensions[3 + i]['name'] = n
+
+    for coords, vals in (({'y': 2}, ['u', 's']),
+            ({'x': 0.31}, ['v', 's']),
+            ({'x': (0.3, 0.7), 'z': 1}, ['u', 'w'])):
+        s = d.slice(coords, vals=vals)
+        mask = numpy.ones(len(rows), dtype=bool)
+        cols = []
+        for i, n in enumerate(('x', 'y', 'z')):
+            sel = coords.get(n)
+            if sel is None:
+                cols.append(i)
+            elif type(sel) is types.TupleType:
+                cols.append(i)
+                mask &= (rows[:, i] >= sel[0]) & (rows[:, i] <= sel[1])
+            else:
+                vals_i = numpy.unique(rows[:, i])
+                near = vals_i[numpy.argmin(abs(vals_i - sel))]
+                mask &= rows[:, i] == near
+        cols += [d._get_dim_index(v) for v in vals]
+        assert numpy.all(s.get_data() == rows[mask][:, cols]), coords
+        print 'slice %r: %s' % (coords, s._comment[-1])
@@ -51,6 +51,56 @@ class DateTimeGenerator(data.DateTimeGenerator):
             self, data_obj))
         return base + '.hdf5'
 
+class DatasetProxy:
+    """
+    Proxy for a dataset in a DataGroup that supports numpy-style slice
+    reading and assignment; assignment only writes the selected hyperslab.
+    np.asarray(proxy) reads the whole dataset.
+    """
+
+    def __init__(self, group, name):
+        self._group = group
+        self._name = name
+        self._dset = group.group[name]
+
+    def __repr__(self):
+        return "DatasetProxy '%s', shape %r" % (self._name, self.shape)
+
+    def __getitem__(self, key):
+        return self._dset[key]
+
+    def __setitem__(self, key, val):
+        # a zero-stride view gives the shape of the selection for free
+        sel = np.lib.stride_tricks.as_strided(np.zeros(1, dtype=self.dtype),
+                shape=self.shape, strides=(0, ) * len(self.shape))[key]
+        self._dset[key] = val
+        self._group._count_written(self._name, sel.size * self.dtype.itemsize)
+
+    def __array__(self, dtype=None):
+        ret = self._dset[()]
+        if dtype is not None:
+            ret = ret.astype(dtype)
+        return ret
+
+    def __len__(self):
+        return len(self._dset)
+
+    @property
+    def shape(self):
+        return self._dset.shape
+
+    @property
+    def dtype(self):
+        return self._dset.dtype
+
+    @property
+    def attrs(self):
+        return self._dset.attrs
+
+    @property
+    def value(self):
+        return self._dset[()]
+
 class DataGroup(SharedGObject):
     """
     A data group consists of a set of arrays that will be saved together
@@ -64,13 +114,16 @@ class DataGroup(SharedGObject):
     def __init__(self, name, hdf5_data, base='/', **kw):
         self.name = name
         self.h5d = hdf5_data._file
+        self._hdf5_data = hdf5_data
+        self._lengths = {}
+        self._nbytes_written = {}
         self.base = base
         self.groupname = base + name
         self._filepath = hdf5_data.get_filepath()
         self._folder = hdf5_data.get_folder()
 
         if self.name in self.h5d[base].keys():
-            self.group = self.h5d[base]
+            self.group = self.h5d[self.groupname]
         else:
             self.group = self.h5d.create_group(self.groupname)
 
@@ -78,20 +131,39 @@ class DataGroup(SharedGObject):
         for k in kw:
             self.group.attrs[k] = kw[k]
 
+        hdf5_data._groups.append(self)
+
     def __getitem__(self, name):
-        return self.group[name].value
+        '''
+        Return a DatasetProxy, which supports partial reads and writes,
+        e.g. group['zs'][i, :] = row.
+        '''
+        self._trim(name)
+        return DatasetProxy(self, name)
 
     def __setitem__(self, name, val):
         if name in self.group.keys():
+            self._trim(name)
+            val = np.asarray(val)
+            dim = self.group[name]
+
+            # write in place if possible, otherwise re-create
+            if val.shape == dim.shape and \
+                    np.can_cast(val.dtype, dim.dtype, 'same_kind'):
+                dim[...] = val
+                self._count_written(name, val.size * dim.dtype.itemsize)
+                return True
 
             # store old attributes
-            attrs = dict(self.group[name].attrs)
+            attrs = dict(dim.attrs)
 
             # delete and re-create; overwrite doesn't work with hdf5
             del self.group[name]
+            self._lengths.pop(name, None)
             dim = self.group.create_dataset(name, data=val)
             for k, v in attrs.iteritems():
                 dim.attrs[k] = v
+            self._count_written(name, dim.size * dim.dtype.itemsize)
 
             return True
 
@@ -138,6 +210,31 @@ class DataGroup(SharedGObject):
         '''
         return self.add_dimension(name, 'unspecified', data, **meta)
 
+    def add_grid(self, name, shape, dim_type='value', dtype=np.float64,
+            **meta):
+        '''
+        Add a dimension of <shape>, allocated once and filled with NaN,
+        without writing any data. It is chunked by row (along the last
+        axis), so filling it row by row only writes the chunks involved.
+        Extra keywords are added as meta data.
+        '''
+
+        if name in self.group.keys():
+            logging.error("Dimension '%s' already exists in data set '%s'" \
+                    % (name, self.name))
+            return False
+
+        shape = tuple(shape)
+        chunks = (1, ) * (len(shape) - 1) + shape[-1:]
+        dim = self.group.create_dataset(name, shape=shape, dtype=dtype,
+                chunks=chunks, fillvalue=np.nan,
+                compression=self._hdf5_data._compression)
+        dim.attrs['dim_type'] = dim_type
+        for k in meta:
+            dim.attrs[k] = meta[k]
+
+        return True
+
     def add_coordinate(self, name, data=None, **meta):
         '''
         Add a coordinate dimension, optionally with known data.
@@ -152,6 +249,101 @@ class DataGroup(SharedGObject):
         '''
         return self.add_dimension(name, 'value', data, **meta)
 
+    def add_stream(self, name, dim_type='value', shape=(), dtype=np.float64,
+            chunks=None, **meta):
+        '''
+        Add an extendable dimension that points can be appended to, see
+        append(). <shape> is the shape of a single point. Extra keywords
+        are added as meta data.
+
+        The dataset is chunked along the first axis (<chunks> points per
+        chunk, default about 64 kB) and compressed as set in the HDF5Data
+        object. Streams should be added before calling start_swmr().
+        '''
+
+        if name in self.group.keys():
+            logging.error("Dimension '%s' already exists in data set '%s'" \
+                    % (name, self.name))
+            return False
+
+        shape = tuple(shape)
+        if chunks is None:
+            pointsize = np.dtype(dtype).itemsize * int(np.prod(shape))
+            chunks = max(1, 65536 // max(pointsize, 1))
+
+        dim = self.group.create_dataset(name, shape=(0, ) + shape,
+                maxshape=(None, ) + shape, chunks=(chunks, ) + shape,
+                dtype=dtype, compression=self._hdf5_data._compression)
+        dim.attrs['dim_type'] = dim_type
+        for k in meta:
+            dim.attrs[k] = meta[k]
+        self._lengths[name] = 0
+
+        return True
+
+    def append(self, name, values):
+        '''
+        Append one or more points to dimension <name>, which is created
+        with add_stream() if it does not exist yet.
+
+        The dataset grows geometrically; it is trimmed to the number of
+        points written when the data is flushed, which happens at most
+        every flush_interval seconds (see HDF5Data) or on flush() / close().
+        '''
+
+        values = np.asarray(values)
+        if name not in self._lengths:
+            if name in self.group.keys():
+                self._lengths[name] = self.group[name].shape[0]
+            else:
+                self.add_stream(name, shape=values.shape[1:],
+                        dtype=values.dtype)
+
+        dim = self.group[name]
+        if values.ndim < dim.ndim:
+            values = values.reshape((-1, ) + dim.shape[1:])
+
+        n = self._lengths[name]
+        newn = n + len(values)
+        if newn > dim.shape[0]:
+            dim.resize(max(newn, 2 * dim.shape[0]), axis=0)
+        dim[n:newn] = values
+        self._lengths[name] = newn
+        self._count_written(name, values.size * dim.dtype.itemsize)
+
+        self._hdf5_data._check_flush()
+
+    def get_length(self, name):
+        '''Return the number of points appended to a stream dimension.'''
+        if name in self._lengths:
+            return self._lengths[name]
+        return self.group[name].shape[0]
+
+    def _trim(self, name=None):
+        if name is None:
+            names = self._lengths.keys()
+        elif name in self._lengths:
+            names = [name]
+        else:
+            return
+
+        for name in names:
+            dim = self.group[name]
+            if dim.shape[0] != self._lengths[name]:
+                dim.resize(self._lengths[name], axis=0)
+
+    def _count_written(self, name, nbytes):
+        self._nbytes_written[name] = self._nbytes_written.get(name, 0) + nbytes
+
+    def get_bytes_written(self, name=None):
+        '''
+        Return the number of data bytes written to dimension <name>, or to
+        all dimensions, through this object.
+        '''
+        if name is not None:
+            return self._nbytes_written.get(name, 0)
+        return sum(self._nbytes_written.values())
+
     def loop1d_data(self, *args, **kwargs):
         kwargs['group'] = self
         return loop1d_data(*args, **kwargs)
@@ -172,6 +364,13 @@ class HDF5Data:
 
         kwargs:
             name (string) : default is 'data'
+            filepath (string) : default is generated
+            compression (string) : compression of stream datasets, None
+                (default), 'lzf' or 'gzip'
+            flush_interval (float) : maximum time in seconds between flushes
+                while appending to streams, default 1
+            swmr (bool) : open the file such that start_swmr() can be used
+                to let readers follow it while it is being written
         """
 
         # FIXME: the name generation here is a bit nasty
@@ -179,7 +378,7 @@ class HDF5Data:
         name = data.Data._data_list.new_item_name(self, name)
         self._name = name
 
-        filepath = kwargs.get('filepath, None')
+        filepath = kwargs.get('filepath', None)
         if filepath:
             self._filepath = filepath
 
@@ -193,7 +392,13 @@ class HDF5Data:
         self._folder, self._filename = os.path.split(self._filepath)
         if not os.path.isdir(self._folder):
             os.makedirs(self._folder)
-        self._file = h5py.File(self._filepath, 'a')
+        self._compression = kwargs.get('compression', None)
+        self._flush_interval = kwargs.get('flush_interval', 1.0)
+        self._groups = []
+        if kwargs.get('swmr', False):
+            self._file = h5py.File(self._filepath, 'a', libver='latest')
+        else:
+            self._file = h5py.File(self._filepath, 'a')
         self.flush()
 
     def __getitem__(self, name):
@@ -223,43 +428,110 @@ class HDF5Data:
         '''Create a DataGroup object.'''
         return DataGroup(name, self, **kwargs)
 
+    def start_swmr(self):
+        '''
+        Switch to single-writer/multiple-reader mode, after which other
+        processes can follow the file with h5py.File(fn, 'r', swmr=True)
+        and refresh(). New datasets can no longer be created, so all
+        streams should be added first. Requires swmr=True on creation.
+        '''
+        self.flush()
+        self._file.swmr_mode = True
+
+    def _check_flush(self):
+        if time.time() - self._last_flush >= self._flush_interval:
+            self.flush()
+
     def flush(self):
+        for group in self._groups:
+            group._trim()
         self._file.flush()
+        self._last_flush = time.time()
 
     def close(self):
+        self.flush()
         self._file.close()
 
 def loop1d_data(xs, ynames=('ys', ), name='data', xname='xs', data=None, group=None):
     '''
     Create 1D loop data group. If <data> is specified it is created in that
-    HDF5 data file.
+    HDF5 data file, if <group> is specified the dimensions are added to it.
     The x coordinates should be specified in <xs> and will be named <xname>.
-    <ynames> is a list that specifies the value data sets that will be created.
+    <ynames> is a list that specifies the value data sets that will be
+    created; they are allocated once (filled with NaN) and can be filled
+    point by point, e.g. group['ys'][i] = y.
     '''
     if not group:
         if not data:
             data = HDF5Data()
-    group = d.create_data_group(name)
-    group.add_coordinate(xs, data=xs)
+        group = data.create_data_group(name)
+    group.add_coordinate(xname, data=xs)
     for yname in ynames:
-        group.add_value(yname, np.zeros((len(xs),)))
+        group.add_grid(yname, (len(xs), ))
     return group
 
 def loop2d_data(xs, ys, znames=('zs', ), name='data', xname='xs', yname='ys', data=None, group=None):
     '''
     Create 2D loop data group. If <data> is specified it is created in that
-    HDF5 data file.
+    HDF5 data file, if <group> is specified the dimensions are added to it.
     The x and y coordinates should be specified in <xs> and <ys> and will be
     named <xname> and <yname>. <znames> is a list that specifies the value
-    data sets that will be created.
+    data sets that will be created; they are allocated once (filled with
+    NaN) and can be filled row by row, e.g. group['zs'][i, :] = row.
     '''
     if not group:
         if not data:
             data = HDF5Data()
-        group = d.create_data_group(name)
+        group = data.create_data_group(name)
     group.add_coordinate(xname, data=xs)
     group.add_coordinate(yname, data=ys)
     for zname in znames:
-        group.add_value(zname, np.zeros((len(xs), len(ys))))
+        group.add_grid(zname, (len(xs), len(ys)))
     return group
 
+if __name__ == '__main__':
+    import tempfile
+
+    npoints = 10**7
+    blocksize = 1000
+    tmpdir = tempfile.mkdtemp()
+    block = np.random.rand(blocksize)
+
+    for compression in (None, 'lzf', 'gzip'):
+        fn = os.path.join(tmpdir, 'stream_%s.hdf5' % compression)
+        d = HDF5Data(filepath=fn, compression=compression, swmr=True)
+        g = d.create_data_group('stream')
+        g.add_stream('x')
+        d.start_swmr()
+        start = time.time()
+        for i in range(npoints // blocksize):
+            g.append('x', block)
+        d.close()
+        print 'HDF5 (%s): %d points in %.2f s, %.1f MB' % \
+                (compression, npoints, time.time() - start,
+                os.path.getsize(fn) / 1e6)
+
+    n = 1000
+    xs = np.arange(n)
+    ys = np.arange(n)
+    zs = np.add.outer(xs * 1000, ys).astype(np.float64)
+    d = HDF5Data(filepath=os.path.join(tmpdir, 'sweep.hdf5'))
+    g = loop2d_data(xs, ys, data=d)
+    start = time.time()
+    for i in range(n):
+        g['zs'][i, :] = zs[i]
+    print 'Sweep %dx%d by row: %.2f s, %.1f MB written, correct: %s' % \
+            (n, n, time.time() - start, g.get_bytes_written('zs') / 1e6,
+            (np.asarray(g['zs']) == zs).all())
+    d.close()
+
+    d = data.Data(name='stream')
+    d.add_value('x')
+    fn = os.path.join(tmpdir, 'stream.dat')
+    d.create_file(filepath=fn, settings_file=False)
+    start = time.time()
+    for i in range(npoints // blocksize):
+        d.add_data_point(block)
+    d.close_file()
+    print '.dat: %d points in %.2f s, %.1f MB' % \
+            (npoints, time.time() - start, os.path.getsize(fn) / 1e6)
@@ -21,8 +21,12 @@ import copy
 import time
 import math
 import inspect
+import functools
+import threading
 from gettext import gettext as _L
 from lib import calltimer
+from lib import persist
+from lib.misc import exact_time
 from lib.network.object_sharer import SharedGObject, cache_result
 
 import numpy as np
@@ -32,6 +36,17 @@ import qt
 from lib.config import get_config
 config = get_config()
 
+def _add_channel(func, channel):
+    '''Return func with a default 'channel' keyword argument.'''
+    if channel is None:
+        return func
+
+    def f(*args, **kwargs):
+        if 'channel' not in kwargs:
+            kwargs['channel'] = channel
+        return func(*args, **kwargs)
+    return f
+
 class Instrument(SharedGObject):
     """
     Base class for instruments.
@@ -76,7 +91,7 @@ class Instrument(SharedGObject):
                                 # e.g. an internally stored value is returned.
                                 # Only use for parameters that cannot be read
                                 # back from a device.
-    FLAG_PERSIST = 0x10         # Write parameter to config file if it is set,
+    FLAG_PERSIST = 0x10         # Write parameter to persist journal if it is set,
                                 # try to read again for a new instance
 
     USE_ACCESS_LOCK = False     # For now
@@ -85,6 +100,9 @@ class Instrument(SharedGObject):
 
     _lock_classes = {}
 
+    # Set by profiler.Profiler.enable()
+    _profiler = None
+
     def __init__(self, name, **kwargs):
         SharedGObject.__init__(self, 'instrument_%s' % name, replace=True)
 
@@ -101,6 +119,8 @@ class Instrument(SharedGObject):
 
         self._parameters = {}
         self._parameter_groups = {}
+        self._getters = {}
+        self._setters = {}
         self._functions = {}
         self._added_methods = []
         self._probe_ids = []
@@ -108,6 +128,10 @@ class Instrument(SharedGObject):
         self._default_read_var = None
         self._default_write_var = None
 
+        # Time spent in driver functions by the current get / set, per
+        # thread (see _start_profile)
+        self._prof_local = threading.local()
+
         self._lock_class = kwargs.get('lockclass', name)
         if self._lock_class in Instrument._lock_classes:
             self._access_lock = Instrument._lock_classes[self._lock_class]
@@ -249,7 +273,7 @@ class Instrument(SharedGObject):
                 format_map (dict): map describing allowed options and the
                     formatted (mostly GUI) representation
                 option_list (array/tuple): allowed options
-                persist (bool): if true load/save values in config file
+                persist (bool): if true load/save values in persist journal
                 probe_interval (int): interval in ms between automatic gets
                 listen_to (list of (ins, param) tuples): list of parameters
                     to watch. If any of them changes, execute a get for this
@@ -377,7 +401,10 @@ class Instrument(SharedGObject):
 #            property(lambda: self.get(name), lambda x: self.set(name, x)))
 
         if options['flags'] & self.FLAG_PERSIST:
-            val = config.get('persist_%s_%s' % (self._name, name))
+            val = persist.get_store().get(self._name, name)
+            if val is None:
+                # values persisted before the journal existed
+                val = config.get('persist_%s_%s' % (self._name, name))
             options['value'] = val
         else:
             options['value'] = None
@@ -403,6 +430,8 @@ class Instrument(SharedGObject):
             else:
                 self._parameter_groups[g].append(name)
 
+        self._compile_parameter(name)
+
         self.emit('parameter-added', name)
 
     def _remove_parameters(self):
@@ -416,6 +445,8 @@ class Instrument(SharedGObject):
                 if hasattr(self, fname):
                     delattr(self, fname)
         self._parameters = {}
+        self._getters = {}
+        self._setters = {}
 
     def remove_parameter(self, name):
         if name not in self._parameters:
@@ -426,6 +457,8 @@ class Instrument(SharedGObject):
                 delattr(self, func)
 
         del self._parameters[name]
+        self._getters.pop(name, None)
+        self._setters.pop(name, None)
         self.emit('parameter-removed', name)
 
     def has_parameter(self, name):
@@ -477,6 +510,7 @@ class Instrument(SharedGObject):
 
         for key, val in kwargs.iteritems():
             self._parameters[name][key] = val
+        self._compile_parameter(name)
 
         self.emit('parameter-changed', name)
 
@@ -711,7 +745,15 @@ class Instrument(SharedGObject):
             base_name = name
 
         func = p['get_func']
-        value = func(**kwargs)
+        if Instrument._profiler is not None:
+            local = self._prof_local
+            driver_time = getattr(local, 'driver_time', 0.0)
+            t = exact_time()
+            value = func(**kwargs)
+            # nested gets / sets in func are part of its driver time
+            local.driver_time = driver_time + exact_time() - t
+        else:
+            value = func(**kwargs)
         if 'type' in p and value is not None:
             try:
                 if p['type'] == types.IntType:
@@ -748,15 +790,37 @@ class Instrument(SharedGObject):
                 Type is whatever the instrument driver returns.
         '''
 
+        prof = Instrument._profiler
+        if prof is None and not Instrument.USE_ACCESS_LOCK and \
+                type(name) not in (types.ListType, types.TupleType):
+            getter = self._getters.get(name, None)
+            if getter is not None:
+                value = getter(query, kwargs)
+                if query and not fast:
+                    self._changed[name] = value
+                    if self._changed_hid is None:
+                        self._changed_hid = \
+                            gobject.idle_add(self._do_emit_changed)
+                return value
+
+        if prof is not None:
+            tstart = exact_time()
+
         if Instrument.USE_ACCESS_LOCK:
             if not self._access_lock.acquire():
                 logging.warning(_L('Failed to acquire lock!'))
                 return None
 
+        if prof is not None:
+            tlock = exact_time() - tstart
+            outer = self._start_profile()
+
         if fast:
             ret = self._get_value(name, query, **kwargs)
             if Instrument.USE_ACCESS_LOCK:
                 self._access_lock.release()
+            if prof is not None:
+                self._record_profile(prof, name, 'get', tstart, tlock, outer)
             return ret
 
         if type(name) in (types.ListType, types.TupleType):
@@ -778,6 +842,9 @@ class Instrument(SharedGObject):
         if len(changed) > 0 and query:
             self._queue_changed(changed)
 
+        if prof is not None:
+            self._record_profile(prof, name, 'get', tstart, tlock, outer)
+
         return result
 
     def get_threaded(self, *args, **kwargs):
@@ -877,6 +944,148 @@ class Instrument(SharedGObject):
 
         return value
 
+    # Casts applied to values returned by get functions
+    _GET_CAST_MAP = {
+            types.IntType: int,
+            types.FloatType: float,
+            types.BooleanType: bool,
+            np.ndarray: np.array,
+    }
+
+    def _compile_parameter(self, name):
+        '''
+        Build the fast get / set accessors for parameter 'name'.
+
+        The accessors are closures that only contain the steps needed for
+        the options of this parameter, they are used by get() and set()
+        instead of _get_value() and _set_value(). They have to be rebuilt
+        when the options change, which set_parameter_options() does.
+        '''
+
+        p = self._parameters[name]
+        getter = self._compile_getter(name, p)
+        if getter is not None:
+            self._getters[name] = getter
+        elif name in self._getters:
+            del self._getters[name]
+
+        setter = self._compile_setter(name, p)
+        if setter is not None:
+            self._setters[name] = setter
+        elif name in self._setters:
+            del self._setters[name]
+
+    def _compile_getter(self, name, p):
+        flags = p['flags']
+        if p['type'] == np.ndarray:
+            cached = lambda: np.array(p['value'])
+        else:
+            cached = lambda: p['value']
+
+        if flags & Instrument.FLAG_SOFTGET:
+            return lambda query, kwargs: cached()
+        elif not flags & Instrument.FLAG_GET:
+            return None
+
+        func = _add_channel(p['get_func'], p.get('channel', None))
+        cast = self._GET_CAST_MAP.get(p['type'], None)
+
+        if cast is None:
+            def getter(query, kwargs):
+                if not query:
+                    return cached()
+                value = func(**kwargs)
+                p['value'] = value
+                return value
+
+        else:
+            ptype = p['type']
+            def getter(query, kwargs):
+                if not query:
+                    return cached()
+                value = func(**kwargs)
+                if value is not None:
+                    try:
+                        value = cast(value)
+                    except:
+                        logging.warning('Unable to cast value "%s" to %s',
+                                value, ptype)
+                p['value'] = value
+                return value
+
+        return getter
+
+    def _compile_setter(self, name, p):
+        flags = p['flags']
+        if not flags & Instrument.FLAG_SET:
+            return None
+
+        # Options that are not specialized are handled by _set_value()
+        for key in ('format_map', 'option_list'):
+            if key in p:
+                return None
+        if p.get('maxstep', None) is not None:
+            return None
+
+        ttype = p['type']
+        if ttype not in self._CONVERT_MAP:
+            return None
+
+        func = _add_channel(p['set_func'], p.get('channel', None))
+        convert = self._convert_value
+        # Conversion of these types to themselves is a no-op
+        if ttype in (types.IntType, types.FloatType, types.StringType,
+                types.BooleanType):
+            skiptype = ttype
+        else:
+            skiptype = None
+
+        checkmin = 'minval' in p
+        checkmax = 'maxval' in p
+        minval = p.get('minval', None)
+        maxval = p.get('maxval', None)
+        getafter = flags & Instrument.FLAG_GET_AFTER_SET
+        persistent = flags & Instrument.FLAG_PERSIST
+
+        if not (checkmin or checkmax or getafter or persistent):
+            def setter(value, kwargs):
+                if type(value) is not skiptype:
+                    try:
+                        value = convert(value, ttype)
+                    except:
+                        return None
+                func(value, **kwargs)
+                p['value'] = value
+                return value
+
+            return setter
+
+        def setter(value, kwargs):
+            if type(value) is not skiptype:
+                try:
+                    value = convert(value, ttype)
+                except:
+                    return None
+
+            if checkmin and value < minval:
+                print 'Trying to set too small value: %s' % value
+                return None
+            if checkmax and value > maxval:
+                print 'Trying to set too large value: %s' % value
+                return None
+
+            func(value, **kwargs)
+
+            if getafter:
+                value = self._get_value(name, **kwargs)
+            if persistent:
+                persist.get_store().set(self._name, name, value)
+
+            p['value'] = value
+            return value
+
+        return setter
+
     def _set_value(self, name, value, **kwargs):
         '''
         Private wrapper function to set a value.
@@ -937,6 +1146,12 @@ class Instrument(SharedGObject):
         else:
             base_name = name
 
+        prof = Instrument._profiler
+        if prof is not None:
+            local = self._prof_local
+            driver_time = getattr(local, 'driver_time', 0.0)
+            t = exact_time()
+
         func = p['set_func']
         if 'maxstep' in p and p['maxstep'] is not None:
             curval = p['value']
@@ -971,12 +1186,14 @@ class Instrument(SharedGObject):
         else:
             ret = func(value, **kwargs)
 
+        if prof is not None:
+            local.driver_time = driver_time + exact_time() - t
+
         if p['flags'] & self.FLAG_GET_AFTER_SET:
             value = self._get_value(name, **kwargs)
 
         if p['flags'] & self.FLAG_PERSIST:
-            config.set('persist_%s_%s' % (self._name, name), value)
-            config.save()
+            persist.get_store().set(self._name, name, value)
 
         p['value'] = value
         return value
@@ -1005,11 +1222,33 @@ class Instrument(SharedGObject):
                     self.get_name())
             return False
 
+        prof = Instrument._profiler
+        if prof is None and not Instrument.USE_ACCESS_LOCK and \
+                type(name) is not types.DictType:
+            setter = self._setters.get(name, None)
+            if setter is not None:
+                value = setter(value, kwargs)
+                if value is None:
+                    return False
+                if not fast:
+                    self._changed[name] = value
+                    if self._changed_hid is None:
+                        self._changed_hid = \
+                            gobject.idle_add(self._do_emit_changed)
+                return True
+
+        if prof is not None:
+            tstart = exact_time()
+
         if Instrument.USE_ACCESS_LOCK:
             if not self._access_lock.acquire():
                 logging.warning(_L('Failed to acquire lock!'))
                 return None
 
+        if prof is not None:
+            tlock = exact_time() - tstart
+            outer = self._start_profile()
+
         result = True
         changed = {}
         if type(name) == types.DictType:
@@ -1033,8 +1272,33 @@ class Instrument(SharedGObject):
         if not fast and len(changed) > 0:
             self._queue_changed(changed)
 
+        if prof is not None:
+            self._record_profile(prof, name, 'set', tstart, tlock, outer)
+
         return result
 
+    def _start_profile(self):
+        '''
+        Start counting driver time for a get / set. Returns the count of
+        an enclosing get / set in the same thread (a get from within a
+        driver function), to be restored by _record_profile().
+        '''
+        local = self._prof_local
+        outer = getattr(local, 'driver_time', 0.0)
+        local.driver_time = 0.0
+        return outer
+
+    def _record_profile(self, prof, name, op, tstart, tlock, outer):
+        local = self._prof_local
+        driver_time = local.driver_time
+        local.driver_time = outer
+        if type(name) == types.DictType:
+            name = ','.join(sorted(name.keys()))
+        elif type(name) in (types.ListType, types.TupleType):
+            name = ','.join(name)
+        prof.record(self._name, name, op, exact_time() - tstart,
+                driver_time, tlock)
+
     def update_value(self, name, value):
         '''
         Update a parameter value if new information is obtained.
@@ -1066,12 +1330,35 @@ class Instrument(SharedGObject):
             logging.warning('Instrument does not implement function %s', name)
 
         f = getattr(self, name)
+        f = getattr(f, '_profiled_func', f)
         if hasattr(f, '__doc__'):
             options['doc'] = getattr(f, '__doc__')
 
         options['argspec'] = self.get_argspec_dict(inspect.getargspec(f))
 
         self._functions[name] = options
+        setattr(self, name, self._make_profiled_function(name, f))
+
+    def _make_profiled_function(self, name, f):
+        '''
+        Return a wrapper of exposed function f that records its calls
+        when the profiler is enabled.
+        '''
+
+        @functools.wraps(f)
+        def profiled(*args, **kwargs):
+            prof = Instrument._profiler
+            if prof is None:
+                return f(*args, **kwargs)
+
+            tstart = exact_time()
+            ret = f(*args, **kwargs)
+            dt = exact_time() - tstart
+            prof.record(self._name, name, 'call', dt, dt, 0.0)
+            return ret
+
+        profiled._profiled_func = f
+        return profiled
 
     def get_function_options(self, name):
         '''
@@ -1121,7 +1408,16 @@ class Instrument(SharedGObject):
         Output: None
         '''
         f = getattr(self, funcname)
+        prof = Instrument._profiler
+        # exposed functions record their calls themselves
+        if prof is None or funcname in self._functions:
+            f(**kwargs)
+            return
+
+        tstart = exact_time()
         f(**kwargs)
+        dt = exact_time() - tstart
+        prof.record(self._name, funcname, 'call', dt, dt, 0.0)
 
     def lock(self):
         '''
@@ -16,16 +16,25 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import code
+import ast
 import inspect
 import gobject
 import types
 import os
 import logging
 import sys
+import threading
+import Queue
 import instrument
-from lib.config import get_config
+from lib.config import get_config, get_execdir
 from insproxy import Proxy
-from lib.network.object_sharer import SharedGObject
+from lib.network.object_sharer import SharedGObject, helper
+
+# for backward compatibility to python 2.5
+try:
+    import json
+except:
+    import simplejson as json
 
 from lib.misc import get_traceback
 TB = get_traceback()()
@@ -87,6 +96,158 @@ def _get_driver_module(name, do_reload=False):
 
     return None
 
+def _get_driver_filename(name):
+    '''Return the file name of driver <name>, user drivers take precedence.'''
+    for dir in (_user_insdir, _insdir):
+        if dir is None:
+            continue
+        fn = os.path.join(dir, '%s.py' % name)
+        if os.path.exists(fn):
+            return fn
+    return None
+
+def _parse_argspec(filename, typename):
+    '''
+    Return the argspec of the constructor of class <typename> from the
+    source in <filename> as a list [args, varargs, varkw, defaults], or
+    None if it can not be determined without importing the module (e.g.
+    an inherited constructor or default values that are not literals).
+    '''
+
+    try:
+        f = open(filename, 'rU')
+        try:
+            tree = ast.parse(f.read(), filename)
+        finally:
+            f.close()
+    except Exception, e:
+        logging.debug('Unable to parse %s: %s', filename, e)
+        return None
+
+    for node in tree.body:
+        if isinstance(node, ast.ClassDef) and node.name == typename:
+            break
+    else:
+        return None
+
+    for func in node.body:
+        if isinstance(func, ast.FunctionDef) and func.name == '__init__':
+            break
+    else:
+        return None
+
+    args = []
+    for arg in func.args.args:
+        if not isinstance(arg, ast.Name):
+            return None
+        args.append(arg.id)
+
+    defaults = []
+    for val in func.args.defaults:
+        try:
+            defaults.append(ast.literal_eval(val))
+        except ValueError:
+            return None
+
+    return [args, func.args.vararg, func.args.kwarg, defaults]
+
+class _ArgspecIndex:
+    '''
+    Constructor argspecs of instrument drivers, parsed from the driver
+    source and cached in a file. Entries are keyed by file name and
+    invalidated when the modification time of the driver changes.
+    '''
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._entries = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+
+        if os.path.exists(filename):
+            try:
+                f = open(filename, 'r')
+                try:
+                    self._entries = json.load(f)
+                finally:
+                    f.close()
+            except Exception, e:
+                logging.warning('Unable to read argspec index %s: %s',
+                        filename, e)
+
+    def get(self, filename, typename):
+        '''
+        Return the argspec (args, varargs, varkw, defaults) of driver
+        <typename> in <filename>, or None if it is not known.
+        '''
+
+        mtime = os.path.getmtime(filename)
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(filename)
+            if entry is None or entry['mtime'] != mtime:
+                entry = {
+                    'mtime': mtime,
+                    'argspec': _parse_argspec(filename, typename),
+                }
+                self._entries[filename] = entry
+                self._dirty = True
+        finally:
+            self._lock.release()
+
+        spec = entry['argspec']
+        if spec is None:
+            return None
+        # the index is stored as JSON, which returns unicode strings
+        args, varargs, varkw, defaults = [_to_str(x) for x in spec]
+        if len(defaults) == 0:
+            defaults = None
+        else:
+            defaults = tuple(defaults)
+        return inspect.ArgSpec(args, varargs, varkw, defaults)
+
+    def save(self):
+        '''Write the index if it has changed.'''
+
+        self._lock.acquire()
+        try:
+            if not self._dirty:
+                return
+            f = open(self._filename, 'w')
+            try:
+                json.dump(self._entries, f, indent=1, sort_keys=True)
+            finally:
+                f.close()
+            self._dirty = False
+        except Exception, e:
+            logging.warning('Unable to write argspec index %s: %s',
+                    self._filename, e)
+        finally:
+            self._lock.release()
+
+def _to_str(val):
+    if type(val) is types.UnicodeType:
+        return str(val)
+    elif type(val) is types.ListType:
+        return [_to_str(x) for x in val]
+    return val
+
+def _get_lock_class(insclass, name, kwargs):
+    '''
+    Return the lock class of instrument <name>: instruments with the same
+    lock class share a bus and should not be accessed concurrently.
+    '''
+
+    if 'lockclass' in kwargs:
+        return kwargs['lockclass']
+    if insclass is not None and issubclass(insclass, instrument.GPIBInstrument):
+        return 'GPIB'
+    address = kwargs.get('address', None)
+    if type(address) in types.StringTypes and \
+            address.upper().startswith('GPIB'):
+        return 'GPIB'
+    return name
+
 class Instruments(SharedGObject):
 
     __gsignals__ = {
@@ -227,6 +388,16 @@ class Instruments(SharedGObject):
             defaults: default values
         '''
 
+        filename = _get_driver_filename(typename)
+        if filename is None:
+            return None
+
+        index = _get_argspec_index()
+        spec = index.get(filename, typename)
+        index.save()
+        if spec is not None:
+            return spec
+
         module = _get_driver_module(typename)
         insclass = getattr(module, typename, None)
         if insclass is None:
@@ -271,33 +442,153 @@ class Instruments(SharedGObject):
         Output: Instrument object (Proxy)
         '''
 
+        if not self._prepare_create(name, instype):
+            return None
+
+        # Set VISA provider
+        visa_driver = kwargs.get('visa', 'pyvisa')
+        import visa
+        visa.set_visa(visa_driver)
+
+        insclass = self._get_class(instype)
+        ins = self._construct(insclass, name, kwargs)
+        return self._finish_create(name, instype, ins, kwargs)
+
+    def create_many(self, specs, nthreads=8):
+        '''
+        Create several instruments in parallel, e.g. at startup.
+
+        Instruments with the same lock class (such as all GPIB instruments)
+        are created one after the other by the same thread, so that
+        instruments sharing a bus are never initialized concurrently.
+        Each driver module is imported only once.
+
+        Input:
+            specs (list): (name, type, kwargs) tuples, where kwargs is a
+                dictionary of keyword arguments as accepted by create()
+            nthreads (int): maximum number of threads
+
+        Output:
+            List of Instrument objects (Proxy) in the order of <specs>,
+            None for instruments of unsupported type.
+        '''
+
+        import visa
+
+        # Sort into groups per VISA provider and lock class
+        todo = []
+        classes = {}
+        for name, instype, kwargs in specs:
+            if not self._prepare_create(name, instype):
+                continue
+            if instype not in classes:
+                classes[instype] = self._get_class(instype)
+            insclass = classes[instype]
+            visa_driver = kwargs.get('visa', 'pyvisa')
+            lockclass = _get_lock_class(insclass, name, kwargs)
+            todo.append((visa_driver, lockclass, name, insclass, kwargs))
+
+        # The VISA provider is a global setting, so instruments using
+        # different providers are created in separate rounds.
+        created = {}
+        while len(todo) > 0:
+            visa_driver = todo[0][0]
+            groups = {}
+            order = []
+            for item in todo:
+                if item[0] != visa_driver:
+                    continue
+                if item[1] not in groups:
+                    groups[item[1]] = []
+                    order.append(item[1])
+                groups[item[1]].append(item[2:])
+            todo = [item for item in todo if item[0] != visa_driver]
+
+            visa.set_visa(visa_driver)
+            queue = Queue.Queue()
+            for lockclass in order:
+                queue.put(groups[lockclass])
+
+            threads = []
+            for i in range(min(nthreads, len(order))):
+                t = threading.Thread(target=self._create_worker,
+                        args=(queue, created))
+                t.start()
+                threads.append(t)
+            for t in threads:
+                t.join()
+
+        # Signals are emitted from this thread
+        ret = []
+        for name, instype, kwargs in specs:
+            if name not in created:
+                ret.append(None)
+                continue
+            ins, signals = created[name]
+            helper.emit_deferred(signals)
+            ret.append(self._finish_create(name, instype, ins, kwargs))
+        return ret
+
+    def _create_worker(self, queue, created):
+        '''
+        Construct the instruments of groups from queue. Signals emitted by
+        the constructors are buffered, create_many() sends them.
+        '''
+
+        while True:
+            try:
+                group = queue.get_nowait()
+            except Queue.Empty:
+                return
+            for name, insclass, kwargs in group:
+                helper.defer_signals()
+                try:
+                    ins = self._construct(insclass, name, kwargs)
+                finally:
+                    signals = helper.defer_signals(False)
+                created[name] = (ins, signals)
+
+    def _prepare_create(self, name, instype):
         if not self.type_exists(instype):
             logging.error('Instrument type %s not supported', instype)
-            return None
+            return False
 
         if name in self._instruments:
             logging.warning('Instrument "%s" already exists, removing', name)
             self.remove(name)
 
-        # Set VISA provider
-        visa_driver = kwargs.get('visa', 'pyvisa')
-        import visa
-        visa.set_visa(visa_driver)
+        return True
+
+    def _get_class(self, instype):
+        '''
+        Return the instrument class of driver <instype>, the module is
+        imported if that did not happen yet. Use reload_module() to load
+        a modified driver.
+        '''
 
         module = _get_driver_module(instype)
         if module is None:
-            return self._create_invalid_ins(name, instype, **kwargs)
-        reload(module)
+            return None
         insclass = getattr(module, instype, None)
         if insclass is None:
             logging.error('Driver does not contain instrument class')
-            return self._create_invalid_ins(name, instype, **kwargs)
+        return insclass
+
+    def _construct(self, insclass, name, kwargs):
+        '''Create instance of <insclass>, return None if that fails.'''
+
+        if insclass is None:
+            return None
 
         try:
-            ins = insclass(name, **kwargs)
+            return insclass(name, **kwargs)
         except Exception, e:
             TB()
             logging.error('Error creating instrument %s', name)
+            return None
+
+    def _finish_create(self, name, instype, ins, kwargs):
+        if ins is None:
             return self._create_invalid_ins(name, instype, **kwargs)
 
         self.add(ins, create_args=kwargs)
@@ -415,6 +706,15 @@ _config = get_config()
 _insdir = _set_insdir()
 _user_insdir = _set_user_insdir()
 
+_argspec_index = None
+def _get_argspec_index():
+    global _argspec_index
+    if _argspec_index is None:
+        pname = os.path.split(sys.argv[0])[-1]
+        fname = os.path.join(get_execdir(), pname + '.argspec')
+        _argspec_index = _ArgspecIndex(fname)
+    return _argspec_index
+
 _instruments = None
 def get_instruments():
     global _instruments
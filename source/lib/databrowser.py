@@ -1,15 +1,55 @@
 import os
 import re
+import time
+import logging
+import sqlite3
+
+# for backward compatibility to python 2.5
+try:
+    import json
+except:
+    import simplejson as json
+
+def _encode_metadata(metadata):
+    '''
+    Serialize metadata to JSON. Headers are not necessarily UTF-8, so
+    strings are mapped byte-for-byte through latin-1.
+    '''
+    return json.dumps(metadata, encoding='latin-1')
+
+def _to_bytes(val):
+    if type(val) is unicode:
+        return val.encode('latin-1')
+    elif type(val) is list:
+        return [_to_bytes(v) for v in val]
+    elif type(val) is dict:
+        return dict([(_to_bytes(k), _to_bytes(v)) for k, v in val.items()])
+    return val
+
+def _decode_metadata(s):
+    '''Inverse of _encode_metadata, returns the original byte strings.'''
+    return _to_bytes(json.loads(s))
 
 class DataInfo:
 
-    RE_META = re.compile('\A\s*#\s*(\w+)\s*:\s*([\w\s,.:;]+)')
+    RE_META = re.compile('\A\s*#\s*(\w+)\s*:\s*(\S.*)$')
     RE_META_KEY = re.compile('\A\s*#\s*(\w+)\s*:')
+    # Instrument objects are written to the header as Instrument '<name>'
+    RE_INS_NAME = re.compile("\AInstrument\s+'(.*)'\Z")
+
+    def __init__(self, fn, metadata=None):
+        '''
+        Info about a data file. If metadata is given (e.g. from the index)
+        the file is not read.
+        '''
 
-    def __init__(self, fn):
         self._filename = None
         self._metadata = {}
-        self.set_filename(fn)
+        if metadata is None:
+            self.set_filename(fn)
+        else:
+            self._filename = fn
+            self._metadata = metadata
 
     def set_filename(self, fn):
         self._filename = fn
@@ -39,8 +79,9 @@ class DataInfo:
 
             m = self.RE_META_KEY.search(line)
             if m is not None:
-                self._metadata[g[0]] = {}
+                self._metadata[m.group(1)] = {}
 
+        f.close()
         self._check_settings_file()
 
     def _check_settings_file(self):
@@ -51,23 +92,353 @@ class DataInfo:
             for line in f:
                 line = line.rstrip('\r\n')
                 self._metadata['settings'].append(line)
+            f.close()
+
+    def get_columns(self):
+        '''
+        Return a list of dictionaries with the column info (name,
+        instrument, parameter) from the header.
+        '''
+
+        cols = []
+        for line in self._metadata.get('header', []):
+            m = self.RE_META.search(line)
+            if m is None:
+                if line.lstrip('# \t').startswith('Column'):
+                    cols.append({})
+                continue
+
+            key, val = m.groups()
+            if len(cols) > 0 and key in ('name', 'instrument', 'parameter'):
+                val = val.strip()
+                if key == 'instrument':
+                    m = self.RE_INS_NAME.match(val)
+                    if m is not None:
+                        val = m.group(1)
+                cols[-1][key] = val
+
+        return cols
+
+    def get_settings(self):
+        '''Return a list of (instrument, parameter, value) tuples.'''
+
+        settings = []
+        ins = None
+        for line in self._metadata.get('settings', []):
+            if line.startswith('Instrument:'):
+                ins = line.split(':', 1)[1].strip()
+            elif line.startswith('\t') and ins is not None:
+                fields = line.strip().split(':', 1)
+                if len(fields) == 2:
+                    settings.append((ins, fields[0], fields[1].strip()))
+
+        return settings
+
+    def get_timestamp(self):
+        '''Return the timestamp from the header in seconds, or None.'''
+
+        ts = self._metadata.get('Timestamp', None)
+        if ts is None:
+            return None
+        try:
+            return time.mktime(time.strptime(ts.strip()))
+        except ValueError:
+            return None
+
+class DataIndex:
+    '''
+    Persistent SQLite index of the data files in a directory tree, with
+    their header metadata and settings.
+
+    rescan() only parses files of which the modification time or size
+    changed since the last scan.
+    '''
+
+    _SCHEMA = (
+        '''CREATE TABLE IF NOT EXISTS files (
+            id INTEGER PRIMARY KEY,
+            path TEXT UNIQUE,
+            name TEXT,
+            date TEXT,
+            timestamp REAL,
+            mtime REAL,
+            size INTEGER,
+            set_mtime REAL,
+            metadata TEXT)''',
+        '''CREATE TABLE IF NOT EXISTS columns (
+            file_id INTEGER,
+            colnum INTEGER,
+            name TEXT,
+            instrument TEXT,
+            parameter TEXT)''',
+        '''CREATE TABLE IF NOT EXISTS settings (
+            file_id INTEGER,
+            instrument TEXT,
+            parameter TEXT,
+            value TEXT)''',
+        'CREATE INDEX IF NOT EXISTS files_name ON files (name)',
+        'CREATE INDEX IF NOT EXISTS files_date ON files (date)',
+        'CREATE INDEX IF NOT EXISTS files_timestamp ON files (timestamp)',
+        'CREATE INDEX IF NOT EXISTS columns_file ON columns (file_id)',
+        'CREATE INDEX IF NOT EXISTS columns_ins ON columns (instrument, parameter)',
+        'CREATE INDEX IF NOT EXISTS settings_file ON settings (file_id)',
+        'CREATE INDEX IF NOT EXISTS settings_ins ON settings (instrument, parameter)',
+    )
+
+    # Bump when the stored format changes, to re-parse all files
+    _VERSION = 2
+
+    _RE_DATE = re.compile('(\d{8})')
+
+    def __init__(self, dbfn=':memory:'):
+        self._dbfn = dbfn
+        self._db = sqlite3.connect(dbfn)
+        self._db.text_factory = str
+        for cmd in self._SCHEMA:
+            self._db.execute(cmd)
+        version = self._db.execute('PRAGMA user_version').fetchone()[0]
+        if version != self._VERSION:
+            for table in ('columns', 'settings', 'files'):
+                self._db.execute('DELETE FROM %s' % table)
+            self._db.execute('PRAGMA user_version = %d' % self._VERSION)
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+    def _stat(self, fn):
+        try:
+            st = os.stat(fn)
+            return st.st_mtime, st.st_size
+        except OSError:
+            return None, None
+
+    def rescan(self, dir):
+        '''
+        Update the index for all .dat files below dir. Returns the number
+        of files that were (re)parsed.
+        '''
+
+        dir = os.path.abspath(dir)
+        known = {}
+        prefix = os.path.join(dir, '')
+        rows = self._db.execute(
+                'SELECT id, path, mtime, size, set_mtime FROM files '
+                'WHERE substr(path, 1, ?) = ?', (len(prefix), prefix))
+        for row in rows:
+            known[row[1]] = row
+
+        nparsed = 0
+        for dirpath, dirnames, filenames in os.walk(dir):
+            for fn in filenames:
+                if os.path.splitext(fn)[1] != '.dat':
+                    continue
+
+                fullfn = os.path.join(dirpath, fn)
+                mtime, size = self._stat(fullfn)
+                if mtime is None:
+                    continue
+                set_mtime = self._stat(os.path.splitext(fullfn)[0] + '.set')[0]
+
+                row = known.pop(fullfn, None)
+                if row is not None and tuple(row[2:]) == \
+                        (mtime, size, set_mtime):
+                    continue
+
+                try:
+                    info = DataInfo(fullfn)
+                    self._store(info, mtime, size, set_mtime)
+                except Exception, e:
+                    logging.warning('Unable to index %s: %s', fullfn, e)
+                    continue
+
+                nparsed += 1
+
+        # Remove entries for files that no longer exist
+        for row in known.values():
+            self._remove(row[0])
+
+        self._db.commit()
+        return nparsed
+
+    def _remove(self, file_id):
+        self._db.execute('DELETE FROM columns WHERE file_id = ?', (file_id, ))
+        self._db.execute('DELETE FROM settings WHERE file_id = ?', (file_id, ))
+        self._db.execute('DELETE FROM files WHERE id = ?', (file_id, ))
+
+    def _store(self, info, mtime, size, set_mtime):
+        fn = info.get_filename()
+        row = self._db.execute('SELECT id FROM files WHERE path = ?',
+                (fn, )).fetchone()
+        if row is not None:
+            self._remove(row[0])
+
+        name = os.path.split(fn)[1]
+        ts = info.get_timestamp()
+        if ts is None:
+            ts = mtime
+        m = self._RE_DATE.search(os.path.split(os.path.dirname(fn))[1])
+        if m is None:
+            date = time.strftime('%Y%m%d', time.localtime(ts))
+        else:
+            date = m.group(1)
+
+        cur = self._db.execute('INSERT INTO files (path, name, date, '
+                'timestamp, mtime, size, set_mtime, metadata) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (fn, name, date, ts, mtime, size, set_mtime,
+                    _encode_metadata(info.get_metadata())))
+        file_id = cur.lastrowid
+
+        cols = [(file_id, i, c.get('name'), c.get('instrument'),
+                c.get('parameter')) for i, c in enumerate(info.get_columns())]
+        self._db.executemany('INSERT INTO columns VALUES (?, ?, ?, ?, ?)',
+                cols)
+
+        settings = [(file_id, ) + s for s in info.get_settings()]
+        self._db.executemany('INSERT INTO settings VALUES (?, ?, ?, ?)',
+                settings)
+
+    def query(self, dir=None, match='', date=None, instrument=None,
+            parameter=None, starttime=None, endtime=None, setting=None):
+        '''
+        Return a sorted list of filenames matching all given criteria:
+            dir: only files below this directory
+            match: substring of the filename
+            date: 'YYYYMMDD' string, or a (first, last) tuple
+            instrument, parameter: measured in one of the columns
+            starttime, endtime: 'HHMMSS' strings, based on the 6-digit
+                timestamp at the front of the filename; or numbers, compared
+                to the timestamp in the header (seconds since the epoch)
+            setting: (instrument, parameter, value) tuple from the
+                settings file, value can be None
+        '''
+
+        where = []
+        args = []
+        if dir is not None:
+            prefix = os.path.join(os.path.abspath(dir), '')
+            where.append('substr(f.path, 1, ?) = ?')
+            args += [len(prefix), prefix]
+        if match != '':
+            where.append('f.name GLOB ?')
+            args.append('*%s*' % re.sub('([*?[])', '[\\1]', match))
+
+        if type(date) in (tuple, list):
+            where.append('f.date BETWEEN ? AND ?')
+            args += list(date)
+        elif date is not None:
+            where.append('f.date = ?')
+            args.append(date)
+
+        for val, op in ((starttime, '>='), (endtime, '<=')):
+            if val is None:
+                continue
+            if type(val) in (str, unicode):
+                where.append('substr(f.name, 1, 6) %s ?' % op)
+            else:
+                where.append('f.timestamp %s ?' % op)
+            args.append(val)
+
+        if instrument is not None or parameter is not None:
+            sub = 'SELECT file_id FROM columns WHERE 1'
+            if instrument is not None:
+                sub += ' AND instrument = ?'
+                args.append(instrument)
+            if parameter is not None:
+                sub += ' AND parameter = ?'
+                args.append(parameter)
+            where.append('f.id IN (%s)' % sub)
+
+        if setting is not None:
+            sub = 'SELECT file_id FROM settings WHERE instrument = ? ' \
+                    'AND parameter = ?'
+            args += [setting[0], setting[1]]
+            if len(setting) > 2 and setting[2] is not None:
+                sub += ' AND value = ?'
+                args.append(str(setting[2]))
+            where.append('f.id IN (%s)' % sub)
+
+        sql = 'SELECT f.path FROM files f'
+        if len(where) > 0:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY f.path'
+
+        return [row[0] for row in self._db.execute(sql, args)]
+
+    def get_infos(self, dir):
+        '''Return DataInfo objects for all files below dir.'''
+
+        prefix = os.path.join(os.path.abspath(dir), '')
+        rows = self._db.execute('SELECT path, metadata FROM files '
+                'WHERE substr(path, 1, ?) = ? ORDER BY path',
+                (len(prefix), prefix))
+        return [DataInfo(row[0], metadata=_decode_metadata(row[1])) \
+                for row in rows]
+
+    def get_info(self, fn):
+        '''Return a DataInfo object for fn from the index, or None.'''
+
+        row = self._db.execute('SELECT metadata FROM files WHERE path = ?',
+                (fn, )).fetchone()
+        if row is None:
+            return None
+        return DataInfo(fn, metadata=_decode_metadata(row[0]))
 
 class Browser:
 
-    def __init__(self, dir=None):
+    INDEX_FILENAME = '.qtlab_index.db'
+
+    def __init__(self, dir=None, index=None):
+        '''
+        Browse the data files in dir.
+
+        The file info is kept in a DataIndex, by default stored in
+        <dir>/.qtlab_index.db (in memory if that is not writable), so only
+        new and changed files have to be read when reopening a directory.
+        '''
+
         self._dir = None
-        self._entries = []
+        self._index = index
+        self._own_index = index is None
         self.set_dir(dir)
 
+    def _open_index(self, dir):
+        fn = os.path.join(dir, self.INDEX_FILENAME)
+        try:
+            return DataIndex(fn)
+        except sqlite3.Error, e:
+            logging.warning('Unable to open index %s: %s, using memory',
+                    fn, e)
+            return DataIndex()
+
     def set_dir(self, dir):
+        if dir is not None:
+            dir = os.path.abspath(dir)
         self._dir = dir
-        self._entries = []
-        self._walk_dir(self._dir, recurse=True)
+        if dir is None:
+            return
+
+        # Every directory has its own index, unless one was given
+        if self._own_index:
+            if self._index is not None:
+                self._index.close()
+            self._index = self._open_index(dir)
+        self.rescan()
+
+    def rescan(self):
+        '''Update the index for new, changed and removed files.'''
+        return self._index.rescan(self._dir)
+
+    def get_index(self):
+        return self._index
 
     def get_entries(self):
-        return self._entries
+        if self._dir is None:
+            return []
+        return self._index.get_infos(self._dir)
 
-    def get_filenames(self, match='', starttime=None, endtime=None):
+    def get_filenames(self, match='', starttime=None, endtime=None, **kwargs):
         '''
         Return filenames of entries matching 'match'. If match is an empty
         string it returns all filenames.
@@ -75,45 +446,15 @@ class Browser:
         a specific range of the matched data files, based on the 6-digit
         timestamp at the front of a filename. 'starttime' and 'endtime' must
         be specified as a 6-digit string.
+
+        Other keyword arguments are passed to DataIndex.query().
         '''
 
-        usetimes = False
-        if starttime is not None or endtime is not None:
-            usetimes = True
-            if starttime is None:
-                starttime = '000000'
-            if endtime is None:
-                endtime = '240000'
-
-        ret = []
-        for info in self._entries:
-            fn = info.get_filename()
-            fnr = os.path.split(fn)[1]
-            if not usetimes and fnr.count(match) > 0:
-                ret.append(fn)
-            elif usetimes and fnr.count(match) > 0 and starttime <= fnr[:6] <= endtime:
-                ret.append(fn)
-        ret.sort()
-        return ret
+        if self._dir is None:
+            return []
+        return self._index.query(dir=self._dir, match=match,
+                starttime=starttime, endtime=endtime, **kwargs)
 
     def get_entry(self, fn):
-        for i in self._entries:
-            if i.get_filename() == fn:
-                return i
-        return None
-
-    def _walk_dir(self, dir, recurse=False):
-        entries = os.listdir(dir)
-        for i in entries:
-            fullfn = os.path.join(dir, i)
-            if os.path.isdir(fullfn):
-                if recurse:
-                    self._walk_dir(fullfn)
-            else:
-                fn, ext = os.path.splitext(i)
-                if ext == '.dat':
-                    self._add_data_entry(fullfn)
-
-    def _add_data_entry(self, fn):
-        self._entries.append(DataInfo(fn))
+        return self._index.get_info(os.path.abspath(fn))
 
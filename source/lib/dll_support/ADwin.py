@@ -1,7 +1,11 @@
 # -*- coding: cp1252 -*-
-import ctypes, sys, os, array
+import ctypes, sys, os, array, threading, time
 if sys.platform == 'win32':
     import _winreg
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # ADwin-Exception
 class ADwinError(Exception):
@@ -19,9 +23,11 @@ class ADwin:
     __err = ctypes.c_long(0)
     __errPointer = ctypes.pointer(__err)
 
-    def __init__(self, DeviceNo = 0x150, raiseExceptions = 1):
+    def __init__(self, DeviceNo = 0x150, raiseExceptions = 1, dll = None):
 
-        if sys.platform == 'linux2':
+        if dll is not None:
+            self.dll = dll
+        elif sys.platform == 'linux2':
             try:
                 if (sys.version_info[0] == 3):
                     f = open('/etc/adwin/ADWINDIR', 'r')
@@ -203,6 +209,35 @@ class ADwin:
         self.__checkError('Get_FPar_All')
         return data
 
+    # Conversion of bulk data
+    def __toDLL(self, Data, ctype, Count):
+        '''Returns Data in a form that can be passed to the DLL. Contiguous numpy
+        arrays of the matching type are passed as a pointer, without copying.'''
+        if numpy is not None and isinstance(Data, numpy.ndarray):
+            data = numpy.ascontiguousarray(Data[:Count], dtype=ctype)
+            if len(data) < Count:
+                raise ValueError('Data has less than %d elements' % Count)
+            return data, data.ctypes.data_as(ctypes.POINTER(ctype))
+        elif (type(Data) == list) or (type(Data) == array.array):
+            dataType = ctype * Count
+            data = dataType(*Data[:Count])
+            return data, data
+        else: # ctypes-array
+            return Data, Data
+
+    def __fromDLL(self, out, ctype, Count):
+        '''Returns a buffer of Count elements for the DLL to write into: a new
+        ctypes array, or a view of the numpy array out.'''
+        if out is None:
+            dataType = ctype * Count
+            data = dataType(0)
+            return data, data
+        if out.dtype != numpy.dtype(ctype) or not out.flags.c_contiguous \
+                or not out.flags.writeable or len(out) < Count:
+            raise ValueError('out must be a writeable, contiguous array of '
+                    'at least %d elements of type %s' % (Count, numpy.dtype(ctype)))
+        return out[:Count], out.ctypes.data_as(ctypes.POINTER(ctype))
+
     # Transfer of data arrays
     def Data_Length(self, Data_No):
         '''Data_Length returns the length of an array, declared under ADbasic,
@@ -214,48 +249,36 @@ class ADwin:
     def SetData_Long(self, Data, DataNo, Startindex, Count):
         '''SetData_Long transfers long data from the PC into a DATA array
         of the ADwin system.'''
-        if (type(Data) == list) or (type(Data) == array.array):
-            # convert list to ctypes.c_long_Array
-            dataType = ctypes.c_long * Count
-            data = dataType(0)
-            for i in range(Count):
-                data[i] = Data[i]
-        else: # ctypes-array
-            data = Data
+        buf, data = self.__toDLL(Data, ctypes.c_long, Count)
         self.dll.e_Set_Data(data, 2, DataNo, Startindex, Count, self.DeviceNo, self.__errPointer)
         self.__checkError('SetData_Long')
 
-    def GetData_Long(self, DataNo, StartIndex, Count):
+    def GetData_Long(self, DataNo, StartIndex, Count, out = None):
         '''GetData_Long transfers long data from a DATA array of an ADwin system
-        into an array.'''
-        dataType = ctypes.c_long * Count
-        data = dataType(0)
+        into an array.
+        If the numpy array out is given, the data is transferred into it directly
+        and a view of its first Count elements is returned.'''
+        buf, data = self.__fromDLL(out, ctypes.c_long, Count)
         self.dll.e_Get_Data(data, 2, DataNo, StartIndex, Count, self.DeviceNo, self.__errPointer)
         self.__checkError('GetData_Long')
-        return data
+        return buf
 
     def SetData_Float(self, Data, DataNo, Startindex, Count):
         '''SetData_Float transfers float data from the PC into a DATA array
         of the ADwin system.'''
-        if (type(Data) == list) or (type(Data) == array.array):
-            # convert list to ctypes.c_float_Array
-            dataType = ctypes.c_float * Count
-            data = dataType(0)
-            for i in range(Count):
-                data[i] = Data[i]
-        else: # ctypes-array
-            data = Data
+        buf, data = self.__toDLL(Data, ctypes.c_float, Count)
         self.dll.e_Set_Data(data, 5, DataNo, Startindex, Count, self.DeviceNo, self.__errPointer)
         self.__checkError('SetData_Float')
 
-    def GetData_Float(self, DataNo, StartIndex, Count):
+    def GetData_Float(self, DataNo, StartIndex, Count, out = None):
         '''GetData_Float transfers float data from a DATA array of an ADwin system
-        into an array.'''
-        dataType = ctypes.c_float * Count
-        data = dataType(0)
+        into an array.
+        If the numpy array out is given, the data is transferred into it directly
+        and a view of its first Count elements is returned.'''
+        buf, data = self.__fromDLL(out, ctypes.c_float, Count)
         self.dll.e_Get_Data(data, 5, DataNo, StartIndex, Count, self.DeviceNo, self.__errPointer)
         self.__checkError('GetData_Float')
-        return data
+        return buf
 
     # Transfer of FIFO Arrays
     def Fifo_Empty(self, FifoNo):
@@ -277,45 +300,33 @@ class ADwin:
 
     def SetFifo_Long(self, FifoNo, Data, Count):
         '''SetFifo_Long transfers long data from the PC to a FIFO array of the ADwin system.'''
-        if (type(Data) == list) or (type(Data) == array.array):
-            # convert list to ctypes.c_long_Array
-            dataType = ctypes.c_long * Count
-            data = dataType(0)
-            for i in range(Count):
-                data[i] = Data[i]
-        else: # ctypes-array
-            data = Data
+        buf, data = self.__toDLL(Data, ctypes.c_long, Count)
         self.dll.e_Set_Fifo(data, 2, FifoNo, Count, self.DeviceNo, self.__errPointer)
         self.__checkError('SetFifo_Long')
 
-    def GetFifo_Long(self, FifoNo, Count):
-        '''GetFifo_Long transfers long FIFO data from the ADwin system to the PC.'''
-        dataType = ctypes.c_long * Count
-        data = dataType(0)
+    def GetFifo_Long(self, FifoNo, Count, out = None):
+        '''GetFifo_Long transfers long FIFO data from the ADwin system to the PC.
+        If the numpy array out is given, the data is transferred into it directly
+        and a view of its first Count elements is returned.'''
+        buf, data = self.__fromDLL(out, ctypes.c_long, Count)
         self.dll.e_Get_Fifo(data, 2, FifoNo, Count, self.DeviceNo, self.__errPointer)
         self.__checkError('GetFifo_Long')
-        return data
+        return buf
 
     def SetFifo_Float(self, FifoNo, Data, Count):
         '''SetFifo_Float transfers float data from the PC into a FIFO array of the ADwin system.'''
-        if (type(Data) == list) or (type(Data) == array.array):
-            # convert list to ctypes.c_float_Array
-            dataType = ctypes.c_float * Count
-            data = dataType(0)
-            for i in range(Count):
-                data[i] = Data[i]
-        else: # ctypes-array
-            data = Data
+        buf, data = self.__toDLL(Data, ctypes.c_float, Count)
         self.dll.e_Set_Fifo(data, 5, FifoNo, Count, self.DeviceNo, self.__errPointer)
         self.__checkError('SetFifo_Float')
 
-    def GetFifo_Float(self, FifoNo, Count):
-        '''GetFifo_Float transfers float FIFO data from the ADwin system to the PC.'''
-        dataType = ctypes.c_float * Count
-        data = dataType(0)
+    def GetFifo_Float(self, FifoNo, Count, out = None):
+        '''GetFifo_Float transfers float FIFO data from the ADwin system to the PC.
+        If the numpy array out is given, the data is transferred into it directly
+        and a view of its first Count elements is returned.'''
+        buf, data = self.__fromDLL(out, ctypes.c_float, Count)
         self.dll.e_Get_Fifo(data, 5, FifoNo, Count, self.DeviceNo, self.__errPointer)
         self.__checkError('GetFifo_Float')
-        return data
+        return buf
 
     # Data arrays with string data
     def String_Length(self, DataNo):
@@ -353,4 +364,182 @@ class ADwin:
 
     def Get_Last_Error(self):
         '''Get_Last_Error returns the number of the last error.'''
-        return self.__err.value
\ No newline at end of file
+        return self.__err.value
+
+
+class FifoStreamer:
+    '''FifoStreamer drains a FIFO array of an ADwin system into a numpy ring
+    buffer from a background thread, polling Fifo_Full every Interval seconds.
+    If the ring buffer is not read out in time the oldest elements are
+    overwritten and counted in Overruns.'''
+
+    def __init__(self, adwin, FifoNo, Size = 2**20, Interval = 0.01, Type = 'Float'):
+        if numpy is None:
+            raise ADwinError('FifoStreamer', 'numpy is required.', 0)
+        self.adwin = adwin
+        self.FifoNo = FifoNo
+        self.Interval = Interval
+        if Type == 'Float':
+            self.__get = adwin.GetFifo_Float
+            self.buffer = numpy.zeros(Size, dtype=ctypes.c_float)
+        else:
+            self.__get = adwin.GetFifo_Long
+            self.buffer = numpy.zeros(Size, dtype=ctypes.c_long)
+        self.Size = Size
+        self.Overruns = 0
+        self.__written = 0
+        self.__read = 0
+        self.__cond = threading.Condition()
+        self.__thread = None
+        self.__stop = threading.Event()
+
+    def start(self):
+        '''start starts draining the FIFO.'''
+        if self.__thread is not None:
+            return
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        '''stop stops draining the FIFO, after emptying it once more.'''
+        if self.__thread is None:
+            return
+        self.__stop.set()
+        self.__thread.join()
+        self.__thread = None
+        self.drain()
+
+    def __run(self):
+        while not self.__stop.is_set():
+            start = time.time()
+            self.drain()
+            self.__stop.wait(max(0, self.Interval - (time.time() - start)))
+
+    def drain(self):
+        '''drain transfers the used elements of the FIFO into the ring buffer
+        and returns their number.'''
+        Count = self.adwin.Fifo_Full(self.FifoNo)
+        if Count <= 0:
+            return 0
+        Count = min(Count, self.Size)
+        self.__cond.acquire()
+        try:
+            pos = self.__written % self.Size
+            first = min(Count, self.Size - pos)
+            self.__get(self.FifoNo, first, out=self.buffer[pos:])
+            if Count > first:
+                self.__get(self.FifoNo, Count - first, out=self.buffer)
+            self.__written += Count
+            if self.__written - self.__read > self.Size:
+                self.Overruns += self.__written - self.__read - self.Size
+                self.__read = self.__written - self.Size
+            self.__cond.notify_all()
+        finally:
+            self.__cond.release()
+        return Count
+
+    def available(self):
+        '''available returns the number of elements that can be read.'''
+        return self.__written - self.__read
+
+    def read(self, Count = None, timeout = None):
+        '''read returns (a copy of) the next Count elements of the ring buffer,
+        waiting at most timeout seconds for them to arrive. If Count is None
+        all available elements are returned.'''
+        self.__cond.acquire()
+        try:
+            if Count is None:
+                Count = self.available()
+            Count = min(Count, self.Size)
+            if timeout is not None:
+                end = time.time() + timeout
+                while self.available() < Count and time.time() < end:
+                    self.__cond.wait(end - time.time())
+            Count = min(Count, self.available())
+            pos = self.__read % self.Size
+            if pos + Count <= self.Size:
+                ret = self.buffer[pos:pos+Count].copy()
+            else:
+                ret = numpy.concatenate((self.buffer[pos:],
+                    self.buffer[:pos+Count-self.Size]))
+            self.__read += Count
+            return ret
+        finally:
+            self.__cond.release()
+
+
+class _FakeDLL:
+    '''Numpy backed stand-in for the ADwin DLL, implementing the transfer of
+    DATA and FIFO arrays only. The FIFO is filled with a ramp at Rate elements
+    per second. Addresses passed to the transfer functions are recorded in
+    Addresses.'''
+
+    def __init__(self, Size = 10**7, Rate = 1e6):
+        self.data = {2: numpy.zeros(Size, dtype=ctypes.c_long),
+                     5: numpy.zeros(Size, dtype=ctypes.c_float)}
+        self.Rate = Rate
+        self.Addresses = []
+        self.e_Clear_Fifo(0, 0, None)
+
+    def __array(self, data, Type, Count):
+        ctype = {2: ctypes.c_long, 5: ctypes.c_float}[Type]
+        ptr = ctypes.cast(data, ctypes.POINTER(ctype))
+        self.Addresses.append(ctypes.addressof(ptr.contents))
+        return numpy.ctypeslib.as_array(ptr, shape=(Count,))
+
+    def e_GetDataLength(self, DataNo, DeviceNo, err):
+        return len(self.data[2])
+
+    def e_Set_Data(self, data, Type, DataNo, Startindex, Count, DeviceNo, err):
+        self.data[Type][Startindex-1:Startindex-1+Count] = self.__array(data, Type, Count)
+
+    def e_Get_Data(self, data, Type, DataNo, Startindex, Count, DeviceNo, err):
+        self.__array(data, Type, Count)[:] = self.data[Type][Startindex-1:Startindex-1+Count]
+
+    def e_Clear_Fifo(self, FifoNo, DeviceNo, err):
+        self.__start = time.time()
+        self.__fiforead = 0
+
+    def e_Get_Fifo_Count(self, FifoNo, DeviceNo, err):
+        return int((time.time() - self.__start) * self.Rate) - self.__fiforead
+
+    def e_Get_Fifo(self, data, Type, FifoNo, Count, DeviceNo, err):
+        self.__array(data, Type, Count)[:] = numpy.arange(self.__fiforead, self.__fiforead + Count)
+        self.__fiforead += Count
+
+    def e_Set_Fifo(self, data, Type, FifoNo, Count, DeviceNo, err):
+        self.__array(data, Type, Count)
+
+
+if __name__ == '__main__':
+    N = 10**7
+    adw = ADwin(dll=_FakeDLL(N))
+
+    data = numpy.arange(N, dtype=ctypes.c_float)
+    start = time.time()
+    adw.SetData_Float(data, 1, 1, N)
+    out = numpy.empty(N, dtype=ctypes.c_float)
+    ret = adw.GetData_Float(1, 1, N, out=out)
+    print('numpy: %d samples to and from DATA array in %.3f s' % (N, time.time() - start))
+    print('zero-copy: %s' % (adw.dll.Addresses[-2:] == [data.ctypes.data, out.ctypes.data] and (ret == data).all()))
+
+    lst = data.tolist()
+    start = time.time()
+    adw.SetData_Float(lst, 1, 1, N)
+    ret = numpy.array(adw.GetData_Float(1, 1, N))
+    print('list: %d samples to and from DATA array in %.3f s' % (N, time.time() - start))
+
+    streamer = FifoStreamer(adw, 1, Size=2**18)
+    adw.Fifo_Clear(1)
+    streamer.start()
+    total = 0
+    start = time.time()
+    while time.time() - start < 1:
+        block = streamer.read(2**16, timeout=1)
+        if total == 0 and len(block) > 0 and block[0] != 0:
+            print('Unexpected first element %r' % block[0])
+        total += len(block)
+    streamer.stop()
+    print('FifoStreamer: read %d samples in 1 s, %d overruns' % (total, streamer.Overruns))
@@ -1,6 +1,9 @@
 from ctypes import *
 import numpy as np
 import time
+import threading
+import Queue
+import logging
 
 DRV_ERROR_CODES = 20001
 DRV_SUCCESS = 20002
@@ -245,9 +248,12 @@ AC_EMGAIN_12BIT = 2
 AC_EMGAIN_LINEAR12 = 4
 AC_EMGAIN_REAL12 = 8
 
-def initialize(dir='c:/program files/andor andor/drivers/'):
+def initialize(dir='c:/program files/andor andor/drivers/', dll=None):
     global andor
-    andor = windll.atmcd32d
+    if dll is not None:
+        andor = dll
+    else:
+        andor = windll.atmcd32d
     ret = andor.Initialize(dir)
     return ret
 
@@ -308,17 +314,17 @@ def wait_idle(delay=30):
         time.sleep(0.5)
     return False
 
-def get_acquired_data(bufsize=1024):
-    data = np.zeros(bufsize, dtype=np.int32)
-    ret = andor.GetAcquiredData(data.ctypes.data, bufsize)
-    return data
+def get_acquired_data(bufsize=1024, out=None):
+    if out is None:
+        out = np.zeros(bufsize, dtype=np.int32)
+    ret = andor.GetAcquiredData(out.ctypes.data, out.size)
+    return out
 
 def get_spectrum():
     xpix, ypix = get_detector()
     start_acquisition()
     while get_status() == DRV_ACQUIRING:
-        time.sleep(0.1)
-    time.sleep(0.2)
+        wait_for_acquisition(0.1)
     return get_acquired_data(xpix)
 
 def get_spectrum_adv(background=None, ntries=3, thresh=0.15):
@@ -378,13 +384,432 @@ def get_read_mode():
     romode = c_int32(0)
     ret = andor.GetReadMode(byref(romode))
     return romode.value
-
 # SetShutter
 # SetTriggerMode
 # SetAccumulationCycletime
 # SetNumberAccumulations
-# SetNumberKinetics
-# SetKineticCycletime
 # GetAcquisitiontimings
 # SetHSSpeed
 # SetVSSpeed
+
+def set_acquisition_mode(mode):
+    '''
+    mode:
+        1: Single scan
+        2: Accumulate
+        3: Kinetics
+        4: Fast kinetics
+        5: Run till abort
+    '''
+    ret = andor.SetAcquisitionMode(c_int32(mode))
+    return ret
+
+def set_number_kinetics(n):
+    ret = andor.SetNumberKinetics(c_int32(n))
+    return ret
+
+def set_kinetic_cycle_time(t):
+    ret = andor.SetKineticCycleTime(c_float(t))
+    return ret
+
+def abort_acquisition():
+    ret = andor.AbortAcquisition()
+    return ret
+
+def wait_for_acquisition(timeout=0.1):
+    '''
+    Wait until a new image is available or <timeout> seconds have passed.
+    Returns True if a new image arrived.
+    '''
+    ret = andor.WaitForAcquisitionTimeOut(c_int32(int(timeout * 1000)))
+    return ret == DRV_SUCCESS
+
+def get_number_new_images():
+    '''
+    Return the indices (first, last) of the images in the circular buffer
+    of the driver that have not been retrieved yet, or None.
+    '''
+    first, last = c_int32(0), c_int32(0)
+    ret = andor.GetNumberNewImages(byref(first), byref(last))
+    if ret != DRV_SUCCESS:
+        return None
+    return first.value, last.value
+
+def get_images(first, last, out):
+    '''
+    Copy images first to last (inclusive) into the int32 array <out>.
+    Returns the range (first, last) of valid images, or None.
+    '''
+    vfirst, vlast = c_int32(0), c_int32(0)
+    ret = andor.GetImages(c_int32(first), c_int32(last), out.ctypes.data,
+            c_uint32(out.size), byref(vfirst), byref(vlast))
+    if ret != DRV_SUCCESS:
+        return None
+    return vfirst.value, vlast.value
+
+def get_frame_shape():
+    '''Return the shape of a frame in the current read mode.'''
+    xpix, ypix = get_detector()
+    if get_read_mode() == 4:
+        return (ypix, xpix)
+    return (xpix, )
+
+class NpyStackWriter:
+    '''
+    Append frames to a .npy file; the header is completed on close(), so
+    the stack can be loaded with numpy.load (also using mmap_mode).
+    '''
+
+    HEADER_LEN = 256
+
+    def __init__(self, filepath, shape, dtype=np.int32):
+        self._file = open(filepath, 'wb')
+        self._shape = tuple(shape)
+        self._dtype = np.dtype(dtype)
+        self._nframes = 0
+        self._write_header()
+
+    def _write_header(self):
+        header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % \
+                (self._dtype.str, (self._nframes, ) + self._shape)
+        header = header.ljust(self.HEADER_LEN - 11) + '\n'
+        self._file.seek(0)
+        self._file.write('\x93NUMPY\x01\x00')
+        self._file.write(np.array(len(header), dtype='<u2').tostring())
+        self._file.write(header)
+        self._file.seek(0, 2)
+
+    def append(self, frame):
+        self._file.write(np.ascontiguousarray(frame, dtype=self._dtype).tostring())
+        self._nframes += 1
+
+    def close(self):
+        self._write_header()
+        self._file.close()
+
+class HDF5StackWriter:
+    '''
+    Append frames to a chunked, extendable dataset in an HDF5 file.
+    '''
+
+    def __init__(self, filepath, shape, dtype=np.int32, name='frames',
+            chunkframes=16):
+        import h5py
+        self._file = h5py.File(filepath, 'a')
+        self._chunkframes = chunkframes
+        self._shape = tuple(shape)
+        self._ds = self._file.create_dataset(name,
+                shape=(chunkframes, ) + self._shape,
+                maxshape=(None, ) + self._shape,
+                chunks=(chunkframes, ) + self._shape, dtype=dtype)
+        self._nframes = 0
+
+    def append(self, frame):
+        if self._nframes == self._ds.shape[0]:
+            self._ds.resize(self._nframes + self._chunkframes, axis=0)
+        self._ds[self._nframes] = frame
+        self._nframes += 1
+
+    def close(self):
+        self._ds.resize(self._nframes, axis=0)
+        self._file.close()
+
+class FrameStream:
+    '''
+    Stream frames from a kinetic series or run-till-abort acquisition.
+
+    An acquisition thread waits for new images, copies every image from
+    the driver with GetImages into a free frame of a preallocated pool and
+    queues it for a writer thread, which passes it to <sink> (an object
+    with append(frame) and close(), e.g. NpyStackWriter or HDF5StackWriter)
+    and returns the frame to the pool.
+
+    Frames are dropped, and counted, when the driver's circular buffer was
+    overwritten before they were retrieved, or when the pool is exhausted
+    because the sink cannot keep up.
+    '''
+
+    def __init__(self, sink, nframes=None, cycle_time=None, npool=32,
+            shape=None):
+        '''
+        Input:
+            sink: frame sink, or None to only keep the last frame
+            nframes (int): number of frames in a kinetic series, None to
+                run till abort
+            cycle_time (float): kinetic cycle time in seconds
+            npool (int): number of preallocated frames
+            shape (tuple): frame shape, default from the detector size
+                and read mode
+        '''
+
+        if shape is None:
+            shape = get_frame_shape()
+        self._sink = sink
+        self._nframes = nframes
+        self._cycle_time = cycle_time
+        self._shape = tuple(shape)
+
+        self._pool = np.zeros((npool, ) + self._shape, dtype=np.int32)
+        self._free = Queue.Queue()
+        for i in range(npool):
+            self._free.put(i)
+        self._filled = Queue.Queue()
+
+        self._last = None
+        self._nacquired = 0
+        self._nwritten = 0
+        self._ndropped = 0
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        if self._nframes is None:
+            set_acquisition_mode(5)
+        else:
+            set_acquisition_mode(3)
+            set_number_kinetics(self._nframes)
+        if self._cycle_time is not None:
+            set_kinetic_cycle_time(self._cycle_time)
+
+        ret = start_acquisition()
+        if ret != DRV_SUCCESS:
+            raise RuntimeError('Andor StartAcquisition failed: %d' % ret)
+
+        self._stop.clear()
+        self._threads = [
+            threading.Thread(target=self._acquire_loop),
+            threading.Thread(target=self._write_loop),
+        ]
+        for t in self._threads:
+            t.setDaemon(True)
+            t.start()
+
+    def _acquire_loop(self):
+        nextimg = 1
+        try:
+            while not self._stop.isSet():
+                if wait_for_acquisition(0.1):
+                    nextimg = self._retrieve(nextimg)
+                elif get_status() != DRV_ACQUIRING:
+                    break
+
+            self._retrieve(nextimg)
+        finally:
+            self._filled.put(None)
+
+    def _retrieve(self, nextimg):
+        '''Retrieve all new images, return the index of the next one.'''
+
+        new = get_number_new_images()
+        if new is None:
+            return nextimg
+        first, last = new
+        if first > nextimg:
+            self._ndropped += first - nextimg
+        for img in range(max(first, nextimg), last + 1):
+            try:
+                slot = self._free.get_nowait()
+            except Queue.Empty:
+                self._ndropped += 1
+                continue
+            if get_images(img, img, self._pool[slot]) is None:
+                self._free.put(slot)
+                self._ndropped += 1
+                continue
+            self._nacquired += 1
+            self._filled.put(slot)
+        return last + 1
+
+    def _write_loop(self):
+        try:
+            while True:
+                slot = self._filled.get()
+                if slot is None:
+                    break
+                frame = self._pool[slot]
+                if self._sink is not None:
+                    self._sink.append(frame)
+                self._last = frame.copy()
+                self._nwritten += 1
+                self._free.put(slot)
+        finally:
+            if self._sink is not None:
+                self._sink.close()
+
+    def is_running(self):
+        return len([t for t in self._threads if t.isAlive()]) > 0
+
+    def wait(self, timeout=None):
+        '''Wait for a kinetic series to finish; returns True if it did.'''
+        for t in self._threads:
+            t.join(timeout)
+        return not self.is_running()
+
+    def stop(self):
+        '''Abort the acquisition and flush the remaining frames.'''
+        abort_acquisition()
+        self._stop.set()
+        self.wait()
+        if self._ndropped > 0:
+            logging.warning('Andor frame stream dropped %d frames',
+                    self._ndropped)
+
+    def get_last_frame(self):
+        return self._last
+
+    def get_stats(self):
+        '''Return (acquired, written, dropped) frame counts.'''
+        return self._nacquired, self._nwritten, self._ndropped
+
+class _SimulatedAndor:
+    '''
+    Simulated Andor driver producing synthetic frames for the functions
+    used above, pass it to initialize(dll=...). Like the real driver it
+    keeps the last <nbuf> images in a circular buffer.
+    '''
+
+    def __init__(self, xpix=1024, ypix=256, nbuf=64):
+        self._xpix = xpix
+        self._ypix = ypix
+        self._nbuf = nbuf
+        self._readmode = 0
+        self._acqmode = 1
+        self._nkin = 1
+        self._cycle = 0.01
+        self._exposure = 0.01
+        self._start = None
+        self._retrieved = 0
+
+    def _set(name):
+        def func(self, val):
+            setattr(self, name, getattr(val, 'value', val))
+            return DRV_SUCCESS
+        return func
+    SetReadMode = _set('_readmode')
+    SetAcquisitionMode = _set('_acqmode')
+    SetNumberKinetics = _set('_nkin')
+    SetKineticCycleTime = _set('_cycle')
+    SetExposureTime = _set('_exposure')
+    del _set
+
+    def Initialize(self, dir):
+        return DRV_SUCCESS
+
+    def GetDetector(self, xpix, ypix):
+        xpix._obj.value = self._xpix
+        ypix._obj.value = self._ypix
+        return DRV_SUCCESS
+
+    def GetReadMode(self, mode):
+        mode._obj.value = self._readmode
+        return DRV_SUCCESS
+
+    def _framesize(self):
+        if self._readmode == 4:
+            return self._xpix * self._ypix
+        return self._xpix
+
+    def _period(self):
+        if self._acqmode in (3, 5):
+            return max(self._cycle, self._exposure)
+        return self._exposure
+
+    def _nacquired(self):
+        if self._start is None:
+            return 0
+        n = int((time.time() - self._start) / self._period())
+        if self._acqmode == 3:
+            n = min(n, self._nkin)
+        elif self._acqmode != 5:
+            n = min(n, 1)
+        return n
+
+    def StartAcquisition(self):
+        self._start = time.time()
+        self._retrieved = 0
+        self._total = None
+        return DRV_SUCCESS
+
+    def AbortAcquisition(self):
+        if self._start is not None:
+            self._total = self._nacquired()
+        self._start = None
+        return DRV_SUCCESS
+
+    def _count(self):
+        if self._start is None:
+            return getattr(self, '_total', None) or 0
+        return self._nacquired()
+
+    def GetStatus(self, status):
+        n = self._nacquired()
+        if self._start is None or \
+                (self._acqmode != 5 and n >= (self._acqmode == 3 and self._nkin or 1)):
+            status._obj.value = DRV_IDLE
+        else:
+            status._obj.value = DRV_ACQUIRING
+        return DRV_SUCCESS
+
+    def WaitForAcquisitionTimeOut(self, ms):
+        end = time.time() + ms.value / 1000.0
+        while time.time() < end:
+            if self._count() > self._retrieved:
+                return DRV_SUCCESS
+            time.sleep(min(0.001, self._period() / 10))
+        return DRV_NO_NEW_DATA
+
+    def _fill(self, img, ptr):
+        n = self._framesize()
+        frame = np.ctypeslib.as_array((c_int32 * n).from_address(ptr))
+        frame[:] = np.arange(n) % 1000 + img
+        return n
+
+    def GetNumberNewImages(self, first, last):
+        n = self._count()
+        if n <= self._retrieved:
+            return DRV_NO_NEW_DATA
+        first._obj.value = max(self._retrieved + 1, n - self._nbuf + 1)
+        last._obj.value = n
+        return DRV_SUCCESS
+
+    def GetImages(self, first, last, ptr, size, vfirst, vlast):
+        first, last = first.value, last.value
+        n = self._framesize()
+        if size.value < n * (last - first + 1):
+            return DRV_P3INVALID
+        for i, img in enumerate(range(first, last + 1)):
+            self._fill(img, ptr + 4 * n * i)
+        self._retrieved = max(self._retrieved, last)
+        vfirst._obj.value = first
+        vlast._obj.value = last
+        return DRV_SUCCESS
+
+    def GetAcquiredData(self, ptr, size):
+        self._fill(1, ptr)
+        return DRV_SUCCESS
+
+if __name__ == '__main__':
+    import tempfile
+    import os
+
+    initialize(dll=_SimulatedAndor(ypix=64))
+    set_read_mode(4)
+    set_exposure_time(0.001)
+
+    fn = os.path.join(tempfile.gettempdir(), 'andor_stream.npy')
+    sink = NpyStackWriter(fn, get_frame_shape())
+    stream = FrameStream(sink, nframes=200, cycle_time=0.005)
+    start = time.time()
+    stream.start()
+    stream.wait()
+    print 'Kinetic series: %d acquired, %d written, %d dropped in %.2fs' % \
+            (stream.get_stats() + (time.time() - start, ))
+    stack = np.load(fn, mmap_mode='r')
+    print 'Stack shape: %r, frame 10 starts at %d' % (stack.shape, stack[10][0][0])
+
+    stream = FrameStream(None, cycle_time=0.005)
+    stream.start()
+    time.sleep(0.5)
+    stream.stop()
+    print 'Run till abort: %d acquired, %d written, %d dropped' % \
+            stream.get_stats()
@@ -20,8 +20,13 @@ import types
 import numpy
 import logging
 import time
+import threading
 
-nidaq = ctypes.windll.nicaiu
+try:
+    nidaq = ctypes.windll.nicaiu
+except (AttributeError, OSError):
+    logging.warning('NI DAQmx library not available')
+    nidaq = None
 
 int32 = ctypes.c_long
 uInt32 = ctypes.c_ulong
@@ -47,6 +52,8 @@ _config_map = {
 DAQmx_Val_Volts             = 10348
 DAQmx_Val_Rising            = 10280
 DAQmx_Val_FiniteSamps       = 10178
+DAQmx_Val_ContSamps         = 10123
+DAQmx_Val_Acquired_Into_Buffer = 1
 DAQmx_Val_GroupByChannel    = 0
 DAQmx_Val_GroupByScanNumber = 1
 DAQmx_Val_ChanPerLine       = 0
@@ -56,13 +63,19 @@ DAQmx_Val_CountUp           = 10128
 DAQmx_Val_CountDown         = 10124
 DAQmx_Val_ExtControlled     = 10326
 
-def CHK(err):
+# Callback prototype for DAQmxRegisterEveryNSamplesEvent
+EveryNSamplesEventCallback = ctypes.CFUNCTYPE(int32, TaskHandle, int32,
+        uInt32, ctypes.c_void_p)
+
+def CHK(err, dll=None):
     '''Error checking routine'''
 
     if err < 0:
+        if dll is None:
+            dll = nidaq
         buf_size = 100
         buf = ctypes.create_string_buffer('\000' * buf_size)
-        nidaq.DAQmxGetErrorString(err, ctypes.byref(buf), buf_size)
+        dll.DAQmxGetErrorString(err, ctypes.byref(buf), buf_size)
         raise RuntimeError('Nidaq call failed with error %d: %s' % \
             (err, repr(buf.value)))
 
@@ -395,3 +408,393 @@ def write_dig_port8(channel, val, timeout=1.0):
         if taskHandle.value != 0:
             nidaq.DAQmxStopTask(taskHandle)
             nidaq.DAQmxClearTask(taskHandle)
+
+class ContinuousTask:
+    '''
+    A persistent, hardware-timed continuous task.
+
+    Analog input ('AI') and counter ('CI') tasks read every block of
+    <blocksize> samples per channel from a DAQmx callback into a
+    preallocated ring buffer of <nblocks> blocks, from which get_block(),
+    iter_blocks() and stream() consume them. If the consumer falls more
+    than <nblocks> - 1 blocks behind, the oldest blocks are dropped and
+    counted as overruns.
+
+    Analog output ('AO') tasks regenerate the waveform given to start().
+
+    The task stays configured between start() / stop() cycles, call
+    clear() to release it.
+    '''
+
+    def __init__(self, devchan, kind='AI', freq=10000.0, blocksize=1000,
+            nblocks=16, minv=-10.0, maxv=10.0, config=DAQmx_Val_Cfg_Default,
+            src='', clock='', dll=None):
+        '''
+        Input:
+            devchan (string): device/channel specifier, such as Dev1/ai0:3
+            kind (string): 'AI', 'AO' or 'CI'
+            freq (float): the sample clock frequency
+            blocksize (int): number of samples per channel in a block
+            nblocks (int): number of blocks in the ring buffer
+            minv, maxv (float): the voltage range (AI / AO)
+            config (string or int): the terminal configuration (AI)
+            src (string): the input terminal to count edges on (CI)
+            clock (string): the sample clock source, default onboard
+            dll: the DAQmx library to use, default the NI DAQmx DLL
+        '''
+
+        if dll is None:
+            dll = nidaq
+        if dll is None:
+            raise RuntimeError('NI DAQmx library not available')
+        if type(config) is types.StringType:
+            config = _config_map[config]
+
+        self._dll = dll
+        self._kind = kind
+        self._freq = freq
+        self._blocksize = blocksize
+        self._nblocks = nblocks
+        self._task = TaskHandle(0)
+        self._ring = None
+        self._callback = None
+        self._running = False
+
+        self._cond = threading.Condition()
+        self._nwritten = 0
+        self._nread = 0
+        self._noverrun = 0
+        self._error = None
+
+        try:
+            self._create(devchan, minv, maxv, config, src, clock)
+        except:
+            self.clear()
+            raise
+
+    def _chk(self, err):
+        CHK(err, self._dll)
+
+    def _create(self, devchan, minv, maxv, config, src, clock):
+        dll = self._dll
+        self._chk(dll.DAQmxCreateTask("", ctypes.byref(self._task)))
+
+        if self._kind == 'AI':
+            self._chk(dll.DAQmxCreateAIVoltageChan(self._task, devchan, "",
+                config, float64(minv), float64(maxv), DAQmx_Val_Volts, None))
+        elif self._kind == 'AO':
+            self._chk(dll.DAQmxCreateAOVoltageChan(self._task, devchan, "",
+                float64(minv), float64(maxv), DAQmx_Val_Volts, None))
+        elif self._kind == 'CI':
+            self._chk(dll.DAQmxCreateCICountEdgesChan(self._task, devchan, "",
+                DAQmx_Val_Rising, int32(0), DAQmx_Val_CountUp))
+            if src is not None and src != "":
+                self._chk(dll.DAQmxSetCICountEdgesTerm(self._task, devchan, src))
+        else:
+            raise ValueError('Unknown task kind %r' % self._kind)
+
+        nchans = uInt32(0)
+        self._chk(dll.DAQmxGetTaskNumChans(self._task, ctypes.byref(nchans)))
+        self._nchans = nchans.value
+
+        if self._kind == 'AO':
+            return
+
+        self._chk(dll.DAQmxCfgSampClkTiming(self._task, clock,
+            float64(self._freq), DAQmx_Val_Rising, DAQmx_Val_ContSamps,
+            uInt64(self._blocksize * self._nblocks)))
+
+        self._ring = numpy.zeros((self._nblocks, self._nchans,
+            self._blocksize), dtype=numpy.float64)
+        self._callback = EveryNSamplesEventCallback(self._every_n_cb)
+        self._chk(dll.DAQmxRegisterEveryNSamplesEvent(self._task,
+            DAQmx_Val_Acquired_Into_Buffer, uInt32(self._blocksize), 0,
+            self._callback, None))
+
+    def _every_n_cb(self, task, event, nsamples, cbdata):
+        '''Called by DAQmx from its own thread for every block.'''
+
+        slot = self._ring[self._nwritten % self._nblocks]
+        nread = int32(0)
+        if self._kind == 'AI':
+            err = self._dll.DAQmxReadAnalogF64(self._task,
+                int32(self._blocksize), float64(0), DAQmx_Val_GroupByChannel,
+                slot.ctypes.data, uInt32(slot.size), ctypes.byref(nread), None)
+        else:
+            err = self._dll.DAQmxReadCounterF64(self._task,
+                int32(self._blocksize), float64(0), slot.ctypes.data,
+                uInt32(slot.size), ctypes.byref(nread), None)
+
+        self._cond.acquire()
+        try:
+            if err < 0:
+                self._error = err
+            else:
+                self._nwritten += 1
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+        return 0
+
+    def start(self, data=None):
+        '''
+        Start the task. For AO tasks <data> is the waveform to regenerate,
+        an array of shape (nchans, nsamples) or (nsamples,).
+        '''
+
+        if self._kind == 'AO':
+            data = numpy.array(data, dtype=numpy.float64, ndmin=2)
+            nsamples = data.shape[1]
+            self._chk(self._dll.DAQmxCfgSampClkTiming(self._task, "",
+                float64(self._freq), DAQmx_Val_Rising, DAQmx_Val_ContSamps,
+                uInt64(nsamples)))
+            written = int32(0)
+            self._chk(self._dll.DAQmxWriteAnalogF64(self._task,
+                int32(nsamples), 0, float64(10.0), DAQmx_Val_GroupByChannel,
+                data.ctypes.data, ctypes.byref(written), None))
+
+        self._cond.acquire()
+        try:
+            self._nwritten = 0
+            self._nread = 0
+            self._noverrun = 0
+            self._error = None
+        finally:
+            self._cond.release()
+
+        self._chk(self._dll.DAQmxStartTask(self._task))
+        self._running = True
+
+    def stop(self):
+        '''Stop the task, it can be started again.'''
+
+        if self._task.value != 0 and self._running:
+            self._dll.DAQmxStopTask(self._task)
+        self._cond.acquire()
+        self._running = False
+        self._cond.notify_all()
+        self._cond.release()
+
+    def clear(self):
+        '''Stop and release the task.'''
+
+        self.stop()
+        if self._task.value != 0:
+            self._dll.DAQmxClearTask(self._task)
+            self._task = TaskHandle(0)
+
+    def is_running(self):
+        return self._running
+
+    def get_overruns(self):
+        '''Return the number of blocks that were dropped.'''
+        return self._noverrun
+
+    def _next_index(self, timeout):
+        '''
+        Wait for an unread block, skipping overwritten ones, and return its
+        sequence number, or None on timeout / stop. Call with lock held.
+        '''
+
+        end = time.time() + timeout
+        while self._nwritten == self._nread:
+            if self._error is not None:
+                CHK(self._error, self._dll)
+            remaining = end - time.time()
+            if not self._running or remaining <= 0:
+                return None
+            self._cond.wait(remaining)
+
+        # The slot after the newest block may be being overwritten
+        oldest = self._nwritten - self._nblocks + 1
+        if self._nread < oldest:
+            logging.warning('NI DAQ ring buffer overrun, %d blocks lost',
+                    oldest - self._nread)
+            self._noverrun += oldest - self._nread
+            self._nread = oldest
+        return self._nread
+
+    def _get_indexed_block(self, timeout):
+        end = time.time() + timeout
+        while True:
+            self._cond.acquire()
+            try:
+                index = self._next_index(max(end - time.time(), 0))
+            finally:
+                self._cond.release()
+            if index is None:
+                return None, None
+
+            block = self._ring[index % self._nblocks].copy()
+
+            self._cond.acquire()
+            try:
+                self._nread = index + 1
+                # Was the block overwritten while copying?
+                if index >= self._nwritten - self._nblocks + 1:
+                    return index, block
+                self._noverrun += 1
+            finally:
+                self._cond.release()
+
+    def get_block(self, timeout=10.0):
+        '''
+        Return the next block as a (nchans, blocksize) array, or None if
+        no block arrived within <timeout> seconds or the task was stopped.
+        '''
+
+        if self._ring is None:
+            raise ValueError('Cannot read from an output task')
+        return self._get_indexed_block(timeout)[1]
+
+    def iter_blocks(self, nblocks=None, timeout=10.0):
+        '''
+        Yield (times, block) for up to <nblocks> blocks (unlimited if None),
+        until the task is stopped or no block arrives within <timeout>.
+        '''
+
+        if self._ring is None:
+            raise ValueError('Cannot read from an output task')
+
+        i = 0
+        while nblocks is None or i < nblocks:
+            index, block = self._get_indexed_block(timeout)
+            if block is None:
+                return
+            times = (index * self._blocksize + \
+                    numpy.arange(self._blocksize)) / float(self._freq)
+            yield times, block
+            i += 1
+
+    def stream(self, sink, nblocks=None, timeout=10.0):
+        '''
+        Pass blocks to a sink: a Data object gets add_data_point(times,
+        chan0, chan1, ...), other sinks are called as sink(times, block).
+
+        Returns the number of blocks passed.
+        '''
+
+        n = 0
+        for times, block in self.iter_blocks(nblocks, timeout):
+            if hasattr(sink, 'add_data_point'):
+                sink.add_data_point(times, *block)
+            else:
+                sink(times, block)
+            n += 1
+        return n
+
+class _FakeDAQmx:
+    '''
+    Minimal stand-in for the DAQmx library to try ContinuousTask without
+    hardware. Every channel specifier counts as one channel; started tasks
+    produce a ramp, one block per <blocksize> / <freq> seconds.
+    '''
+
+    def __init__(self):
+        self._tasks = {}
+        self._next = 1
+
+    def _get(self, handle):
+        return self._tasks[getattr(handle, 'value', handle)]
+
+    def DAQmxGetErrorString(self, err, buf, size):
+        buf._obj.value = 'Fake DAQmx error'
+        return 0
+
+    def DAQmxCreateTask(self, name, handle):
+        handle._obj.value = self._next
+        self._tasks[self._next] = {'nchans': 0, 'count': 0, 'thread': None}
+        self._next += 1
+        return 0
+
+    def DAQmxCreateAIVoltageChan(self, handle, devchan, *args):
+        self._get(handle)['nchans'] += len(devchan.split(','))
+        return 0
+    DAQmxCreateAOVoltageChan = DAQmxCreateAIVoltageChan
+    DAQmxCreateCICountEdgesChan = DAQmxCreateAIVoltageChan
+
+    def DAQmxSetCICountEdgesTerm(self, *args):
+        return 0
+
+    def DAQmxGetTaskNumChans(self, handle, nchans):
+        nchans._obj.value = self._get(handle)['nchans']
+        return 0
+
+    def DAQmxCfgSampClkTiming(self, handle, clock, freq, edge, mode, n):
+        self._get(handle)['freq'] = freq.value
+        return 0
+
+    def DAQmxRegisterEveryNSamplesEvent(self, handle, event, n, opt, cb, data):
+        t = self._get(handle)
+        t['n'] = n.value
+        t['cb'] = cb
+        return 0
+
+    def DAQmxWriteAnalogF64(self, handle, n, autostart, timeout, fill, data,
+            written, reserved):
+        written._obj.value = n.value
+        return 0
+
+    def _run(self, handle, t):
+        while not t['stop'].isSet():
+            t['stop'].wait(t['n'] / t['freq'])
+            if not t['stop'].isSet():
+                t['cb'](handle, DAQmx_Val_Acquired_Into_Buffer, t['n'], None)
+
+    def DAQmxStartTask(self, handle):
+        t = self._get(handle)
+        t['stop'] = threading.Event()
+        if 'cb' in t:
+            t['thread'] = threading.Thread(target=self._run,
+                    args=(handle.value, t))
+            t['thread'].setDaemon(True)
+            t['thread'].start()
+        return 0
+
+    def DAQmxReadAnalogF64(self, handle, n, timeout, fill, data, size,
+            nread, reserved):
+        t = self._get(handle)
+        arr = numpy.ctypeslib.as_array(
+                (ctypes.c_double * size.value).from_address(data))
+        arr[:] = numpy.arange(t['count'], t['count'] + size.value) \
+                // t['nchans']
+        t['count'] += size.value
+        nread._obj.value = n.value
+        return 0
+
+    def DAQmxReadCounterF64(self, handle, n, timeout, data, size, nread,
+            reserved):
+        return self.DAQmxReadAnalogF64(handle, n, timeout, 0, data, size,
+                nread, reserved)
+
+    def DAQmxStopTask(self, handle):
+        t = self._get(handle)
+        if t.get('stop') is not None:
+            t['stop'].set()
+        if t['thread'] is not None:
+            t['thread'].join()
+            t['thread'] = None
+        return 0
+
+    def DAQmxClearTask(self, handle):
+        self.DAQmxStopTask(handle)
+        del self._tasks[handle.value]
+        return 0
+
+if __name__ == '__main__':
+    dll = _FakeDAQmx()
+    task = ContinuousTask('Dev1/ai0,Dev1/ai1', freq=100000.0, blocksize=1000,
+            nblocks=4, dll=dll)
+    task.start()
+    n = 0
+    for times, block in task.iter_blocks(20):
+        n += 1
+    print 'Read %d blocks of shape %r, %d overruns' % \
+            (n, block.shape, task.get_overruns())
+
+    time.sleep(0.1)
+    block = task.get_block()
+    print 'After sleeping: %d overruns, first sample %r' % \
+            (task.get_overruns(), block[0][0])
+    task.clear()
+    print 'Tasks left: %d' % len(dll._tasks)
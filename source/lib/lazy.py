@@ -0,0 +1,68 @@
+# lazy.py, modules that are imported on first use
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+import sys
+import types
+
+class LazyModule(types.ModuleType):
+    '''
+    Placeholder for a module that is imported on first attribute access,
+    for rarely used subsystems that should not slow down startup.
+
+    Submodules of a package are imported on access as well.
+
+    Example:
+        fit = LazyModule('lib.math.fit')
+        fit.Gaussian(...)   # imports lib.math.fit here
+    '''
+
+    def __init__(self, name):
+        types.ModuleType.__init__(self, name)
+        self.__dict__['_lazy_module'] = None
+
+    def _load(self):
+        mod = self.__dict__['_lazy_module']
+        if mod is None:
+            __import__(self.__name__)
+            mod = sys.modules[self.__name__]
+            self.__dict__['_lazy_module'] = mod
+        return mod
+
+    def __getattr__(self, attr):
+        mod = self._load()
+        try:
+            return getattr(mod, attr)
+        except AttributeError:
+            if not hasattr(mod, '__path__'):
+                raise
+        name = '%s.%s' % (self.__name__, attr)
+        __import__(name)
+        return sys.modules[name]
+
+    def __setattr__(self, attr, val):
+        setattr(self._load(), attr, val)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        if self.__dict__['_lazy_module'] is None:
+            return "<lazy module '%s' (not loaded)>" % self.__name__
+        return repr(self.__dict__['_lazy_module'])
+
+    def is_loaded(self):
+        return self.__dict__['_lazy_module'] is not None
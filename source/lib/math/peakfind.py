@@ -21,6 +21,94 @@ import fit
 FIT_LORENTZIAN = 1
 FIT_GAUSSIAN = 2
 
+def _window_extreme(ydata, halfwidth, func):
+    '''
+    Return func (np.min or np.max) of ydata over a sliding window of
+    2 * halfwidth + 1 points centered on each element, without a Python loop.
+    '''
+    n = len(ydata)
+    padded = np.empty(n + 2 * halfwidth, dtype=float)
+    padded[halfwidth:halfwidth+n] = ydata
+    padded[:halfwidth] = ydata[0]
+    padded[halfwidth+n:] = ydata[-1]
+    stride = padded.strides[0]
+    windows = np.lib.stride_tricks.as_strided(padded,
+            shape=(n, 2 * halfwidth + 1), strides=(stride, stride))
+    return func(windows, axis=1)
+
+def find_candidates(ydata, threshold=3, halfwidth=15, prominence=0,
+        maxpeaks=None, sign=1):
+    '''
+    Locate all peak candidates in ydata in a single vectorized pass.
+
+    A candidate is a local maximum (minimum for sign=-1) that lies more than
+    <threshold> standard deviations from the average, has a prominence of
+    at least <prominence> with respect to the lowest point within
+    <halfwidth> points on either side and is the largest point within
+    <halfwidth> points.
+
+    Returns an array of indices sorted by decreasing peak height.
+    '''
+
+    y = sign * np.asarray(ydata, dtype=float)
+    if len(y) < 3:
+        return np.array([], dtype=int)
+
+    avg = np.average(y)
+    std = np.std(y)
+
+    d = np.diff(y)
+    locs = np.flatnonzero((d[:-1] > 0) & (d[1:] <= 0)) + 1
+    locs = locs[y[locs] >= avg + threshold * std]
+    if len(locs) == 0:
+        return locs
+
+    halfwidth = max(int(halfwidth), 1)
+    wmax = _window_extreme(y, halfwidth, np.max)
+    locs = locs[y[locs] >= wmax[locs]]
+
+    if prominence > 0:
+        wmin = _window_extreme(y, halfwidth, np.min)
+        locs = locs[y[locs] - wmin[locs] >= prominence]
+
+    locs = locs[np.argsort(-y[locs], kind='mergesort')]
+    if maxpeaks is not None:
+        locs = locs[:maxpeaks]
+    return locs
+
+def _fit_window(args):
+    '''
+    Fit a single peak; module level so it can be used with multiprocessing.
+
+    Returns ([position, height, width], fit parameters) or None.
+    '''
+
+    fittype, xdata, ydata, p0, sign = args
+    if fittype == FIT_LORENTZIAN:
+        f = fit.Lorentzian(xdata, ydata)
+    elif fittype == FIT_GAUSSIAN:
+        f = fit.Gaussian(xdata, ydata)
+    else:
+        return None
+
+    p = f.fit(p0)
+    if sign * p[1] < 0:
+        print 'Peak of wrong sign found'
+    h = f.get_height() + sign * p[0]   # Height including background
+    return [p[2], h, f.get_fwhm()], p
+
+def _map(func, jobs, nprocs):
+    if nprocs is None or nprocs <= 1 or len(jobs) <= 1:
+        return map(func, jobs)
+
+    import multiprocessing
+    pool = multiprocessing.Pool(processes=nprocs)
+    try:
+        return pool.map(func, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
 class PeakFinderBase:
 
     def __init__(self, data1, data2=None, **kwargs):
@@ -41,11 +129,18 @@ class PeakFinder(PeakFinderBase):
         - fit: fitting function, FIT_LORENTZIAN or FIT_GAUSSIAN
         - fitwidth: number of data points around maximum to use for fit
         - threshold: the threshold for detecting a peak (# of standard dev.)
+        - prominence: minimum height of a peak above the lowest point within
+        fitwidth / 2 points (default 0, disabled)
+        - nprocs: number of worker processes to fit peaks with (default
+        None, fit in this process)
         '''
 
         self._fit = kwargs.get('fit', FIT_LORENTZIAN)
         self._fitwidth = kwargs.get('fitwidth', 30)
         self._threshold = kwargs.get('threshold', 3)
+        self._prominence = kwargs.get('prominence', 0)
+        self._nprocs = kwargs.get('nprocs', None)
+        self._fits = []
         PeakFinderBase.__init__(self, *args, **kwargs)
 
     def _fit_bg(self, order):
@@ -55,66 +150,91 @@ class PeakFinder(PeakFinderBase):
         p = f.fit(p0)
         return f.func(p)
 
-    def find(self, sign=1, bgorder=0):
+    def _fit_jobs(self, locs, sign):
+        avg = np.average(self._ydata)
+        std = np.std(self._ydata)
+        halfwidth = self._fitwidth // 2
+        jobs = []
+        for loc in locs:
+            mini = max(0, loc - halfwidth)
+            maxi = min(len(self._xdata) - 1, loc + halfwidth)
+            dx = abs((self._xdata[maxi] - self._xdata[mini]) / (maxi - mini))
+            p0 = [avg, sign*3*std, self._xdata[loc], 3 * dx]
+            jobs.append((self._fit, self._xdata[mini:maxi],
+                    self._ydata[mini:maxi], p0, sign))
+        return jobs
+
+    def find(self, sign=1, bgorder=0, plot=False):
         '''
         Return a list of (position, height, width) tuples for all peaks that
         are located.
 
-        sign should be 1 to find peaks, -1 to find valleys
+        All candidates are detected in a single pass, after which every
+        peak is fitted independently (in parallel if nprocs > 1).
+
+        sign should be 1 to find peaks, -1 to find valleys.
+        If plot is True the data and fits are plotted afterwards, see plot().
         '''
 
+        if self._fit not in (FIT_LORENTZIAN, FIT_GAUSSIAN):
+            print 'Unknown fit requested'
+            return
+
         if bgorder > 0:
             bg = self._fit_bg(bgorder)
-            self._ydata -= bg
+            self._ydata = self._ydata - bg
+
+        locs = find_candidates(self._ydata, threshold=self._threshold,
+                halfwidth=self._fitwidth // 2, prominence=self._prominence,
+                maxpeaks=self._maxpeaks, sign=sign)
+        jobs = self._fit_jobs(locs, sign)
+        results = _map(_fit_window, jobs, self._nprocs)
 
-        i = 0
         peaks = []
-        while i < self._maxpeaks:
-            avg = np.average(self._ydata)
-            std = np.std(self._ydata)
-
-            if sign > 0:
-                maxloc = np.argmax(self._ydata)
-                maxval = self._ydata[maxloc]
-                if maxval < avg + self._threshold * std:
-                    break
-            else:
-                maxloc = np.argmin(self._ydata)
-                maxval = self._ydata[maxloc]
-                if maxval > avg - self._threshold * std:
-                    break
-
-            mini = max(0, maxloc - self._fitwidth / 2)
-            maxi = min(len(self._xdata) - 1, maxloc + self._fitwidth / 2)
-            dx = abs((self._xdata[maxi] - self._xdata[mini]) / (maxi - mini))
+        self._fits = []
+        for job, (peak, p) in zip(jobs, results):
+            peaks.append(peak)
+            self._fits.append((job[1], p))
 
-            if self._fit == FIT_LORENTZIAN:
-                f = fit.Lorentzian(self._xdata[mini:maxi], self._ydata[mini:maxi])
-            elif self._fit == FIT_GAUSSIAN:
-                f = fit.Gaussian(self._xdata[mini:maxi], self._ydata[mini:maxi])
-            else:
-                print 'Unknown fit requested'
-                return
+        if plot:
+            self.plot()
 
-            p = f.fit([avg, sign*3*std, self._xdata[maxloc], 3 * dx])
-            pos = p[2]
-            w = f.get_fwhm()
-            if sign * p[1] < 0:
-                print 'Peak of wrong sign found'
-            h = f.get_height() + sign * p[0]   # Height including background
-            peaks.append([pos, h, w])
+        return peaks
 
-            import matplotlib.pyplot as plt
-            plt.plot(self._xdata, self._ydata + 2 * i)
-            plt.plot(f._xdata, f.func(p) + 2 * i)
+    def plot(self):
+        '''
+        Plot the (background subtracted) data and the peak fits of the
+        last call to find() using matplotlib.
+        '''
 
-            w = max(w, dx * 1.1)    # At least dx wide
-            mask = ((self._xdata > (p[2] - w)) & (self._xdata < (p[2] + w)))
-            self._ydata[mask] = avg - sign * std
+        import matplotlib.pyplot as plt
+        if self._fit == FIT_GAUSSIAN:
+            f = fit.Gaussian()
+        else:
+            f = fit.Lorentzian()
 
-            i += 1
+        plt.plot(self._xdata, self._ydata)
+        for xdata, p in self._fits:
+            plt.plot(xdata, f.func(p, xdata))
 
-        return peaks
+def find_peaks_2d(xdata, ydata, sign=1, bgorder=0, nprocs=None, **kwargs):
+    '''
+    Find peaks in every trace (row) of the 2D array ydata, sharing the
+    x axis xdata. Keyword arguments are passed to PeakFinder.
+
+    Traces are processed by <nprocs> worker processes if nprocs > 1.
+    Returns a list with a list of (position, height, width) per trace.
+    '''
+
+    ydata = np.asarray(ydata)
+    jobs = [(xdata, ydata[i], sign, bgorder, kwargs) \
+            for i in range(ydata.shape[0])]
+    return _map(_find_trace, jobs, nprocs)
+
+def _find_trace(args):
+    xdata, ydata, sign, bgorder, kwargs = args
+    p = PeakFinder(xdata, np.array(ydata, dtype=float), **kwargs)
+    return p.find(sign=sign, bgorder=bgorder)
 
 if __name__ == "__main__":
     maxx = 20
@@ -132,6 +252,6 @@ if __name__ == "__main__":
         plt.plot(xdata, ydata)
 
         p = PeakFinder(xdata, ydata, maxpeaks=3)
-        peaks = p.find(sign=sign, bgorder=2)
+        peaks = p.find(sign=sign, bgorder=2, plot=True)
         print 'Peaks at: %r' % (peaks, )
 
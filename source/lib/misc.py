@@ -96,9 +96,8 @@ def usleep(usec):
     '''
     Sleep for usec microseconds.
     '''
-    start = exact_time()
-    while (exact_time() - start) * 1e6 < usec:
-        pass
+    import sleeper
+    sleeper.sleep(usec * 1e-6)
 
 def get_ipython():
     import IPython
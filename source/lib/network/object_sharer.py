@@ -25,6 +25,7 @@ import copy
 import random
 import inspect
 import time
+import threading
 import gobject
 import types
 
@@ -50,6 +51,10 @@ class ObjectSharer():
         self._client_cache = {}
         self.server = None
 
+        # Objects can be created from several threads, e.g. by
+        # Instruments.create_many()
+        self._objects_lock = threading.RLock()
+
         self._last_hid = 0
         self._last_call_id = 0
         self._return_cbs = {}
@@ -65,6 +70,10 @@ class ObjectSharer():
         # Buffers to store partly received packets
         self._buffers = {}
         self._send_queue = {}
+        self._send_lock = threading.RLock()
+
+        # Signals of threads that defer them, see defer_signals()
+        self._deferred = threading.local()
 
     def set_client_timeout(self, timeout):
         '''
@@ -143,23 +152,31 @@ class ObjectSharer():
             return False
 
         objname = object.get_shared_name()
-        if objname in self._objects:
-            if not replace:
-                logging.error('Object with name %s already exists', objname)
-                return False
-            else:
-                logging.info('Object with name %s exists, replacing', objname)
+        self._objects_lock.acquire()
+        try:
+            if objname in self._objects:
+                if not replace:
+                    logging.error('Object with name %s already exists', objname)
+                    return False
+                else:
+                    logging.info('Object with name %s exists, replacing', objname)
 
-        self._objects[objname] = object
-        if objname is not 'root':
-            self._objects['root'].emit('object-added', objname)
+            self._objects[objname] = object
+            if objname is not 'root':
+                self._objects['root'].emit('object-added', objname)
+        finally:
+            self._objects_lock.release()
 
         return True
 
     def remove_object(self, objname):
-        if objname in self._objects:
-            del self._objects[objname]
-            self._objects['root'].emit('object-removed', objname)
+        self._objects_lock.acquire()
+        try:
+            if objname in self._objects:
+                del self._objects[objname]
+                self._objects['root'].emit('object-removed', objname)
+        finally:
+            self._objects_lock.release()
 
     def _get_full_object_name(self, client, objname):
         if ':' in objname:
@@ -388,6 +405,13 @@ class ObjectSharer():
         Process send queue on a per connection basis.
         '''
 
+        self._send_lock.acquire()
+        try:
+            return self._do_process_send_queue()
+        finally:
+            self._send_lock.release()
+
+    def _do_process_send_queue(self):
         for conn in self._send_queue.keys():
             datalist = self._send_queue[conn]
             while len(datalist) > 0:
@@ -420,10 +444,14 @@ class ObjectSharer():
             (dlen&0x00ff0000)>>16, (dlen&0x0000ff00)>>8, (dlen&0x000000ff))
         tosend += data
 
-        if conn not in self._send_queue:
-            self._send_queue[conn] = []
-        self._send_queue[conn].append(tosend)
-        self._process_send_queue()
+        self._send_lock.acquire()
+        try:
+            if conn not in self._send_queue:
+                self._send_queue[conn] = []
+            self._send_queue[conn].append(tosend)
+            self._process_send_queue()
+        finally:
+            self._send_lock.release()
 
     def _call_cb(self, callid, val):
         if callid in self._return_vals:
@@ -533,7 +561,33 @@ class ObjectSharer():
                     del self._callbacks_name[name][index]
                     break
 
+    def defer_signals(self, defer=True):
+        '''
+        Start (or with defer=False stop) buffering the signals emitted by
+        the calling thread, instead of sending them to the clients. This is
+        used for objects created in worker threads. Returns the list of
+        buffered signals, to be passed to emit_deferred() from the main
+        thread.
+        '''
+
+        signals = getattr(self._deferred, 'signals', None)
+        if defer:
+            self._deferred.signals = []
+        else:
+            self._deferred.signals = None
+        return signals
+
+    def emit_deferred(self, signals):
+        '''Send signals buffered by defer_signals() to the clients.'''
+        for objname, signame, args, kwargs in signals:
+            self.emit_signal(objname, signame, *args, **kwargs)
+
     def emit_signal(self, objname, signame, *args, **kwargs):
+        deferred = getattr(self._deferred, 'signals', None)
+        if deferred is not None:
+            deferred.append((objname, signame, args, kwargs))
+            return
+
         logging.debug('Emitting %s(%r, %r) for %s to %d clients',
                 signame, args, kwargs, objname, len(self._clients))
 
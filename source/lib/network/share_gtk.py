@@ -45,6 +45,7 @@ def start_client(host, port=objsh.PORT, nretry=1):
             return handler.client
         except Exception, e:
             logging.warning('Failed to start sharing client: %s', str(e))
+            nretry -= 1
             if nretry > 0:
                 logging.info('Retrying in 2 seconds...')
                 time.sleep(2)
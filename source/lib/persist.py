@@ -0,0 +1,339 @@
+# persist.py, journal for persisted instrument parameter values
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+Store for the values of FLAG_PERSIST instrument parameters.
+
+Every set appends a (instrument, parameter, value) record to a journal
+file and hands it to the operating system immediately, so it survives a
+crash of the process. The file is fsynced in batches from a background
+thread, compacted when it has grown to several records per parameter and
+replayed when the store is opened. A torn record at the end of the file
+(e.g. from a power failure) is detected by its checksum and dropped.
+
+Run the self-test and benchmark from the source directory with
+'python -m lib.persist'. Running this file directly puts lib/ first on
+the path, where lib/math hides the standard math module.
+'''
+
+import os
+import sys
+import zlib
+import time
+import atexit
+import logging
+import threading
+
+# for backward compatibility to python 2.5
+try:
+    import json
+except:
+    import simplejson as json
+
+class PersistStore:
+
+    def __init__(self, filename, sync_interval=0.2, compact_records=10000):
+        '''
+        Open (and replay) the journal <filename>.
+
+        Input:
+            filename (string): journal file
+            sync_interval (float): maximum time in seconds between a set
+                and the fsync of its record
+            compact_records (int): minimum number of records before the
+                journal is compacted
+        '''
+
+        self._filename = filename
+        self._sync_interval = sync_interval
+        self._compact_records = compact_records
+
+        self._values = {}
+        self._nrecords = 0
+        self._lock = threading.Lock()
+        self._dirty = threading.Event()
+        self._closed = False
+
+        validsize = self._replay()
+        self._file = open(self._filename, 'ab')
+        if self._file.tell() != validsize:
+            logging.warning('Dropping %d bytes of incomplete records from %s',
+                    self._file.tell() - validsize, self._filename)
+            self._file.truncate(validsize)
+            self._file.seek(validsize)
+
+        self._thread = threading.Thread(target=self._sync_loop)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def _replay(self):
+        '''Read all valid records, return the size of the valid part.'''
+
+        # A compacted journal is complete before the old one is replaced;
+        # recover it if the process died in between.
+        tmpname = self._filename + '.tmp'
+        if os.path.exists(tmpname):
+            if os.path.exists(self._filename):
+                os.remove(tmpname)
+            else:
+                logging.warning('Recovering compacted journal %s', tmpname)
+                _replace(tmpname, self._filename)
+
+        if not os.path.exists(self._filename):
+            return 0
+
+        f = open(self._filename, 'rb')
+        validsize = 0
+        try:
+            for line in f:
+                rec = _decode(line)
+                if rec is None:
+                    break
+                ins, param, val = rec
+                self._values[(ins, param)] = val
+                self._nrecords += 1
+                validsize += len(line)
+        finally:
+            f.close()
+
+        return validsize
+
+    def get(self, ins, param, default=None):
+        '''Return the stored value of parameter <param> of <ins>.'''
+        return self._values.get((ins, param), default)
+
+    def set(self, ins, param, val):
+        '''
+        Store the value of parameter <param> of instrument <ins>. Values
+        that can not be stored as JSON are logged and skipped.
+        '''
+
+        try:
+            line = _encode(ins, param, val)
+        except (TypeError, ValueError), e:
+            logging.error('Unable to persist %s.%s = %r: %s',
+                    ins, param, val, e)
+            return
+        self._lock.acquire()
+        try:
+            self._values[(ins, param)] = val
+            self._file.write(line)
+            self._file.flush()
+            self._nrecords += 1
+            if self._nrecords > max(self._compact_records,
+                    4 * len(self._values)):
+                self._compact()
+        finally:
+            self._lock.release()
+        self._dirty.set()
+
+    def get_all(self):
+        '''Return a dictionary {(instrument, parameter): value}.'''
+        return dict(self._values)
+
+    def sync(self):
+        '''Write all records to disk now.'''
+
+        self._lock.acquire()
+        try:
+            if not self._closed:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+        finally:
+            self._lock.release()
+
+    def _sync_loop(self):
+        while not self._closed:
+            self._dirty.wait()
+            if self._closed:
+                break
+            self._dirty.clear()
+            # collect records for at most sync_interval before syncing
+            time.sleep(self._sync_interval)
+            self.sync()
+
+    def compact(self):
+        '''Rewrite the journal with only the current value of every key.'''
+
+        self._lock.acquire()
+        try:
+            self._compact()
+        finally:
+            self._lock.release()
+
+    def _compact(self):
+        tmpname = self._filename + '.tmp'
+        f = open(tmpname, 'wb')
+        for (ins, param), val in self._values.iteritems():
+            f.write(_encode(ins, param, val))
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+
+        self._file.close()
+        _replace(tmpname, self._filename)
+        self._file = open(self._filename, 'ab')
+        self._nrecords = len(self._values)
+
+    def close(self):
+        if self._closed:
+            return
+        self.sync()
+        self._closed = True
+        self._dirty.set()
+        self._file.close()
+
+def _replace(src, dst):
+    '''Atomically rename src to dst, replacing dst if it exists.'''
+    if sys.platform != 'win32':
+        os.rename(src, dst)
+        return
+
+    # os.rename() does not replace an existing file on Windows
+    import ctypes
+    MOVEFILE_REPLACE_EXISTING = 0x1
+    MOVEFILE_WRITE_THROUGH = 0x8
+    if not ctypes.windll.kernel32.MoveFileExW(unicode(src), unicode(dst),
+            MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH):
+        raise ctypes.WinError()
+
+def _to_json(val):
+    '''Convert numpy scalars and arrays to the equivalent Python types.'''
+    if hasattr(val, 'tolist'):
+        return val.tolist()
+    raise TypeError('%r is not JSON serializable' % (val, ))
+
+def _encode(ins, param, val):
+    payload = json.dumps([ins, param, val], separators=(',', ':'),
+            default=_to_json)
+    return '%08x %s\n' % (zlib.crc32(payload) & 0xffffffff, payload)
+
+def _decode(line):
+    '''Decode a journal line, return None if it is incomplete or corrupt.'''
+
+    if not line.endswith('\n') or len(line) < 10:
+        return None
+    crc, payload = line[:8], line[9:-1]
+    try:
+        if int(crc, 16) != zlib.crc32(payload) & 0xffffffff:
+            return None
+        return json.loads(payload)
+    except ValueError:
+        return None
+
+def get_store():
+    '''Get the persisted parameter store, next to the config file.'''
+    global _store
+    if _store is None:
+        from lib.config import get_execdir
+        pname = os.path.split(sys.argv[0])[-1]
+        fname = os.path.join(get_execdir(), pname + '.persist')
+        _store = PersistStore(fname)
+        atexit.register(_store.close)
+    return _store
+
+_store = None
+
+def _crash_writer(fn, n):
+    '''Write values and report them, to be killed by the parent.'''
+    store = PersistStore(fn, compact_records=1000)
+    for i in xrange(n):
+        store.set('ins%d' % (i % 10), 'value', i)
+        sys.stdout.write('%d\n' % i)
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    import tempfile
+    import signal
+    import subprocess
+
+    tmpdir = tempfile.mkdtemp()
+
+    # Kill a writer mid-batch, all acknowledged sets should be replayed
+    fn = os.path.join(tmpdir, 'crash.persist')
+    ackfn = os.path.join(tmpdir, 'acked')
+    for attempt in range(5):
+        ackf = open(ackfn, 'w')
+        p = subprocess.Popen([sys.executable, '-c',
+            'import sys; sys.path.insert(0, %r); import persist; '
+            'persist._crash_writer(%r, 10**7)' % \
+                    (os.path.dirname(os.path.abspath(__file__)), fn)],
+            stdout=ackf)
+        time.sleep(0.2 + 0.1 * attempt)
+        os.kill(p.pid, signal.SIGKILL)
+        p.wait()
+        ackf.close()
+        acked = [int(l) for l in open(ackfn).read().split('\n')[:-1]]
+
+        store = PersistStore(fn)
+        last = acked[-1]
+        ok = store.get('ins%d' % (last % 10), 'value') >= last
+        ok = ok and all(store.get('ins%d' % i, 'value') >= last - 9 \
+                for i in range(10))
+        print 'Killed after %d sets, replay consistent: %s' % (len(acked), ok)
+        store.close()
+
+    # A torn record at the end is dropped
+    f = open(fn, 'ab')
+    f.write(_encode('ins0', 'value', -1)[:-5])
+    f.close()
+    store = PersistStore(fn)
+    print 'Torn record dropped: %s' % (store.get('ins0', 'value') != -1)
+    store.set('ins0', 'value', 'after')
+    store.close()
+    print 'Appending after torn record: %s' % \
+            (PersistStore(fn).get('ins0', 'value') == 'after')
+
+    # A compacted journal that was not yet renamed is recovered
+    store = PersistStore(fn)
+    store.compact()
+    store.close()
+    os.rename(fn, fn + '.tmp')
+    store = PersistStore(fn)
+    print 'Recovered compacted journal: %s' % \
+            (store.get('ins0', 'value') == 'after')
+    store.close()
+
+    # numpy values are stored as plain numbers and lists
+    import numpy
+    store = PersistStore(fn)
+    store.set('ins1', 'int', numpy.int32(3))
+    store.set('ins1', 'bool', numpy.bool_(True))
+    store.set('ins1', 'array', numpy.arange(3))
+    store.set('ins1', 'object', object())
+    store.close()
+    store = PersistStore(fn)
+    print 'numpy values: %r' % ([store.get('ins1', k) \
+            for k in ('int', 'bool', 'array', 'object')], )
+    store.close()
+
+    # Benchmark 10^4 sets against rewriting a JSON config for every set
+    store = PersistStore(os.path.join(tmpdir, 'bench.persist'))
+    start = time.time()
+    for i in xrange(10**4):
+        store.set('ins%d' % (i % 20), 'value', i * 0.1)
+    store.close()
+    print 'Journal: 10^4 sets in %.3f s' % (time.time() - start)
+
+    cfg = dict(('persist_ins%d_par%d' % (i, j), 1.0) \
+            for i in range(20) for j in range(10))
+    start = time.time()
+    for i in xrange(10**4):
+        cfg['persist_ins%d_value' % (i % 20)] = i * 0.1
+        f = open(os.path.join(tmpdir, 'bench.cfg'), 'w+')
+        json.dump(cfg, f, indent=4, sort_keys=True)
+        f.close()
+    print 'Config rewrite: 10^4 sets in %.3f s' % (time.time() - start)
@@ -0,0 +1,193 @@
+# sleeper.py, precise sleeping with jitter statistics
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+Hybrid sleeping: a coarse OS wait until shortly before the deadline,
+followed by a busy spin for the remainder.
+
+The OS wait overshoots by an amount that depends on the platform and the
+load (typically 50-100 usec on linux, ~1 msec on windows with a 1 msec
+timer period). The overshoot of every coarse wait is tracked and the spin
+margin is set from it, so the spin only covers a few hundred microseconds.
+
+The requested and actual duration of sleeps can be recorded per call site,
+see record(), get_stats() and print_stats().
+
+Run the benchmark from the source directory with 'python -m lib.sleeper'.
+Running this file directly puts lib/ first on the path, where lib/math
+hides the standard math module.
+'''
+
+import sys
+import time
+import select
+import logging
+from misc import exact_time
+
+_MIN_MARGIN = 50e-6
+_MAX_MARGIN = 2e-3
+
+# estimate of the overshoot of a coarse wait
+_overshoot = 200e-6
+_overshoot_dev = 100e-6
+
+if sys.platform in ['win32', 'cygwin']:
+    # select() does not accept empty lists on windows
+    _os_sleep = time.sleep
+    try:
+        import ctypes
+        # default timer period is 15.6 msec
+        ctypes.windll.winmm.timeBeginPeriod(1)
+    except Exception, e:
+        logging.warning('Unable to set timer period to 1 msec: %s', e)
+else:
+    def _os_sleep(delay):
+        select.select([], [], [], delay)
+
+def get_margin():
+    '''Return the time (in seconds) that is spent spinning before a deadline.'''
+    return min(_MAX_MARGIN, max(_MIN_MARGIN, _overshoot + 3 * _overshoot_dev))
+
+def _coarse_wait(delay):
+    global _overshoot, _overshoot_dev
+
+    start = exact_time()
+    _os_sleep(delay)
+    # preemptions cannot be compensated by spinning, don't let them
+    # inflate the margin
+    err = min(_MAX_MARGIN, exact_time() - start - delay)
+    _overshoot_dev += 0.05 * (abs(err - _overshoot) - _overshoot_dev)
+    _overshoot += 0.05 * (err - _overshoot)
+
+def sleep_until(deadline):
+    '''
+    Sleep until exact_time() >= deadline.
+    '''
+    delay = deadline - exact_time() - get_margin()
+    if delay > 0:
+        _coarse_wait(delay)
+    while exact_time() < deadline:
+        pass
+
+def sleep(delay):
+    '''
+    Sleep for <delay> seconds.
+    '''
+    sleep_until(exact_time() + delay)
+
+def coarse_sleep(delay, deadline=None):
+    '''
+    Sleep for approximately <delay> seconds without spinning, but never
+    beyond <deadline>.
+    '''
+    if deadline is not None:
+        delay = min(delay, deadline - exact_time() - get_margin())
+    if delay > 0:
+        _coarse_wait(delay)
+
+class _JitterStats:
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.max = 0.0
+        self.requested = 0.0
+
+    def add(self, requested, actual):
+        err = actual - requested
+        self.n += 1
+        d = err - self.mean
+        self.mean += d / self.n
+        self.m2 += d * (err - self.mean)
+        self.max = max(self.max, abs(err))
+        self.requested += requested
+
+    def get(self):
+        if self.n > 1:
+            std = (self.m2 / (self.n - 1)) ** 0.5
+        else:
+            std = 0.0
+        return {
+            'n': self.n,
+            'mean_requested': self.requested / self.n,
+            'mean_error': self.mean,
+            'std_error': std,
+            'max_error': self.max,
+        }
+
+_stats = {}
+record_stats = True
+
+def get_call_site(depth=1):
+    '''Return "<file>:<line>" of the caller <depth> frames up.'''
+    f = sys._getframe(depth + 1)
+    return '%s:%d' % (f.f_code.co_filename, f.f_lineno)
+
+def record(site, requested, actual):
+    '''Record a sleep of <actual> seconds for a requested <requested>.'''
+    if not record_stats:
+        return
+    s = _stats.get(site)
+    if s is None:
+        s = _stats[site] = _JitterStats()
+    s.add(requested, actual)
+
+def get_stats():
+    '''
+    Return a dictionary of call site -> dict with keys n, mean_requested,
+    mean_error, std_error and max_error (in seconds).
+    '''
+    return dict((site, s.get()) for site, s in _stats.iteritems())
+
+def reset_stats():
+    _stats.clear()
+
+def print_stats():
+    for site, s in sorted(get_stats().iteritems()):
+        print '%s: n=%d, requested %.3f ms, error %.1f +- %.1f us (max %.1f us)' \
+            % (site, s['n'], s['mean_requested'] * 1e3,
+                s['mean_error'] * 1e6, s['std_error'] * 1e6,
+                s['max_error'] * 1e6)
+
+if __name__ == '__main__':
+    import os
+
+    def cputime():
+        t = os.times()
+        return t[0] + t[1]
+
+    def busy_sleep(delay):
+        start = exact_time()
+        while exact_time() - start < delay:
+            pass
+
+    n = 200
+    for name, func in (('time.sleep', time.sleep), ('busy spin', busy_sleep),
+            ('hybrid', sleep)):
+        for delay in (1e-3, 5e-3, 20e-3):
+            errs = []
+            cpu = cputime()
+            for i in xrange(n):
+                start = exact_time()
+                func(delay)
+                errs.append(exact_time() - start - delay)
+            cpu = (cputime() - cpu) / (n * delay)
+            errs.sort()
+            print '%-10s %2d ms: error median %6.1f us, 99%% %7.1f us, cpu %3.0f%%' \
+                % (name, delay * 1e3, errs[n / 2] * 1e6,
+                    errs[n * 99 / 100] * 1e6, cpu * 100)
+    print 'Spin margin: %.1f us' % (get_margin() * 1e6)
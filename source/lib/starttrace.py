@@ -0,0 +1,177 @@
+# starttrace.py, timing of the qtlab startup
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+'''
+Records the wall time spent in every init script and in every import
+while qtlab starts. Enabled by setting the environment variable
+QTLAB_STARTUP_TRACE to 1 (print a report when startup is finished) or
+to a file name (also write the report in JSON format).
+
+qtlab_shell imports this module right after source/ is added to the
+path and before the first init script runs, so everything imported later
+is traced. To keep that true it should only use the standard library.
+'''
+
+import os
+import sys
+import __builtin__
+from timeit import default_timer as _timer
+
+# for backward compatibility to python 2.5
+try:
+    import json
+except:
+    import simplejson as json
+
+class StartupTracer:
+
+    def __init__(self):
+        self._files = []
+        self._file = None
+        self._file_start = None
+        self._imports = {}
+        self._stack = []
+        self._orig_import = None
+        self._start = _timer()
+        self._end = None
+
+    def install(self):
+        '''Start timing imports.'''
+        if self._orig_import is None:
+            self._orig_import = __builtin__.__import__
+            __builtin__.__import__ = self._import
+
+    def uninstall(self):
+        if self._orig_import is not None:
+            __builtin__.__import__ = self._orig_import
+            self._orig_import = None
+
+    def _import(self, name, globals=None, locals=None, fromlist=None,
+            level=-1):
+        # time spent in nested imports is subtracted from the parent
+        self._stack.append(0.0)
+        mod = None
+        start = _timer()
+        try:
+            mod = self._orig_import(name, globals, locals, fromlist, level)
+            return mod
+        finally:
+            total = _timer() - start
+            nested = self._stack.pop()
+            if len(self._stack) > 0:
+                self._stack[-1] += total
+            key = _get_import_key(name, mod, fromlist)
+            info = self._imports.get(key)
+            if info is None:
+                info = self._imports[key] = [0, 0.0, 0.0]
+            info[0] += 1
+            info[1] += total
+            info[2] += total - nested
+
+    def start_file(self, filename):
+        '''Mark the start of init script <filename>.'''
+        self.end_file()
+        self._file = filename
+        self._file_start = _timer()
+
+    def end_file(self):
+        if self._file is not None:
+            self._files.append((self._file, _timer() - self._file_start))
+            self._file = None
+
+    def finish(self):
+        '''Mark the end of startup and stop timing imports.'''
+        self.end_file()
+        self.uninstall()
+        self._end = _timer()
+
+    def get_report(self):
+        '''
+        Return a dictionary with the total startup time, a list of
+        (init script, time) and a dictionary of imported name ->
+        {'n': calls, 'total': time, 'self': time without nested imports}.
+        '''
+        end = self._end
+        if end is None:
+            end = _timer()
+        imports = {}
+        for name, (n, total, own) in self._imports.iteritems():
+            imports[name] = {'n': n, 'total': total, 'self': own}
+        return {
+            'total': end - self._start,
+            'files': list(self._files),
+            'imports': imports,
+        }
+
+    def print_report(self, nimports=20):
+        report = self.get_report()
+        print 'Startup took %.3f s' % report['total']
+        for filename, t in report['files']:
+            print '  %7.1f ms  %s' % (t * 1e3, filename)
+        print 'Slowest imports (excluding nested imports):'
+        items = report['imports'].items()
+        items.sort(key=lambda x: -x[1]['self'])
+        for name, info in items[:nimports]:
+            print '  %7.1f ms  %s (%.1f ms including nested)' % \
+                (info['self'] * 1e3, name, info['total'] * 1e3)
+
+    def dump(self, filename):
+        '''Write the report to <filename> in JSON format.'''
+        f = open(filename, 'w')
+        try:
+            json.dump(self.get_report(), f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+
+def _get_import_key(name, mod, fromlist):
+    '''Return the full name of an import, also for relative imports.'''
+    modname = getattr(mod, '__name__', None)
+    if modname is None:
+        return name
+    if name == '':
+        # from . import <fromlist>
+        return '%s.%s' % (modname, ','.join(fromlist or ()))
+    if modname.endswith('.' + name):
+        return modname
+    return name
+
+_tracer = None
+
+def get_tracer():
+    '''Return the startup tracer, or None if tracing is not enabled.'''
+    return _tracer
+
+def start():
+    '''Start tracing if requested in the environment.'''
+    global _tracer
+    if _tracer is None and os.environ.get('QTLAB_STARTUP_TRACE'):
+        _tracer = StartupTracer()
+        _tracer.install()
+    return _tracer
+
+def finish():
+    '''Stop tracing and report.'''
+    if _tracer is None:
+        return
+    _tracer.finish()
+    _tracer.print_report()
+    dest = os.environ.get('QTLAB_STARTUP_TRACE')
+    if dest not in ('1', 'yes', 'true'):
+        try:
+            _tracer.dump(dest)
+        except IOError, e:
+            print 'Unable to write startup trace to %s: %s' % (dest, e)
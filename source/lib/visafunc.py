@@ -17,6 +17,9 @@
 
 import time
 import logging
+import struct
+import warnings
+import numpy
 try:
     from visa import *
     from pyvisa import vpp43
@@ -68,3 +71,177 @@ def read_all(visains):
 
     return buf
 
+
+def parse_binary_block(data, dtype):
+    """
+    Decode the binary block in data into a numpy array with elements of
+    type dtype (e.g. '>f4'), using a single numpy.frombuffer call.
+
+    Supported headers are IEEE-488.2 definite (#<n><length>) and
+    indefinite (#0) length blocks and the HP '#A<2 byte length>' format.
+    An indefinite length block extends to the end of data, truncated to
+    whole elements so that a trailing terminator is dropped.
+    """
+
+    i = data.find('#')
+    if i == -1 or len(data) < i + 2:
+        raise ValueError('No binary block header found')
+
+    dtype = numpy.dtype(dtype)
+    if data[i+1] == 'A':
+        nbytes = struct.unpack('>H', data[i+2:i+4])[0]
+        start = i + 4
+    else:
+        ndigits = int(data[i+1])
+        start = i + 2 + ndigits
+        if ndigits == 0:
+            nbytes = len(data) - start
+            nbytes -= nbytes % dtype.itemsize
+        else:
+            nbytes = int(data[i+2:start])
+
+    if start + nbytes > len(data):
+        raise ValueError('Binary block truncated (%d of %d bytes)' % \
+                (len(data) - start, nbytes))
+
+    return numpy.frombuffer(data, dtype=dtype, count=nbytes / dtype.itemsize,
+            offset=start)
+
+def read_binary_block(readn, nbytes=None, readall=None):
+    """
+    Read an IEEE-488.2 definite (#<n><length>) or indefinite (#0) length
+    block, or an HP '#A' block, using readn(n), which should return exactly
+    n bytes. Returns the raw block including its header, for
+    parse_binary_block(). Data bytes are never interpreted as termination
+    characters.
+
+    The length of a #0 block is not in its header: nbytes bytes are read
+    if given (e.g. known from the number of points), otherwise readall()
+    should return the rest of the message, up to END.
+
+    A terminator following the block is not read, except by readall().
+    """
+
+    c = readn(1)
+    while c != '#':
+        if c not in ' \t\r\n':
+            raise ValueError('No binary block header found')
+        c = readn(1)
+
+    c = readn(1)
+    if c == 'A':
+        header = readn(2)
+        nbytes = struct.unpack('>H', header)[0]
+    elif c in '123456789':
+        header = readn(int(c))
+        nbytes = int(header)
+    elif c == '0':
+        header = ''
+        if nbytes is None:
+            if readall is None:
+                raise ValueError('Length of indefinite block #0 unknown')
+            return '#0' + readall()
+    else:
+        raise ValueError('Unsupported binary block header #%s' % c)
+
+    return '#' + c + header + readn(nbytes)
+
+class _VisaReader:
+    """
+    Read exactly n bytes at a time from a pyvisa instrument, with
+    termination characters disabled until close() is called. The end
+    attribute tells whether END was received with the last byte.
+    """
+
+    def __init__(self, visains):
+        self._vi = visains.vi
+        self._termchar_en = vpp43.get_attribute(self._vi,
+                vpp43.VI_ATTR_TERMCHAR_EN)
+        vpp43.set_attribute(self._vi, vpp43.VI_ATTR_TERMCHAR_EN,
+                vpp43.VI_FALSE)
+        self.end = False
+
+    def readn(self, n):
+        buf = ''
+        while len(buf) < n:
+            with warnings.catch_warnings(record=True) as w:
+                warnings.simplefilter('always')
+                buf += vpp43.read(self._vi, n - len(buf))
+            self.end = not any(['VI_SUCCESS_MAX_CNT' in str(i.message) \
+                    for i in w])
+            if self.end and len(buf) < n:
+                raise ValueError('Reply truncated (%d of %d bytes)' % \
+                        (len(buf), n))
+        return buf
+
+    def readall(self):
+        '''Read up to and including END.'''
+        buf = ''
+        self.end = False
+        while not self.end:
+            with warnings.catch_warnings(record=True) as w:
+                warnings.simplefilter('always')
+                buf += vpp43.read(self._vi, 65536)
+            self.end = not any(['VI_SUCCESS_MAX_CNT' in str(i.message) \
+                    for i in w])
+        return buf
+
+    def close(self):
+        vpp43.set_attribute(self._vi, vpp43.VI_ATTR_TERMCHAR_EN,
+                self._termchar_en)
+
+def read_bytes(visains, n):
+    """
+    Read exactly n bytes from visains, without interpreting data bytes as
+    termination characters. Uses read_raw(n) on instruments providing it
+    (TCP/IP, Prologix) and VISA otherwise.
+    """
+
+    if not hasattr(visains, 'vi'):
+        return visains.read_raw(n)
+
+    reader = _VisaReader(visains)
+    try:
+        return reader.readn(n)
+    finally:
+        reader.close()
+
+def _visa_read_block(visains, nbytes=None):
+    """
+    Read a binary block from a pyvisa instrument, see read_binary_block().
+    The message terminator is consumed if the device did not assert END on
+    the last data byte.
+    """
+
+    reader = _VisaReader(visains)
+    try:
+        data = read_binary_block(reader.readn, nbytes=nbytes,
+                readall=reader.readall)
+        if not reader.end:
+            visains.read_raw()
+    finally:
+        reader.close()
+
+    return data
+
+def ask_binary_block(visains, cmd, dtype, count=None):
+    """
+    Send cmd to visains and decode the binary block reply, see
+    parse_binary_block(). The block is read by its length, on instruments
+    providing read_raw(n) (TCP/IP, Prologix) or through VISA otherwise.
+
+    count is the expected number of elements, needed to read an
+    indefinite length (#0) block except through VISA, where it is read
+    up to END otherwise.
+    """
+
+    nbytes = None
+    if count is not None:
+        nbytes = count * numpy.dtype(dtype).itemsize
+
+    visains.write(cmd)
+    if hasattr(visains, 'vi'):
+        data = _visa_read_block(visains, nbytes=nbytes)
+    else:
+        data = read_binary_block(visains.read_raw, nbytes=nbytes)
+    return parse_binary_block(data, dtype)
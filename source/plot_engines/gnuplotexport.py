@@ -0,0 +1,253 @@
+# gnuplotexport.py, export of gnuplot plots by background gnuplot processes
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+'''
+Pool of gnuplot processes that render plots to files, so that exporting
+many plots does not block the gnuplot instances of the live session.
+
+A job is a snapshot of a plot: its property commands, its plot command
+(with full data file paths) and the terminal and path to write to. Data
+in temporary files, which are rewritten by the live session, is copied
+when the job is created.
+'''
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import Queue
+import logging
+import gobject
+
+from lib.config import get_config
+from lib.network.object_sharer import SharedGObject
+import gnuplotpipe
+
+config = get_config()
+
+class ExportJob:
+
+    def __init__(self, plotname, terminal, filepath, commands, plotcmd,
+            tempfiles=None):
+        self.id = None
+        self.plotname = plotname
+        self.terminal = terminal
+        self.filepath = filepath
+        self.commands = commands
+        self.plotcmd = plotcmd
+        self.tempfiles = list(tempfiles or [])
+        self.success = None
+        self.output = ''
+
+    def get_commands(self):
+        '''Return the commands to render the plot.'''
+        return 'reset\n%sset terminal %s\nset output "%s"\n%s\nset output\n' % \
+            (self.commands, self.terminal, self.filepath, self.plotcmd)
+
+    def cleanup(self):
+        for fn in self.tempfiles:
+            try:
+                os.remove(fn)
+            except OSError, e:
+                logging.warning('Unable to remove %s: %s', fn, e)
+        self.tempfiles = []
+
+def create_job(plotname, terminal, filepath, commands, plotcmd, datapaths):
+    '''
+    Create an export job for plot <plotname> to be rendered with terminal
+    <terminal> to <filepath>. <commands> are the commands for the plot
+    properties, <plotcmd> the plot command and <datapaths> the data files
+    it refers to; those in the temporary directory are copied.
+    '''
+
+    tempfiles = []
+    tempdir = config.get('tempdir', None)
+    for path in datapaths:
+        if not tempdir or not path.startswith(tempdir) or \
+                not os.path.exists(path):
+            continue
+        fd, copy = tempfile.mkstemp(suffix=os.path.splitext(path)[1],
+                dir=tempdir)
+        os.close(fd)
+        shutil.copyfile(path, copy)
+        tempfiles.append(copy)
+        plotcmd = plotcmd.replace('"%s"' % path.replace('\\', '/'),
+                '"%s"' % copy.replace('\\', '/'))
+
+    return ExportJob(plotname, terminal, filepath.replace('\\', '/'),
+            commands, plotcmd, tempfiles)
+
+class ExportPool(SharedGObject):
+    '''
+    Renders export jobs with <nworkers> gnuplot processes. The processes
+    are started when the first job is queued.
+
+    Signals:
+        job-done (job id, file path, success)
+        progress (number of jobs done, number of jobs queued in total)
+    '''
+
+    __gsignals__ = {
+        'job-done': (gobject.SIGNAL_RUN_FIRST,
+                    gobject.TYPE_NONE,
+                    ([gobject.TYPE_PYOBJECT, gobject.TYPE_PYOBJECT,
+                        gobject.TYPE_PYOBJECT])),
+        'progress': (gobject.SIGNAL_RUN_FIRST,
+                    gobject.TYPE_NONE,
+                    ([gobject.TYPE_PYOBJECT, gobject.TYPE_PYOBJECT])),
+    }
+
+    def __init__(self, nworkers=4, timeout=60):
+        SharedGObject.__init__(self, 'gnuplot_export')
+        self._nworkers = nworkers
+        self._timeout = timeout
+        self._queue = Queue.Queue()
+        self._workers = []
+        self._cond = threading.Condition()
+        self._last_id = 0
+        self._ndone = 0
+        self._ntotal = 0
+        self._failed = []
+
+    def submit(self, job):
+        '''Queue an ExportJob, return its id.'''
+
+        self._cond.acquire()
+        try:
+            self._last_id += 1
+            job.id = self._last_id
+            self._ntotal += 1
+        finally:
+            self._cond.release()
+
+        self._start_workers()
+        self._queue.put(job)
+        return job.id
+
+    def _start_workers(self):
+        while len(self._workers) < self._nworkers:
+            t = threading.Thread(target=self._worker_loop)
+            t.setDaemon(True)
+            t.start()
+            self._workers.append(t)
+
+    def _open_gnuplot(self):
+        # No windows for the export processes
+        return gnuplotpipe.GnuplotPipe(termtitle='export',
+                default_terminal=('unknown', ''))
+
+    def _worker_loop(self):
+        gp = None
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+
+            try:
+                if gp is None:
+                    gp = self._open_gnuplot()
+                gp.flush_output()
+                job.output = gp.cmd(job.get_commands(), retoutput=True,
+                        timeout=self._timeout)
+                if not gp.is_alive():
+                    job.output += 'gnuplot exited'
+                    job.success = False
+                elif gp.is_busy():
+                    job.output += 'timed out'
+                    job.success = False
+                else:
+                    job.success = os.path.exists(job.filepath)
+                if not job.success:
+                    gp.close_gnuplot()
+                    gp = None
+            except Exception, e:
+                logging.warning('Export of plot %s failed: %s',
+                        job.plotname, e)
+                job.success = False
+            job.cleanup()
+
+            if not job.success:
+                logging.warning('Exporting plot %s to %s failed: %s',
+                        job.plotname, job.filepath, job.output)
+
+            self._cond.acquire()
+            try:
+                self._ndone += 1
+                if not job.success:
+                    self._failed.append((job.id, job.filepath))
+                ndone, ntotal = self._ndone, self._ntotal
+                self._cond.notifyAll()
+            finally:
+                self._cond.release()
+
+            gobject.idle_add(self._emit_done, job.id, job.filepath,
+                    job.success, ndone, ntotal)
+
+        if gp is not None:
+            gp.close_gnuplot()
+
+    def _emit_done(self, jobid, filepath, success, ndone, ntotal):
+        self.emit('job-done', jobid, filepath, success)
+        self.emit('progress', ndone, ntotal)
+        return False
+
+    def get_progress(self):
+        '''Return (number of jobs done, number of jobs queued in total).'''
+        return (self._ndone, self._ntotal)
+
+    def get_failed(self):
+        '''Return list of (job id, file path) of failed jobs.'''
+        return list(self._failed)
+
+    def wait(self, timeout=None):
+        '''
+        Wait until all queued jobs are done, at most <timeout> seconds.
+        Returns True if all jobs are done.
+        '''
+
+        self._cond.acquire()
+        try:
+            if timeout is not None:
+                end = time.time() + timeout
+            while self._ndone < self._ntotal:
+                if timeout is None:
+                    self._cond.wait(1.0)
+                else:
+                    remaining = end - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            return self._ndone >= self._ntotal
+        finally:
+            self._cond.release()
+
+    def close(self):
+        '''Stop the worker processes after the queued jobs are done.'''
+        for t in self._workers:
+            self._queue.put(None)
+        for t in self._workers:
+            t.join()
+        self._workers = []
+
+_pool = None
+def get_export_pool():
+    '''Return the export pool, config['gnuplot_export_workers'] processes.'''
+    global _pool
+    if _pool is None:
+        _pool = ExportPool(nworkers=config.get('gnuplot_export_workers', 4))
+    return _pool
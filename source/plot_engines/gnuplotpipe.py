@@ -18,11 +18,10 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import subprocess
-import select
 import re
 import time
-import ctypes
 import logging
+import threading
 import sys
 import types
 import os
@@ -35,58 +34,16 @@ def on_windows():
 def is_64bit_windows():
     return 'PROGRAMFILES(X86)' in os.environ
 
-class WinPipe():
-    '''
-    Class to perform line-based, non-blocking reads from a win32 file.
-    '''
-
-    def __init__(self, fd):
-        self._peek_named_pipe = ctypes.windll.kernel32.PeekNamedPipe
-
-        self._fd = fd
-        self._buf = ''
-        self._maxsize = 1024
-
-    def _get_buffer(self):
-        try:
-            import msvcrt
-            handle = msvcrt.get_osfhandle(self._fd.fileno())
-            avail = ctypes.c_ulong(0)
-            self._peek_named_pipe(handle, None, 0, None, ctypes.byref(avail), None)
-            avail = avail.value
-            avail = min(avail, self._maxsize)
-            if avail > 0:
-                data = self._fd.read(avail)
-                self._buf += data
-                return True
-            return False
-        except Exception, e:
-            print 'Error: %s' % str(e)
-            return False
-
-    def readline(self, timeout=0):
-        '''Return a \n terminated line, if available.'''
-
-        start = time.time()
-        firsttime = True
-
-        while firsttime or (time.time() - start) < timeout:
-            self._get_buffer()
-            index = self._buf.find('\n')
-            if index != -1:
-                ret = self._buf[:index]
-                self._buf = self._buf[index+1:]
-                ret = ret.rstrip('\r\n')
-                ret += '\n'
-                return ret
-            firsttime = False
-            time.sleep(timeout / 10.0)
-
-        return None
-
 class GnuplotPipe():
     '''
     Class for a two-way pipe interface with gnuplot.
+
+    Commands are buffered and written in a single write, either immediately
+    or, between start_batch() and end_batch(), when the batch ends. Every
+    write is followed by a 'print "__QTLAB_<n>__"' sentinel. A reader thread
+    collects gnuplot's output and uses the sentinels to hand the output of a
+    command to the caller waiting for it, and to keep track of which
+    commands gnuplot has finished.
     '''
 
     _RE_TERMINAL = re.compile('terminal type is (\w*) (.*)')
@@ -100,6 +57,10 @@ class GnuplotPipe():
     _RE_RANGE = re.compile('set .*range \[ (.*) : (.*) \] .*\n')
     _RE_LOG = re.compile('(\w+) \(base ([^\)]*)\)')
     _RE_LABEL = re.compile('.*label is "[\"]"')
+    _RE_SENTINEL = re.compile('^__QTLAB_(\d+)__\s*$')
+
+    # Maximum number of lines of output not requested by a command
+    MAX_OUTPUT_LINES = 1000
 
     def __init__(self, termtitle='QTGnuplot', persist=False, noraise=True,
                     default_terminal=None):
@@ -108,6 +69,16 @@ class GnuplotPipe():
         self._noraise = noraise
         self._reopen_cb = None
         self._popen = None
+        self._reader = None
+
+        self._wbuf = []
+        self._batch = 0
+        self._cond = threading.Condition()
+        self._sent = 0
+        self._acked = 0
+        self._replies = {}
+        self._output = []
+        self._eof = False
 
         if type(default_terminal) in (types.StringType, types.UnicodeType):
             self._default_terminal = (default_terminal, '')
@@ -132,9 +103,16 @@ class GnuplotPipe():
         except:
             pass
         self._popen.stdin.close()
-        self._popen.stdout.close()
-        self._popen.stderr.close()
         self._popen.wait()
+        # the reader thread stops at end of file
+        if self._reader is not None:
+            self._reader.join(1.0)
+            self._reader = None
+        try:
+            self._popen.stdout.close()
+            self._popen.stderr.close()
+        except IOError, e:
+            logging.debug('Unable to close gnuplot pipes: %s', str(e))
         self._popen = None
 
     def _open_gnuplot(self):
@@ -150,8 +128,20 @@ class GnuplotPipe():
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE)
 
-        if subprocess.mswindows:
-            self._winpipe = WinPipe(self._popen.stderr)
+        # Replies to commands sent to a previous instance will not arrive
+        self._cond.acquire()
+        try:
+            self._wbuf = []
+            self._acked = self._sent
+            self._output = []
+            self._eof = False
+        finally:
+            self._cond.release()
+
+        self._reader = threading.Thread(target=self._read_loop,
+                args=(self._popen.stderr, ))
+        self._reader.setDaemon(True)
+        self._reader.start()
 
         self._wait_start()
 
@@ -171,87 +161,194 @@ class GnuplotPipe():
         if self._reopen_cb:
             self._reopen_cb(self)
 
-    def _wait_start(self):
-        for i in range(50):
-            if not self.is_alive():
-                time.sleep(DEFAULT_TIMEOUT)
-            else:
-                if self.is_responding(timeout=DEFAULT_TIMEOUT):
-                    return True
+    def _wait_start(self, timeout=50*DEFAULT_TIMEOUT):
+        if self.is_responding(timeout=timeout):
+            return True
 
         logging.warning('Gnuplot start timed out!')
         return False
 
+    def _read_loop(self, f):
+        '''Read gnuplot output (on stderr) until the pipe is closed.'''
+
+        lines = []
+        while True:
+            try:
+                line = f.readline()
+            except (IOError, ValueError):
+                break
+            if line == '':
+                break
+
+            m = self._RE_SENTINEL.match(line)
+            if m is None:
+                lines.append(line.rstrip('\r\n') + '\n')
+                continue
+
+            n = int(m.group(1))
+            self._cond.acquire()
+            try:
+                self._acked = max(self._acked, n)
+                if n in self._replies:
+                    self._replies[n] = ''.join(lines)
+                else:
+                    self._output.extend(lines)
+                    del self._output[:-self.MAX_OUTPUT_LINES]
+                self._cond.notifyAll()
+            finally:
+                self._cond.release()
+            lines = []
+
+        # gnuplot exited, don't wait for replies
+        self._cond.acquire()
+        try:
+            if self._popen is not None and self._popen.stderr is f:
+                self._eof = True
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
     def is_alive(self):
         '''Check whether the gnuplot instance is alive.'''
         return self._popen.poll() == None
 
-    if subprocess.mswindows:
-        def readline(self, timeout=0):
-            line = self._winpipe.readline(timeout)
-            return line
-
-    else:
-        def readline(self, timeout=0):
-            rlist = [self._popen.stderr]
-            elist = []
-            lists = select.select(rlist, elist, elist, timeout)
-            if len(lists[0]) == 0:
-                return None
-            line = self._popen.stderr.readline()
-            return line
-
     def get_output(self, timeout=DEFAULT_TIMEOUT):
-        '''Read output from gnuplot, waiting at most <timeout> seconds.'''
+        '''
+        Return output from gnuplot that was not requested by a command,
+        waiting at most <timeout> seconds if there is none.
+        '''
 
         if not self._popen:
             return None
 
-        ret = ''
-        i = 0
-        while i < 1000:
-            line = self.readline(timeout)
-            if line is None:
-                break
-            ret += line
-            i += 1
+        self._cond.acquire()
+        try:
+            if len(self._output) == 0 and timeout > 0:
+                self._cond.wait(timeout)
+            ret = ''.join(self._output)
+            self._output = []
+        finally:
+            self._cond.release()
 
         return ret
 
     def flush_output(self, timeout=0):
-        '''Flush gnuplot stdout.'''
+        '''Discard gnuplot output that was not requested by a command.'''
         self.get_output(timeout)
 
-    def cmd(self, cmd, retoutput=False, timeout=DEFAULT_TIMEOUT, retry=True):
-        '''Execute a gnuplot command, optionally returning output.'''
+    def start_batch(self):
+        '''Buffer commands until end_batch() is called.'''
+        self._batch += 1
 
-        # End with newline
-        if len(cmd) > 0 and cmd[-1] != '\n':
-            cmd += '\n'
+    def end_batch(self):
+        '''Write the commands buffered since start_batch().'''
+        self._batch -= 1
+        if self._batch <= 0:
+            self._batch = 0
+            self.flush()
+
+    def flush(self, reply=False, retry=True):
+        '''
+        Write buffered commands followed by a sentinel, return the sentinel
+        number. If <reply> is True the output of the commands is kept for
+        _wait_reply().
+        '''
+
+        if len(self._wbuf) == 0 and not reply:
+            return None
+
+        self._cond.acquire()
+        try:
+            self._sent += 1
+            n = self._sent
+            if reply:
+                self._replies[n] = None
+        finally:
+            self._cond.release()
+
+        cmds = self._wbuf
+        self._wbuf = []
+        data = ''.join(cmds) + 'print "__QTLAB_%d__"\n' % n
 
         try:
-            if retoutput:
-                self.flush_output()
             if not self._popen:
                 self._open_gnuplot()
-            ret = self._popen.stdin.write(cmd)
-            if retoutput:
-                return self.get_output(timeout)
+            self._popen.stdin.write(data)
         except IOError, e:
+            self._cond.acquire()
+            try:
+                self._replies.pop(n, None)
+            finally:
+                self._cond.release()
             if retry:
                 logging.error('Gnuplot communication failed; reopening')
                 self._open_gnuplot()
-                self.cmd(cmd, retoutput=retoutput, timeout=timeout, retry=False)
+                self._wbuf.extend(cmds)
+                return self.flush(reply=reply, retry=False)
             else:
                 logging.error('Gnuplot communication failed but not reopening')
 
+        return n
+
+    def _wait_reply(self, n, timeout):
+        '''
+        Wait at most <timeout> seconds for the output of the commands
+        written with sentinel <n>. Returns None if it did not arrive.
+        '''
+
+        end = time.time() + timeout
+        self._cond.acquire()
+        try:
+            while self._replies.get(n) is None and not self._eof:
+                remaining = end - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return self._replies.pop(n, None)
+        finally:
+            self._cond.release()
+
+    def cmd(self, cmd, retoutput=False, timeout=DEFAULT_TIMEOUT, retry=True,
+            defer=False):
+        '''
+        Execute a gnuplot command, optionally returning output. If <defer>
+        is True the command is only buffered, it is written together with
+        the next command that is not deferred or by flush().
+        '''
+
+        # End with newline
+        if len(cmd) > 0 and cmd[-1] != '\n':
+            cmd += '\n'
+        self._wbuf.append(cmd)
+
+        if retoutput:
+            n = self.flush(reply=True, retry=retry)
+            ret = self._wait_reply(n, timeout)
+            if ret is None:
+                logging.debug('No reply from gnuplot within %.3f s', timeout)
+                return ''
+            return ret
+
+        if self._batch == 0 and not defer:
+            self.flush(retry=retry)
         return None
 
     def is_responding(self, timeout=DEFAULT_TIMEOUT):
         '''Check whether gnuplot is responding within <timeout> seconds.'''
-        self.flush_output()
-        ret = self.cmd('print 0', True, timeout)
-        if ret != '0\n':
+        n = self.flush(reply=True)
+        return self._wait_reply(n, timeout) is not None
+
+    def is_busy(self):
+        '''
+        Return whether gnuplot is still processing commands. This does not
+        wait for gnuplot; if the gnuplot process died it is restarted.
+        '''
+
+        if self._acked >= self._sent or self._popen is None:
+            return False
+        if not self.is_alive():
+            logging.error('Gnuplot died; reopening')
+            self._open_gnuplot()
             return False
         return True
 
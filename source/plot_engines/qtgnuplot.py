@@ -30,6 +30,7 @@ from lib.network.object_sharer import cache_result
 import plot
 
 import gnuplotpipe
+import gnuplotexport
 
 class _GnuPlotList(NamedList):
 
@@ -165,9 +166,10 @@ class _QTGnuPlot():
     def set_property(self, name, val, update=False, **kwargs):
         '''Set a plot property value.'''
 
+        # Written together with the next update
         cmd = self.create_command(name, val, **kwargs)
         if cmd is not None and cmd != '':
-            self.cmd(cmd)
+            self.cmd(cmd, defer=True)
         return plot.Plot.set_property(self, name, val, update=update)
 
     def get_commands(self):
@@ -180,10 +182,14 @@ class _QTGnuPlot():
         return cmd
 
     def reset(self):
-        self.cmd('reset')
-        self.cmd('clear')
-        self.cmd(self.get_commands())
-        self.update()
+        self._gnuplot.start_batch()
+        try:
+            self.cmd('reset')
+            self.cmd('clear')
+            self.cmd(self.get_commands())
+            self.update()
+        finally:
+            self._gnuplot.end_batch()
 
     def clear(self):
         '''Clear the plot.'''
@@ -236,12 +242,15 @@ class _QTGnuPlot():
 
         return filepath
 
-    def save_as_type(self, terminal, extension, filepath=None, **kwargs):
+    def save_as_type(self, terminal, extension, filepath=None,
+            background=False, **kwargs):
         '''
         Save a different version of the plot.
 
         kwargs:
             filepath (path)     :       filepath to save to
+            background (bool)   :       render in the export pool, returns
+                                        the job id
             add_suffix (string) :       filename suffix
             autosuffix (bool)   :       auto increment suffix
             append_graphname    :       add graphname to filename
@@ -251,13 +260,28 @@ class _QTGnuPlot():
         # Fix GnuPlot on windows issue
         filepath = filepath.replace('\\', '/')
 
-        self.update()
-        self._gnuplot.set_terminal(terminal)
-        self._gnuplot.cmd('set output "%s"' % filepath)
-        self._gnuplot.cmd('replot')
-        self._gnuplot.reset_default_terminal()
-        self._gnuplot.cmd('set output')
-        self._gnuplot.cmd('replot')
+        if background:
+            job = self._create_export_job(terminal, filepath)
+            return gnuplotexport.get_export_pool().submit(job)
+
+        self._gnuplot.start_batch()
+        try:
+            self.update()
+            self._gnuplot.set_terminal(terminal)
+            self._gnuplot.cmd('set output "%s"' % filepath)
+            self._gnuplot.cmd('replot')
+            self._gnuplot.reset_default_terminal()
+            self._gnuplot.cmd('set output')
+            self._gnuplot.cmd('replot')
+        finally:
+            self._gnuplot.end_batch()
+
+    def _create_export_job(self, terminal, filepath):
+        datapaths = [d['data'].get_filepath() for d in self._data \
+                if 'data' in d]
+        return gnuplotexport.create_job(self.get_name(), terminal, filepath,
+                self.get_commands(), self.create_plot_command(fullpath=True),
+                datapaths)
 
     @cache_result
     def get_save_as_types(self):
@@ -275,7 +299,7 @@ class _QTGnuPlot():
 
         fontstring = '"%s, %s"' % (font, fontsize)
         term = 'postscript color enhanced %s' % (fontstring)
-        self.save_as_type(term, 'ps', filepath=filepath, **kwargs)
+        return self.save_as_type(term, 'ps', filepath=filepath, **kwargs)
 
     def save_eps(self, filepath=None, font='Helvetica', fontsize=14, **kwargs):
         '''
@@ -289,7 +313,7 @@ class _QTGnuPlot():
 
         fontstring = '"%s, %s"' % (font, fontsize)
         term = 'postscript eps color enhanced %s' % (fontstring)
-        self.save_as_type(term, 'eps', filepath=filepath, **kwargs)
+        return self.save_as_type(term, 'eps', filepath=filepath, **kwargs)
         
     def save_pdf(self, filepath=None, **kwargs):
         '''
@@ -302,7 +326,7 @@ class _QTGnuPlot():
         '''
 
         term = 'pdf' # enhanced? problem with underscore in filename
-        self.save_as_type(term, 'pdf', filepath=filepath, **kwargs)
+        return self.save_as_type(term, 'pdf', filepath=filepath, **kwargs)
         
     def save_png(self, filepath=None, font='', transparent=False, **kwargs):
         '''
@@ -325,16 +349,16 @@ class _QTGnuPlot():
                 transparent = '#ffffff'
             transparent = 'transparent %s' % transparent
 
-        self.save_as_type('png %s %s size 1024,768' % (font, transparent),
+        return self.save_as_type('png %s %s size 1024,768' % (font, transparent),
                 'png', filepath=filepath, **kwargs)
 
     def save_jpeg(self, filepath=None, **kwargs):
         '''Save jpeg version of the plot'''
-        self.save_as_type('jpeg', 'jpg', filepath=filepath, **kwargs)
+        return self.save_as_type('jpeg', 'jpg', filepath=filepath, **kwargs)
 
     def save_svg(self, filepath=None, **kwargs):
         '''Save svg version of the plot'''
-        self.save_as_type('svg', 'svg', filepath=filepath, **kwargs)
+        return self.save_as_type('svg', 'svg', filepath=filepath, **kwargs)
 
     def _write_gp(self, s, filepath=None, **kwargs):
 
@@ -368,16 +392,16 @@ class _QTGnuPlot():
         self.cmd(cmd)
         return True
 
-    def cmd(self, cmdstr):
+    def cmd(self, cmdstr, defer=False):
         '''Send command to gnuplot instance directly.'''
         if self._gnuplot is not None:
-            self._gnuplot.cmd(cmdstr)
+            self._gnuplot.cmd(cmdstr, defer=defer)
 
     def live(self):
         self._gnuplot.live()
 
     def is_busy(self):
-        return not self._gnuplot.is_responding()
+        return self._gnuplot.is_busy()
 
     def set_grid(self, on=True, update=True):
         self.set_property('grid', on, update=update)
@@ -1007,3 +1031,39 @@ def plot_file(filename, name='plot', update=True, clear=False, **kwargs):
     if update:
         p.update()
 
+def export_all(plots=None, formats=('png', ), filepath=None, wait=False,
+        **kwargs):
+    '''
+    Export plots in the background with the gnuplot export pool.
+
+    Input:
+        plots (list): plots or plot names, all plots if None
+        formats (list): formats, e.g. 'png', 'ps', 'eps', 'pdf' or 'svg'
+        filepath (path): directory or file path, see save_as_type()
+        wait (bool): wait until all plots are exported
+        kwargs: passed to the save_<format> functions
+
+    Output:
+        List of job ids
+    '''
+
+    plotlist = plot.Plot.get_named_list()
+    if plots is None:
+        plots = plotlist.get_items()
+    if type(formats) in types.StringTypes:
+        formats = (formats, )
+
+    ids = []
+    for p in plots:
+        if type(p) in types.StringTypes:
+            p = plotlist[p]
+        for fmt in formats:
+            func = getattr(p, 'save_%s' % fmt, None)
+            if func is None:
+                logging.warning('Unsupported export format: %s', fmt)
+                continue
+            ids.append(func(filepath=filepath, background=True, **kwargs))
+
+    if wait:
+        gnuplotexport.get_export_pool().wait()
+    return ids
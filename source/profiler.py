@@ -0,0 +1,183 @@
+# profiler.py, latency statistics of instrument get/set/call operations
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import time
+from math import frexp
+from lib.network.object_sharer import SharedObject
+
+# for backward compatibility to python 2.5
+try:
+    import json
+except:
+    import simplejson as json
+
+class _LatencyStats:
+    '''
+    Histograms are dictionaries exponent -> count, where the bucket with
+    exponent e holds times in [2**(e-1), 2**e) seconds (as returned by
+    math.frexp). Zero times are counted in the ~1 nsec bucket.
+    '''
+
+    def __init__(self):
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+        # time in: driver, overhead (casting, formatting, signals), lock wait
+        self.sums = [0.0, 0.0, 0.0]
+        self.hists = [{}, {}, {}]
+
+    def add(self, total, driver, lock):
+        self.n += 1
+        self.total += total
+        if total > self.max:
+            self.max = total
+        sums = self.sums
+        overhead = total - driver - lock
+        sums[0] += driver
+        sums[1] += overhead
+        sums[2] += lock
+        h, e = self.hists[0], frexp(driver + 1e-9)[1]
+        h[e] = h.get(e, 0) + 1
+        h, e = self.hists[1], frexp(overhead + 1e-9)[1]
+        h[e] = h.get(e, 0) + 1
+        # most operations don't wait for a lock, zero times are counted in
+        # get()
+        if lock > 0:
+            h, e = self.hists[2], frexp(lock)[1]
+            h[e] = h.get(e, 0) + 1
+
+    def get(self):
+        ret = {
+            'n': self.n,
+            'total': self.total,
+            'mean': self.total / self.n,
+            'max': self.max,
+        }
+        for i, name in enumerate(('driver', 'overhead', 'lock')):
+            hist = dict(self.hists[i])
+            nzero = self.n - sum(hist.values())
+            if nzero > 0:
+                e = frexp(1e-9)[1]
+                hist[e] = hist.get(e, 0) + nzero
+            ret[name] = self.sums[i]
+            ret['%s_hist' % name] = dict((2.0 ** e, c) \
+                    for e, c in hist.iteritems())
+        return ret
+
+class Profiler(SharedObject):
+    '''
+    Collects the latency of Instrument.get, Instrument.set and
+    Instrument.call per instrument and parameter (or function), split into
+    time spent in the driver, overhead (type casting, format maps, signal
+    queueing) and time waiting for the access lock.
+
+    Profiling is disabled by default, use enable() to start collecting.
+    '''
+
+    def __init__(self):
+        SharedObject.__init__(self, 'profiler')
+        self._stats = {}
+        self._enabled = False
+
+    def enable(self):
+        '''Start recording instrument access latencies.'''
+        import instrument
+        self._enabled = True
+        instrument.Instrument._profiler = self
+
+    def disable(self):
+        '''Stop recording instrument access latencies.'''
+        import instrument
+        self._enabled = False
+        instrument.Instrument._profiler = None
+
+    def is_enabled(self):
+        return self._enabled
+
+    def reset(self):
+        '''Remove all recorded statistics.'''
+        self._stats = {}
+
+    def record(self, ins, name, op, total, driver, lock):
+        '''
+        Record an operation.
+
+        Input:
+            ins (string): instrument name
+            name (string): parameter or function name
+            op (string): 'get', 'set' or 'call'
+            total (float): total duration in seconds
+            driver (float): time spent in the driver
+            lock (float): time spent waiting for the access lock
+        '''
+        key = (ins, name, op)
+        s = self._stats.get(key)
+        if s is None:
+            s = self._stats[key] = _LatencyStats()
+        s.add(total, driver, lock)
+
+    def get_stats(self, ins=None):
+        '''
+        Return statistics as a dictionary
+        {instrument: {'<op> <name>': stats}}, optionally only for
+        instrument <ins>. Times are in seconds, histograms map the upper
+        bucket edge to a count.
+        '''
+        ret = {}
+        for (insname, name, op), s in self._stats.items():
+            if ins is not None and insname != ins:
+                continue
+            ret.setdefault(insname, {})['%s %s' % (op, name)] = s.get()
+        return ret
+
+    def get_slowest(self, n=10):
+        '''Return the <n> (instrument, '<op> <name>', total time) with the
+        largest total time.'''
+        ret = [(ins, '%s %s' % (op, name), s.total) \
+                for (ins, name, op), s in self._stats.items()]
+        ret.sort(key=lambda x: -x[2])
+        return ret[:n]
+
+    def dump(self, filename):
+        '''Write statistics to <filename> in JSON format.'''
+        data = {
+            'time': time.time(),
+            'stats': self.get_stats(),
+        }
+        f = open(filename, 'w')
+        try:
+            json.dump(data, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+
+    def print_stats(self, n=20):
+        '''Print the <n> operations that took the most time.'''
+        items = self._stats.items()
+        items.sort(key=lambda x: -x[1].total)
+        for (ins, name, op), s in items[:n]:
+            total = max(s.total, 1e-12)
+            print '%s %s.%s: n=%d, total %.3f s, mean %.1f us ' \
+                '(driver %.0f%%, overhead %.0f%%, lock %.0f%%)' % \
+                (op, ins, name, s.n, s.total, s.total / s.n * 1e6,
+                    100 * s.sums[0] / total, 100 * s.sums[1] / total,
+                    100 * s.sums[2] / total)
+
+_profiler = None
+def get_profiler():
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler()
+    return _profiler
@@ -12,12 +12,18 @@ To use this to talk to devices do this before creating any instruments:
 
 released under the GPL, whatever version
 
+All instruments on one controller share a single connection (see Bridge),
+the GPIB address is only switched when the target instrument changes.
+
 Changelog:
 0.1 March 2010, initial version, very alpha, most of the functionality is far from bullet proof.
 2010-2013: incorporated into qtlab main, Reinier Heeres
 """
 
+
 import socket
+import select
+import threading
 import time
 import re
 
@@ -28,11 +34,225 @@ def set_controller_address(addr, nport):
     ip = addr
     port = nport
 
-# Connection information to share controller between different instruments
-class ConnectionInfo:
-    def __init__(self, sock, gpib_address=None):
-        self.sock = sock
-        self.gpib_address = gpib_address
+class Bridge:
+    '''
+    Connection to a Prologix GPIB-Ethernet controller, shared by all
+    instruments on its GPIB bus.
+
+    Access is serialized with a per-bridge lock, '++addr' is only sent when
+    the target GPIB address changes and a query (address switch, command
+    and '++read eoi') is sent in a single packet. Replies are read until
+    the read terminator, so long responses are not truncated.
+
+    The connection is counted per instrument (see get() and release()) and
+    reopened on the next transaction if it was closed or dropped.
+    '''
+
+    _bridges = {}
+    _bridges_lock = threading.Lock()
+
+    @staticmethod
+    def get(addr, nport, **kwargs):
+        '''
+        Return the (shared) Bridge for controller addr:nport. Call
+        release() when it is no longer used.
+        '''
+
+        with Bridge._bridges_lock:
+            key = (addr, nport)
+            if key not in Bridge._bridges:
+                Bridge._bridges[key] = Bridge(addr, nport, **kwargs)
+            bridge = Bridge._bridges[key]
+            bridge._refs += 1
+            return bridge
+
+    def __init__(self, addr, nport, timeout=5):
+        self._address = (addr, nport)
+        self._timeout = timeout
+        self._lock = threading.RLock()
+        self._sock = None
+        self._gpib_addr = None
+        self._rxbuf = ''
+        self._refs = 0
+
+        # Statistics
+        self.nsend = 0
+        self.nrecv = 0
+        self.naddr = 0
+
+        self._connect()
+
+    def _connect(self):
+        self._disconnect()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM,
+                socket.IPPROTO_TCP)
+        sock.settimeout(self._timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.connect(self._address)
+        self._sock = sock
+
+        # Controller mode, no saving of settings in the controller, no
+        # read-after-write and assert EOI with the last byte.
+        # The read timeout is maximal 3 seconds for the device.
+        tmo = min(self._timeout, 3)
+        self._send('++savecfg 0\n++mode 1\n++auto 0\n++eoi 1\n'
+                '++read_tmo_ms %d\n' % (tmo * 1000))
+
+    def _disconnect(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        self._gpib_addr = None
+        self._rxbuf = ''
+
+    def release(self):
+        '''Release a reference from get(), close when none are left.'''
+        # Decide under the same lock as get(), so that get() never returns
+        # a bridge that is being closed.
+        with Bridge._bridges_lock:
+            self._refs -= 1
+            if self._refs > 0:
+                return
+            self._unregister()
+        with self._lock:
+            self._disconnect()
+
+    def close(self):
+        with Bridge._bridges_lock:
+            self._unregister()
+        with self._lock:
+            self._disconnect()
+
+    def _unregister(self):
+        '''Remove from the shared bridges, call with _bridges_lock held.'''
+        if Bridge._bridges.get(self._address, None) is self:
+            del Bridge._bridges[self._address]
+
+    def get_lock(self):
+        return self._lock
+
+    def _send(self, data):
+        self._sock.sendall(data)
+        self.nsend += 1
+
+    def _addr_cmd(self, gpib_addr):
+        if gpib_addr is None or gpib_addr == self._gpib_addr:
+            return ''
+        self._gpib_addr = gpib_addr
+        self.naddr += 1
+        return '++addr %d\n' % gpib_addr
+
+    def _clear(self):
+        '''
+        Discard data received but not read, e.g. late bytes of a reply that
+        timed out or a block terminator. Reconnect if the connection is
+        closed.
+        '''
+
+        if self._sock is None:
+            self._connect()
+            return
+
+        self._rxbuf = ''
+        while True:
+            rlist, wlist, xlist = select.select([self._sock], [], [], 0)
+            if len(rlist) == 0:
+                return
+            try:
+                data = self._sock.recv(65536)
+            except socket.error:
+                data = ''
+            if data == '':
+                self._connect()
+                return
+
+    def _recv(self):
+        try:
+            data = self._sock.recv(65536)
+        except socket.timeout:
+            raise
+        except socket.error:
+            data = ''
+        if data == '':
+            self._disconnect()
+            raise socket.error('Connection closed by controller')
+        self.nrecv += 1
+        return data
+
+    def _read_exactly(self, n):
+        '''Read exactly n bytes, raise socket.timeout on timeout.'''
+
+        buf = self._rxbuf
+        while len(buf) < n:
+            try:
+                buf += self._recv()
+            except socket.timeout:
+                self._rxbuf = ''
+                raise
+        self._rxbuf = buf[n:]
+        return buf[:n]
+
+    def _read(self, term):
+        '''
+        Read until (and including) term, raise socket.timeout if it does
+        not arrive in time. If term is empty read until the socket times
+        out.
+        '''
+
+        buf = self._rxbuf
+        ofs = 0
+        while True:
+            if term:
+                i = buf.find(term, ofs)
+                if i != -1:
+                    i += len(term)
+                    self._rxbuf = buf[i:]
+                    return buf[:i]
+                ofs = max(0, len(buf) - len(term) + 1)
+
+            try:
+                buf += self._recv()
+            except socket.timeout:
+                self._rxbuf = ''
+                if not term:
+                    return buf
+                raise socket.timeout('Read timed out after %d bytes' % \
+                        len(buf))
+
+    def transaction(self, gpib_addr, data='', read=False, read_term='\n',
+            nbytes=None):
+        '''
+        Send data to the instrument at gpib_addr and, if read is True,
+        request and return its reply. If nbytes is given exactly that many
+        bytes are returned; with read False these continue a reply that was
+        requested earlier.
+
+        If sending fails the connection is reopened and the data is sent
+        once more; a failure while reading is raised, as the command may
+        already have been executed.
+        '''
+
+        if read:
+            data += '++read eoi\n'
+
+        with self._lock:
+            if data != '':
+                # A new command, stale data and a closed connection are
+                # dealt with before sending
+                self._clear()
+                try:
+                    self._send(self._addr_cmd(gpib_addr) + data)
+                except socket.error:
+                    self._connect()
+                    self._send(self._addr_cmd(gpib_addr) + data)
+            elif self._sock is None:
+                raise socket.error('Connection closed by controller')
+
+            if nbytes is not None:
+                return self._read_exactly(nbytes)
+            elif read:
+                return self._read(read_term)
+            return None
 
 class instrument(object):
     """
@@ -45,16 +265,13 @@ class instrument(object):
         visa='prologix_ethernet')
     """
 
-    CONNECTIONS = {}
-
-    def __init__(self, gpib, **kwargs):	
-        self.conn = None
-
+    def __init__(self, gpib, **kwargs):
         # for compatibility with NI visa
         self.timeout = kwargs.get("timeout", 5)
         self.chunk_size = kwargs.get("chunk_size", 20*1024)
         self.values_format = kwargs.get("values_format", 'ascii') # fixme: single, double
         self.term_char = kwargs.get("term_char", None)
+        self.read_term = kwargs.get("read_term", '\n')
         self.send_end = kwargs.get("send_end", True)
         self.delay = kwargs.get("delay", 0)
         self.lock = kwargs.get("lock", False)
@@ -62,34 +279,26 @@ class instrument(object):
         # parse gpib address (throws an Error() if fails)
         self.gpib_addr = self._get_gpib_adr_from_string(gpib)
 
-        # open connection
-        self._open_connection()
-
-        if self.send_end:
+        if self.send_end or self.term_char is None:
             self.term_char = '\r\n'
-            self._set_EOI_assert()
-
-        # disable the automatic saving of parameters in
-        # the ethernet-gpib device,
 
-        self._set_saveconfig(False)
+        # whether the next read_raw() has to request a new reply
+        self._need_read = True
 
-        # set set the ethernet gpib device to be the controller of#
-        # the gpib chain
-        self._set_controller_mode()
-        # set the GPIB address of the device
-        self._set_gpib_address()
-
-        self._set_EOI_assert()
-        self._set_read_timeout()
-        self._set_read_after_write(False)
-        #self._dump_internal_vars()
+        # open (or share) connection to the controller
+        self.bridge = Bridge.get(kwargs.get('ip', ip),
+                kwargs.get('port', port), timeout=self.timeout)
 
     # wrapper functions for py visa
     def write(self, cmd):
         return self._send(cmd)
     def read(self):
         return self._recv()
+    def read_raw(self, n):
+        '''Read exactly n bytes of the reply to the last command.'''
+        read = self._need_read
+        self._need_read = False
+        return self.bridge.transaction(self.gpib_addr, read=read, nbytes=n)
     def read_values(self, format):
         return self._recv()
 
@@ -124,110 +333,52 @@ class instrument(object):
     def _send(self, cmd):
         cmd = cmd.rstrip()
         cmd += self.term_char
-        #self._set_read_after_write(False)
-        self.conn.sock.send(cmd)
+        self._need_read = True
+        self.bridge.transaction(self.gpib_addr, cmd)
         time.sleep(self.delay)
 
     def _send_recv(self, cmd, **kwargs):
-        bufflen = kwargs.get("bufflen", self.chunk_size)
         cmd = cmd.rstrip()
         cmd += self.term_char
-        #print cmd
-
-        self._send(cmd)
-        self._set_read()
-        return self.conn.sock.recv(bufflen)
+        self._need_read = True
+        return self.bridge.transaction(self.gpib_addr, cmd, read=True,
+                read_term=kwargs.get('read_term', self.read_term))
 
     def _recv(self, **kwargs):
-        bufflen = kwargs.get("bufflen", self.chunk_size)
-        self._set_read()
+        self._need_read = True
+        return self.bridge.transaction(self.gpib_addr, read=True,
+                read_term=kwargs.get('read_term', self.read_term))
 
-        buff = self.conn.sock.recv(bufflen)
-        return buff
-
-    def _open_connection(self):
-        connid = (ip, port)
-        if connid in instrument.CONNECTIONS:
-            self.conn = instrument.CONNECTIONS[connid]
-
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM,
-                socket.IPPROTO_TCP)
-        sock.settimeout(0.1)
-        sock.connect((ip, port))
-        self.conn = ConnectionInfo(sock, None)
-        instrument.CONNECTIONS[connid] = self.conn
+    def _controller_cmd(self, cmd):
+        self.bridge.transaction(self.gpib_addr, cmd + '\n')
 
     def _close_connection(self):
-        self.sock.close()
-
-    def _set_read(self):
-        self._send("++read eoi")
-
-    def _set_saveconfig(self, On=False):
-        # should not be used very frequently
-        if On:
-            self._send("++savecfg 1")
-        else:
-            self._send("++savecfg 0")
-
-    def _set_gpib_address(self, **kwargs):
-        # GET GPIB address
-        self.gpib_addr = kwargs.get("gpib_addr", self.gpib_addr)
-        # SET GPIB address on the device
-        self._send("++addr " + str(self.gpib_addr) + "\n")
-
-    def _set_controller_mode(self, C_Mode=True):
-        # set gpib_ethernet into controller mode (True) or in device mode (False)
-        if C_Mode:
-            # controller mode
-            self._send("++mode 1")
-        else:
-            # device mode
-            self._send("++mode 0")
+        self.bridge.release()
 
-    def _set_read_after_write(self, On=True):
-        if On:
-            # Turn on read-after-write
-            self.sock.send("++auto 1\r\n")
-        else:
-            # Turn off read-after-write to avoid "Query Unterminated" errors
-            self.sock.send("++auto 0\r\n")
-
-    def _set_read_timeout(self, **kwargs):
-        timeout = kwargs.get("timeout", self.timeout)
-        # Read timeout is maximal 3 seconds for my device
-        if timeout > 3:
-                timeout = 3
-        self._send("++read_tmo_ms "+str(timeout*1000))
-
-    def _set_EOI_assert(self, On=True): #
-        # Assert EOI signal line with last byte to indicate end of data
-        if On:
-            self._send("++eoi 1\n")
-        else:
-            self._send("++eoi 0\n")
+    def _set_trigger(self):
+        self._controller_cmd("++trg")
 
     def _set_GPIB_EOS(self, EOS='\n'): # end of signal/string
         EOSs={'\r\n':0, '\r':1, '\n':2, '':3}
-        self.sock.send("++eos"+EOSs.get(EOS)+"\n")
+        self._controller_cmd("++eos %d" % EOSs.get(EOS))
 
     def _set_GPIB_EOT(self, EOT=False):
         # send at EOI an EOT (end of transmission) character ?
         if EOT:
-            self.sock.send("++eot_enable 1\n")
+            self._controller_cmd("++eot_enable 1")
         else:
-            self.sock.send("++eot_enable 0\n")
+            self._controller_cmd("++eot_enable 0")
 
     def _set_GPIB_EOT_char(self, EOT_char=42):
         # set the EOT character
-        self.sock.send("++eot_char" + EOT_char + "\n")
+        self._controller_cmd("++eot_char %d" % EOT_char)
 
     def _set_ifc(self):
-        self._send("++ifc")
+        self._controller_cmd("++ifc")
 
     def _set_reset(self):
         # Reset Device GPIB endpoint
-        self._send("++rst")
+        self._controller_cmd("++clr")
 
     def _set_GPIB_dev_reset(self):
         # Reset Device GPIB endpoint
@@ -237,16 +388,15 @@ class instrument(object):
         return self._send_recv("*IDN?")
 
     def _dump_internal_vars(self):
-        print "timeout" + self.timeout
-        print "chunk_size" + self.chunk_size
-        print "values_format" + self.values_format
-        print "term_char" + self.term_char
-        print "send_end" + self.send_end
-        print "delay" + self.delay
-        print "lock" + self.lock
-        print "gpib_addr" + self.gpib_addr
-        print "ip" + ip
-        print "port" + port
+        print "timeout %s" % self.timeout
+        print "chunk_size %s" % self.chunk_size
+        print "values_format %s" % self.values_format
+        print "term_char %r" % self.term_char
+        print "send_end %s" % self.send_end
+        print "delay %s" % self.delay
+        print "lock %s" % self.lock
+        print "gpib_addr %s" % self.gpib_addr
+        print "bridge %s:%s" % self.bridge._address
 
     # generic error class
     class Error(Exception):
@@ -257,27 +407,132 @@ class instrument(object):
 
     def CheckError(self):
         # check for device error
-        self.sock.send("SYST:ERR?\n")
-        self.sock.send("++read eoi\n")
-
-        s = None
-
         try:
-            s = self.sock.recv(100)
-        except socket.timeout:
-            print "socket timeout"
-            s = ""
-
+            s = self._send_recv("SYST:ERR?")
         except socket.error, e:
-            pass
+            print e
+            s = ""
 
         print s
-        print e
+
+class _FakePrologix:
+    '''
+    Minimal loopback Prologix controller for testing without hardware.
+
+    Queries (commands ending with '?') are answered by responder(gpib_addr,
+    cmd) after '++read eoi'; the default replies '<addr>,<cmd>\\n'.
+    '''
+
+    def __init__(self, responder=None):
+        if responder is None:
+            responder = lambda addr, cmd: '%d,%s\n' % (addr, cmd)
+        self._responder = responder
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(('127.0.0.1', 0))
+        self._server.listen(5)
+        self.address = self._server.getsockname()
+        self.naddr = 0
+        self.nreads = 0
+
+        t = threading.Thread(target=self._serve)
+        t.daemon = True
+        t.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, addr = self._server.accept()
+            except socket.error:
+                return
+            t = threading.Thread(target=self._handle, args=(conn, ))
+            t.daemon = True
+            t.start()
+
+    def _handle(self, conn):
+        gpib = None
+        pending = ''
+        buf = ''
+        while True:
+            data = conn.recv(4096)
+            if data == '':
+                conn.close()
+                return
+            buf += data
+            lines = buf.split('\n')
+            buf = lines.pop()
+            for line in lines:
+                line = line.rstrip('\r')
+                if line.startswith('++addr'):
+                    gpib = int(line.split()[1])
+                    self.naddr += 1
+                elif line.startswith('++read'):
+                    self.nreads += 1
+                    conn.sendall(pending)
+                    pending = ''
+                elif line.startswith('++'):
+                    pass
+                elif line.endswith('?'):
+                    pending = self._responder(gpib, line)
+
+    def close(self):
+        self._server.close()
 
 # do some checking ...
 if __name__ == "__main__":
-   ls = instrument("GPIB::10", ip="172.22.197.181", delay=0.01)
-   ls.write("*IDN?")
-   print ls.read()
-   ls._close_connection()
-
+    # Poll 5 instruments on one (fake) controller and count round trips
+    fake = _FakePrologix()
+    set_controller_address(*fake.address)
+    inslist = [instrument("GPIB::%d" % i) for i in range(1, 6)]
+
+    npoll = 200
+    start = time.time()
+    for i in range(npoll):
+        for ins in inslist:
+            ins.ask("MEAS?")
+    dt = time.time() - start
+
+    bridge = inslist[0].bridge
+    nq = npoll * len(inslist)
+    print '%d queries in %.3f s (%.1f us / query)' % (nq, dt, dt / nq * 1e6)
+    print 'Packets sent: %d (%.2f / query), address switches: %d' % \
+            (bridge.nsend, float(bridge.nsend) / nq, bridge.naddr)
+    print 'Packets received: %d' % bridge.nrecv
+
+    # Long replies are read completely
+    fake._responder = lambda addr, cmd: ','.join(['1.0'] * 50000) + '\n'
+    print 'Long reply: %d bytes' % len(inslist[0].ask("DATA?"))
+
+    # Closing one instrument keeps the shared connection open
+    fake._responder = lambda addr, cmd: '%d,%s\n' % (addr, cmd)
+    inslist[1]._close_connection()
+    print 'After closing an instrument: %r' % inslist[0].ask("MEAS?")
+    bridge.close()
+
+    # get() and the release of the last reference race without handing
+    # out a bridge that is being closed, also when closing the socket is
+    # slow
+    _disconnect = Bridge._disconnect
+    def _slow_disconnect(self):
+        time.sleep(0.001)
+        _disconnect(self)
+    Bridge._disconnect = _slow_disconnect
+    def _get_release(nloop, dying):
+        for i in range(nloop):
+            b = Bridge.get(*fake.address)
+            time.sleep(0.002)
+            # while referenced it should stay the shared bridge
+            if Bridge._bridges.get(fake.address, None) is not b:
+                dying.append(b)
+            b.release()
+            time.sleep(0.001)
+    dying = []
+    threads = [threading.Thread(target=_get_release, args=(200, dying)) \
+            for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    Bridge._disconnect = _disconnect
+    print 'Closing bridges handed out by get(): %d' % len(dying)
+    fake.close()
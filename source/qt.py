@@ -8,6 +8,7 @@ from lib import config as _config
 from data import Data
 from plot import Plot, plot, plot3, replot_all
 from scripts import Scripts, Script
+from profiler import get_profiler
 
 config = _config.get_config()
 
@@ -22,11 +23,17 @@ msleep = flow.measurement_idle
 mstart = flow.measurement_start
 mend = flow.measurement_end
 
+profiler = get_profiler()
+
 from plot import Plot2D, Plot3D
 try:
     from plot import plot_file
 except:
     pass
+try:
+    from plot import export_all
+except:
+    pass
 
 plots = Plot.get_named_list()
 
@@ -22,6 +22,7 @@ import logging
 import time
 from gettext import gettext as _L
 from lib.misc import exact_time, get_traceback
+from lib import sleeper
 from lib.network.object_sharer import SharedGObject
 import os
 
@@ -131,12 +132,17 @@ class FlowControl(SharedGObject):
         to be executed by the time this function handles the event queue.
         After that it handles events and sleeps for periods of 10msec. Every
         <emit_interval> seconds it will emit another measurement-idle signal.
+        The final part of the delay is spent in a precise sleep (see
+        lib.sleeper), the achieved timing is recorded per call site and can
+        be shown with sleeper.print_stats().
 
-        If exact=True, timing should be a bit more precise, but in this case
-        a delay <= 1msec will result in NO gui interaction.
+        If exact=True, event handling is stopped 1msec before the end of the
+        delay, so that it cannot make the delay overrun. In this case a delay
+        <= 1msec will result in NO gui interaction.
         '''
 
         start = exact_time()
+        deadline = start + delay
 
         self.emit('measurement-idle')
         lastemit = exact_time()
@@ -153,15 +159,18 @@ class FlowControl(SharedGObject):
                 self.emit('measurement-idle')
                 lastemit = curtime
 
-            dt = exact_time() - start
-            self.run_mainloop(delay-dt, wait=False, exact=exact)
+            self.run_mainloop(deadline - exact_time(), wait=False,
+                    exact=exact)
 
-            dt = exact_time() - start
-            if dt + 0.01 < delay:
-                time.sleep(0.01)
+            if deadline - exact_time() > 0.01:
+                sleeper.coarse_sleep(0.01)
             else:
-                time.sleep(max(0, delay - dt))
-                return
+                sleeper.sleep_until(deadline)
+                break
+
+        if sleeper.record_stats:
+            sleeper.record(sleeper.get_call_site(), delay,
+                    exact_time() - start)
 
     def _run_script(self, scriptfile):
         return execfile(scriptfile)
@@ -85,13 +85,19 @@ def do_start():
 if __name__ == '__main__':
     print 'Starting QT Lab environment...'
     filelist = do_start()
+    from lib import starttrace
+    _tracer = starttrace.start()
     for (dir, name) in filelist:
         filename = '%s/%s' % (dir, name)
         print 'Executing %s...' % (filename)
+        if _tracer is not None:
+            _tracer.start_file(filename)
         try:
             execfile(filename)
         except SystemExit:
             break
+    starttrace.finish()
+    del starttrace, _tracer
 
     try:
         del filelist, dir, name, filename
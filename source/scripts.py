@@ -19,9 +19,25 @@ import os
 import logging
 
 class Script():
+    '''
+    A python script that can be called like a function. Arguments are
+    available in the script as 'args' and 'kwargs', the script can
+    return a value by calling set_return(<value>).
 
-    def __init__(self, fn):
+    The compiled code is cached and only recompiled when the modification
+    time or size of the file changes.
+
+    A persistent script is executed only once (and again after it has been
+    modified); calling it calls the function main(*args, **kwargs) that it
+    defines, so its top-level setup code is not repeated for every call.
+    '''
+
+    def __init__(self, fn, persistent=False):
         self._fn = fn
+        self._persistent = persistent
+        self._code = None
+        self._code_key = None
+        self._ns = None
         self._read_doc()
 
     def __repr__(self):
@@ -44,6 +60,34 @@ class Script():
                 break
         f.close()
 
+    def _get_code(self):
+        '''Return the code object, recompile if the file has changed.'''
+
+        st = os.stat(self._fn)
+        key = (st.st_mtime, st.st_size)
+        if key != self._code_key:
+            f = open(self._fn, 'rU')
+            try:
+                src = f.read()
+            finally:
+                f.close()
+            self._code = compile(src + '\n', self._fn, 'exec')
+            self._code_key = key
+            self._ns = None
+            self._read_doc()
+        return self._code
+
+    def set_persistent(self, persistent):
+        '''
+        Set whether the script is persistent: run its top-level code once
+        and call its main() function for every call.
+        '''
+        self._persistent = persistent
+        self._ns = None
+
+    def get_persistent(self):
+        return self._persistent
+
     def _set_return(self, retval):
         self._ret_val = retval
 
@@ -51,6 +95,24 @@ class Script():
         return self._ret_val
 
     def __call__(self, *args, **kwargs):
+        code = self._get_code()
+
+        if self._persistent:
+            if self._ns is None:
+                ns = {
+                    '__name__': '__script__',
+                    '__file__': self._fn,
+                    'args': (),
+                    'kwargs': {},
+                    'set_return': self._set_return,
+                }
+                exec code in ns
+                self._ns = ns
+            main = self._ns.get('main', None)
+            if main is None:
+                raise ValueError('Persistent script %s does not define main()' % self._fn)
+            return main(*args, **kwargs)
+
         self._set_return(None)
 
         locals = {
@@ -58,7 +120,7 @@ class Script():
                 'kwargs': kwargs,
                 'set_return': self._set_return,
         }
-        execfile(self._fn, locals)
+        exec code in locals
 
         return self._get_return()
 
@@ -140,4 +202,58 @@ class Scripts():
 
     def update(self):
         self.scripts_to_namespace(globals())
- 
\ No newline at end of file
+ 
+
+    def set_persistent(self, name, persistent=True):
+        '''
+        Make script <name> persistent (or not): its top-level code runs
+        once and every call runs its main() function.
+        '''
+        s = self.get(name)
+        if s is not None:
+            s.set_persistent(persistent)
+        return s
+
+if __name__ == '__main__':
+    import tempfile
+    import time
+
+    tmpdir = tempfile.mkdtemp()
+    fn = os.path.join(tmpdir, 'helper.py')
+
+    def write(src):
+        f = open(fn, 'w')
+        f.write(src)
+        f.close()
+
+    write('# helper\nset_return(args[0] + 1)\n')
+    s = Script(fn)
+    print 'Call: %s' % (s(1) == 2)
+
+    # A different size is always detected, also within the mtime resolution
+    write('# helper\nset_return(args[0] + 10)\n')
+    print 'Recompiled after edit: %s' % (s(1) == 11)
+    write('# helper\nset_return(args[0] + 20)\n')
+    t = time.time() + 10
+    os.utime(fn, (t, t))
+    print 'Recompiled after edit with same size: %s' % (s(1) == 21)
+
+    n = 1000
+    start = time.time()
+    for i in xrange(n):
+        execfile(fn, {'args': (i,), 'kwargs': {}, 'set_return': s._set_return})
+    t_execfile = time.time() - start
+    start = time.time()
+    for i in xrange(n):
+        s(i)
+    t_cached = time.time() - start
+    print '%d calls: execfile %.3f s, cached code %.3f s' % \
+            (n, t_execfile, t_cached)
+
+    write('# helper\nimport time\nsetup = time.time()\n' \
+            'def main(x):\n    return (setup, x * 2)\n')
+    s.set_persistent(True)
+    first = s(1)
+    second = s(2)
+    print 'Persistent: setup once %s, main per call %s' % \
+            (first[0] == second[0], (first[1], second[1]) == (2, 4))
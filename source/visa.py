@@ -18,6 +18,7 @@
 import logging
 import socket
 import select
+import numpy
 
 try:
     from pyvisa import SerialInstrument
@@ -48,11 +49,18 @@ set_visa('pyvisa')
 class TcpIpInstrument:
     '''
     Class to mimic visa instrument for TCP/IP connected text-based devices.
+
+    Received data is kept in a buffer, so bytes following a reply are not
+    lost. IEEE-488.2 definite length binary blocks (#<n><length><data>)
+    can be read directly into a numpy array with read_binary_values().
     '''
 
+    RECV_SIZE = 65536
+
     def __init__(self, host, port, timeout=20, termchars='\n'):
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._socket.connect((host, port))
+        self._rxbuf = bytearray()
 
         self._termchars = termchars
         self._timeout = timeout
@@ -66,38 +74,196 @@ class TcpIpInstrument:
         self._termchars = termchars
 
     def clear(self):
-        rlist, wlist, xlist = select.select([self._socket], [], [], 0)
-        if len(rlist) == 0:
-            return
-        ret = self.read()
+        '''Discard all data that has been received but not read.'''
+        del self._rxbuf[:]
+        while True:
+            rlist, wlist, xlist = select.select([self._socket], [], [], 0)
+            if len(rlist) == 0:
+                return
+            if len(self._socket.recv(self.RECV_SIZE)) == 0:
+                return
 
     def write(self, data):
         self.clear()
         if not data.endswith(self._termchars):
             data += self._termchars
-        self._socket.send(data)
+        self._socket.sendall(data)
+
+    def _recv(self, timeout):
+        '''Receive more data into the buffer; raise socket.timeout on timeout.'''
+        self._socket.settimeout(timeout)
+        try:
+            data = self._socket.recv(self.RECV_SIZE)
+        finally:
+            self._socket.settimeout(self._timeout)
+        if len(data) == 0:
+            raise socket.error('Connection closed')
+        self._rxbuf.extend(data)
+
+    def _read_until(self, termchars, timeout):
+        '''Return buffered data up to (not including) termchars.'''
+
+        ofs = 0
+        while True:
+            i = self._rxbuf.find(termchars, ofs)
+            if i != -1:
+                ans = str(self._rxbuf[:i])
+                del self._rxbuf[:i+len(termchars)]
+                return ans
+            ofs = max(0, len(self._rxbuf) - len(termchars) + 1)
+            self._recv(timeout)
+
+    def _read_exactly(self, n, timeout):
+        while len(self._rxbuf) < n:
+            self._recv(timeout)
+        ans = str(self._rxbuf[:n])
+        del self._rxbuf[:n]
+        return ans
 
     def read(self, timeout=None):
         if timeout is None:
             timeout = self._timeout
-        start = time()
         try:
-            ans = ''
-            while len(ans) == 0 and (time() - start) < timeout and not ans.endswith(self._termchars):
-                ans2 = self._socket.recv(8192)
-                ans += ans2
-                if len(ans2) == 0:
-                    sleep(0.005)
+            return self._read_until(self._termchars, timeout)
         except socket.timeout, e:
             logging.warning('TCP/IP instrument read timed out')
             return ''
 
-        if ans.endswith(self._termchars):
-            ans = ans[:-len(self._termchars)]
-        return ans
+    def read_raw(self, n, timeout=None):
+        '''Read exactly n bytes.'''
+        if timeout is None:
+            timeout = self._timeout
+        return self._read_exactly(n, timeout)
+
+    def read_binary_values(self, dtype='f4', endianness='<', timeout=None):
+        '''
+        Read an IEEE-488.2 binary block and return it as a numpy array.
+
+        Input:
+            dtype: numpy data type of the elements, e.g. 'f4', 'f8', 'i2'
+            endianness: '<' (little, default) or '>' (big endian)
+
+        The data of a definite length block is received straight into the
+        preallocated array; an indefinite length block (#0) is read up to
+        the termination characters.
+        '''
+
+        if timeout is None:
+            timeout = self._timeout
+        if endianness in ('little', 'big'):
+            endianness = {'little': '<', 'big': '>'}[endianness]
+        dtype = numpy.dtype(dtype).newbyteorder(endianness)
+
+        # Skip anything before the block header, e.g. whitespace
+        while True:
+            i = self._rxbuf.find('#')
+            if i != -1:
+                del self._rxbuf[:i]
+                break
+            del self._rxbuf[:]
+            self._recv(timeout)
+
+        ndigits = int(self._read_exactly(2, timeout)[1])
+        if ndigits == 0:
+            data = self._read_until(self._termchars, timeout)
+            return numpy.frombuffer(data, dtype=dtype).copy()
+
+        nbytes = int(self._read_exactly(ndigits, timeout))
+        if nbytes % dtype.itemsize != 0:
+            raise ValueError('Block length %d is not a multiple of %d' % \
+                    (nbytes, dtype.itemsize))
+
+        ret = numpy.empty(nbytes / dtype.itemsize, dtype=dtype)
+        view = memoryview(ret.view(numpy.uint8))
+
+        # Data that was already buffered, then receive the rest in place
+        nbuf = min(nbytes, len(self._rxbuf))
+        view[:nbuf] = str(self._rxbuf[:nbuf])
+        del self._rxbuf[:nbuf]
+
+        pos = nbuf
+        self._socket.settimeout(timeout)
+        try:
+            while pos < nbytes:
+                n = self._socket.recv_into(view[pos:], nbytes - pos)
+                if n == 0:
+                    raise socket.error('Connection closed')
+                pos += n
+        finally:
+            self._socket.settimeout(self._timeout)
+
+        # Remove the terminator following the block, if present
+        try:
+            while len(self._rxbuf) < len(self._termchars):
+                self._recv(0.05)
+        except socket.timeout:
+            pass
+        if str(self._rxbuf[:len(self._termchars)]) == self._termchars:
+            del self._rxbuf[:len(self._termchars)]
+
+        return ret
 
     def ask(self, data):
         self.clear()
         self.write(data)
         return self.read()
 
+    def ask_for_binary_values(self, data, dtype='f4', endianness='<'):
+        self.clear()
+        self.write(data)
+        return self.read_binary_values(dtype, endianness)
+
+if __name__ == '__main__':
+    # Serve a multi-megabyte binary block on a local socket and compare
+    # reading by concatenating strings with read_binary_values().
+    import threading
+    import time
+
+    npoints = 4 * 1024 * 1024
+    payload = numpy.arange(npoints, dtype='<f4').tostring()
+    header = '#%d%d' % (len(str(len(payload))), len(payload))
+    block = header + payload + '\n'
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+
+    def serve():
+        conn, addr = server.accept()
+        buf = ''
+        while True:
+            data = conn.recv(4096)
+            if data == '':
+                break
+            buf += data
+            while '\n' in buf:
+                line, buf = buf.split('\n', 1)
+                if line == 'DATA?':
+                    conn.sendall(block)
+        conn.close()
+
+    t = threading.Thread(target=serve)
+    t.daemon = True
+    t.start()
+
+    ins = TcpIpInstrument(*server.getsockname())
+
+    def read_concat():
+        # Previous approach: recv(8192) and concatenate strings
+        ins.write('DATA?')
+        ans = ''
+        while len(ans) < len(block):
+            ans += ins._socket.recv(8192)
+        return numpy.frombuffer(ans[len(header):-1], dtype='<f4')
+
+    for name, func in (
+            ('recv(8192) + concatenate', read_concat),
+            ('read_binary_values()',
+                lambda: ins.ask_for_binary_values('DATA?', 'f4', '<'))):
+        start = time.time()
+        for i in range(5):
+            vals = func()
+        dt = (time.time() - start) / 5
+        assert len(vals) == npoints and vals[-1] == npoints - 1
+        print '%-25s %6.1f ms, %6.1f MB/s' % (name, dt * 1e3,
+                len(block) / dt / 1e6)